@@ -23,11 +23,13 @@ from mxmcc import catalog
 from mxmcc import tilebuilder
 from mxmcc import tilesmerge
 from mxmcc import gemf
+from mxmcc import gemf_fsck
 from mxmcc import zdata
 from mxmcc import verify
 from mxmcc import tiles_opt
 from mxmcc.checkpoint import *
 from mxmcc import encryption_shim
+from mxmcc import executor
 import mbutil as mb
 import re
 
@@ -36,6 +38,19 @@ import shutil
 PROFILE_MX_R = 'MX_REGION'  # (default) renders standard MX Mariner gemf + zdat
 PROFILE_MB_C = 'MB_CHARTS'  # renders each chart as mbtiles file
 PROFILE_MB_R = 'MB_REGION'  # renders entire region as mbtiles file
+PROFILE_MB_W = 'MB_REGION_WEBP'  # renders entire region as mbtiles file of webp tiles
+
+
+def _opt_policy(profile):
+    """tile output format policy of a profile (config.opt_policies)"""
+    policy = config.opt_policies.get(profile, tiles_opt.POLICY_PNG8)
+    if 'MB_' in profile and len(tiles_opt.policy_extensions[policy]) > 1:
+        raise Exception('mbtiles profile %s needs a single tile format, not %s' % (profile, policy))
+    return policy
+
+
+def _mbtiles_format(profile):
+    return tiles_opt.policy_extensions[_opt_policy(profile)][0][1:]
 
 
 def _build_catalog(checkpoint_store, profile, region):
@@ -74,12 +89,28 @@ def _create_tiles(checkpoint_store, profile, region):
         print('skipping checkpoint', point)
 
 
+def _render_merge_tiles(checkpoint_store, profile, region):
+    # create and merge tiles in one pass
+    point = CheckPoint.CHECKPOINT_MERGE
+    if checkpoint_store.get_checkpoint(region, profile) < point:
+        print('building merged tiles for:', region)
+        tilebuilder.build_merged_tiles_for_catalog(region, keep_unmerged=config.fused_keep_unmerged)
+
+        # verify
+        if not verify.verify_tile_dir(os.path.join(config.merged_tile_dir, region)):
+            raise Exception(region + ' was not verified... ' + verify.error_message)
+
+        checkpoint_store.clear_checkpoint(region, profile, point)
+    else:
+        print('skipping checkpoint', point)
+
+
 def _merge_tiles(checkpoint_store, profile, region):
     # merge
     point = CheckPoint.CHECKPOINT_MERGE
     if checkpoint_store.get_checkpoint(region, profile) < point:
         print('merging tiles for:', region)
-        tilesmerge.merge_catalog(region)
+        tilesmerge.merge_catalog(region, mode=config.merge_mode)
         checkpoint_store.clear_checkpoint(region, profile, point)
     else:
         print('skipping checkpoint', point)
@@ -91,7 +122,7 @@ def _optimize_tiles(checkpoint_store, profile, region, base_dir=config.merged_ti
     if checkpoint_store.get_checkpoint(region, profile) < point:
         # if platform.system() == 'Windows':
         #   tiles_opt.set_nothreads()
-        tiles_opt.optimize_dir(os.path.join(base_dir, region))
+        tiles_opt.optimize_dir(os.path.join(base_dir, region), policy=_opt_policy(profile))
 
         # verify all optimized tiles are there
         if not verify.verify_opt(region, base_dir=base_dir):
@@ -129,7 +160,15 @@ def _create_gemf(checkpoint_store, profile, region):
             name = region + '.enc'
         else:
             name = region + '.opt'
-        gemf.generate_gemf(name, add_uid=should_encrypt)
+        gemf_path = gemf.generate_gemf(name, add_uid=should_encrypt, dedup=config.gemf_dedup,
+                                       tile_order=config.gemf_tile_order,
+                                       source_list=[name] + config.gemf_sources.get(region, []),
+                                       pack_ranges=config.gemf_pack_ranges, zoom_bands=config.gemf_zoom_bands)
+        if config.gemf_dedup and not verify.verify_gemf(gemf_path, os.path.join(config.merged_tile_dir, name)):
+            raise Exception(region + ' gemf was not verified... ' + verify.error_message)
+        for path in gemf_path if isinstance(gemf_path, list) else [gemf_path]:
+            if gemf_fsck.fsck(path, config.gemf_fsck_sample):
+                raise Exception(region + ' gemf failed fsck')
         #if should_encrypt:
         #   encryption_shim.generate_token(region)
         checkpoint_store.clear_checkpoint(region, profile, point)
@@ -162,14 +201,14 @@ def _create_region_mb_tiles(checkpoint_store, profile, region):
         mbtiles_file = os.path.join(config.compiled_dir, region + '.mbtiles')
         if os.path.isfile(mbtiles_file):
             os.remove(mbtiles_file)
-        mb.disk_to_mbtiles(region_dir, mbtiles_file, format='png', scheme='xyz')
+        mb.disk_to_mbtiles(region_dir, mbtiles_file, format=_mbtiles_format(profile), scheme='xyz')
 
         checkpoint_store.clear_checkpoint(region, profile, point)
     else:
         print('skipping checkpoint', point)
 
 
-def __create_chart_mb_tiles(region):
+def __create_chart_mb_tiles(region, profile):
     region_charts_dir = os.path.join(config.unmerged_tile_dir, region + '.opt')
     for chart in os.listdir(region_charts_dir):
         print('archiving mbtiles for chart:', chart)
@@ -178,13 +217,13 @@ def __create_chart_mb_tiles(region):
         mbtiles_file = os.path.join(config.compiled_dir, prefix + '.mbtiles')
         if os.path.isfile(mbtiles_file):
             os.remove(mbtiles_file)
-        mb.disk_to_mbtiles(chart_dir, mbtiles_file, format='png', scheme='xyz')
+        mb.disk_to_mbtiles(chart_dir, mbtiles_file, format=_mbtiles_format(profile), scheme='xyz')
 
 
 def _create_chart_mb_tiles(checkpoint_store, profile, region):
     point = CheckPoint.CHECKPOINT_ARCHIVE
     if checkpoint_store.get_checkpoint(region, profile) < point:
-        __create_chart_mb_tiles(region)
+        __create_chart_mb_tiles(region, profile)
         checkpoint_store.clear_checkpoint(region, profile, point)
     else:
         print('skipping checkpoint', point)
@@ -210,15 +249,13 @@ def _skip_zoom(region):
                 i += 1
 
 
-def compile_region(region, profile=PROFILE_MX_R, perform_clean=True):
-    region = region.upper()
-    profile = profile.upper()
-
-    checkpoint_store = CheckPointStore()
-
+def _compile_stages(checkpoint_store, profile, region):
     _build_catalog(checkpoint_store, profile, region)
 
-    _create_tiles(checkpoint_store, profile, region)
+    if 'REGION' in profile and config.fused_render_merge:
+        _render_merge_tiles(checkpoint_store, profile, region)
+    else:
+        _create_tiles(checkpoint_store, profile, region)
 
     if 'REGION' in profile:
         _merge_tiles(checkpoint_store, profile, region)
@@ -240,6 +277,19 @@ def compile_region(region, profile=PROFILE_MX_R, perform_clean=True):
         _optimize_tiles(checkpoint_store, profile, region, base_dir=config.unmerged_tile_dir)
         _create_chart_mb_tiles(checkpoint_store, profile, region)
 
+
+def compile_region(region, profile=PROFILE_MX_R, perform_clean=True):
+    region = region.upper()
+    profile = profile.upper()
+
+    checkpoint_store = CheckPointStore()
+
+    _opt_policy(profile)  # fail before doing any work
+
+    # every stage uses the same pool of worker processes
+    with executor.shared_pool():
+        _compile_stages(checkpoint_store, profile, region)
+
     print('final checkpoint', checkpoint_store.get_checkpoint(region, profile))
     if perform_clean and checkpoint_store.get_checkpoint(region, profile) > CheckPoint.CHECKPOINT_ENCRYPTED:
         cleanup(region, config.unmerged_tile_dir)
@@ -31,9 +31,55 @@ linz_update = 'http://topo.linz.govt.nz/hydro/BSB_UPDATE.zip'
 noaa_web =    'http://www.charts.noaa.gov/RNCs/RNCs.shtml'
 noaa_all =    'http://www.charts.noaa.gov/RNCs/All_RNCs.zip'
 
+# how tiles_opt quantizes png tiles:
+# 'pil' - in process with Pillow (uses libimagequant if Pillow was built with it)
+# 'pngnq' - with the pngnq binary below
+# 'shared' - every tile mapped to one palette built for the whole region (see tiles_opt.palette_zoom_bands)
+png_quantizer = 'pil'
+
 png_nq_binary = 'pngnq'
 # png_nq_binary = 'C:\\pngnq\\pngnqi.exe'
 
+# set to false to always optimize every tile, otherwise tiles_opt reuses optimized tiles from
+# tile_cache_dir/opt for tiles with the same content and optimizer settings
+# (the cache is never pruned, delete tile_cache_dir/opt to reclaim the space)
+tile_opt_cache = True
+
+# tile output format of each compiler profile (see tiles_opt.POLICY_*):
+# 'png8', 'png32', 'jpeg' (opaque tiles), 'webp' or 'auto' (smallest of png8, jpeg and png32 meeting opt_min_psnr)
+# mbtiles profiles need a single format: 'png8', 'png32' or 'webp'
+opt_policies = {'MX_REGION': 'png8',
+                'MB_REGION': 'png8',
+                'MB_CHARTS': 'png8',
+                'MB_REGION_WEBP': 'webp'}
+# lowest peak signal to noise ratio (dB) of a lossy tile the 'auto' format policy accepts
+opt_min_psnr = 40.
+
+# set to true to store identical tiles (open water, land, blank margins) once in gemf archives,
+# duplicate tiles point at the same data (archives are verified tile by tile after they are written)
+gemf_dedup = False
+
+# fraction of the tiles of a finished gemf archive decoded by gemf_fsck before the archive is accepted
+# (the archive structure is always checked, encrypted sgemf tiles are never decoded)
+gemf_fsck_sample = 1.
+
+# order of the tile data in gemf archives: 'range' (file info order), 'morton' or 'hilbert' (tiles next to each
+# other on the chart are next to each other on disk, fewer seeks for clients panning a chart, see gemf_bench.py)
+gemf_tile_order = 'range'
+
+# more sources written into a region's gemf archive along with the region's tiles (one archive and header),
+# region: list of merged tile directory names or .gemf (.sgemf for encrypted regions) / .mbtiles archive paths
+# e.g. {'REGION_15': ['REGION_15.night']}
+gemf_sources = {}
+
+# set to true to merge the ranges of ragged (coastline) coverage into fewer ranges padded with empty tiles
+# where it lowers the header bytes plus gemf.range_penalty per range (the range packing is printed)
+gemf_pack_ranges = False
+
+# set to a list of (min zoom, max zoom or None) to write a region as zoom band archives instead of one archive,
+# e.g. [(0, 10), (11, 14), (15, None)], so clients can download coarse zoom levels first
+gemf_zoom_bands = None
+
 # InputOutput directory
 _root_dir = '/charts'
 
@@ -42,6 +88,19 @@ _root_dir = '/charts'
 # - then use anti-aliased image scale down for the final pass to render the target single zoom
 use_single_zoom_over_zoom = False
 
+# how tilesmerge merges the charts of a region:
+# 'chart' - one chart at a time, painting each chart over the previous ones
+# 'tile' - one destination tile at a time, compositing every chart that contributes to it in one pass
+# 'reverse' - one chart at a time starting with the most detailed, skipping tiles that are already opaque
+merge_mode = 'chart'
+
+# set to true to render and merge the tiles of a region in one pass (tilebuilder.build_merged_tiles_for_catalog)
+# each destination tile is composited in memory from the charts that contribute to it and only merged tiles
+# are written, merge_mode is not used
+fused_render_merge = False
+# set to true to also write each chart's own tiles to the unmerged tile directory in fused mode (for debugging)
+fused_keep_unmerged = False
+
 # UKHO specific meta data excel sheets that change every quarter
 ukho_quarterly_extract = 'Quarterly Extract of Metadata for Raster Charts Oct 2021.xls'
 ukho_source_breakdown = 'Raster supply lists Q3 2021.xlsx'
@@ -72,6 +131,8 @@ compiled_dir = os.path.join(_root_dir, 'compiled')
 _tile_dir = os.path.join(_root_dir, 'tiles')
 merged_tile_dir = os.path.join(_tile_dir, 'merged')
 unmerged_tile_dir = os.path.join(_tile_dir, 'unmerged')
+# (created as needed)
+tile_cache_dir = os.path.join(_tile_dir, 'cache')
 
 # meta data and catalogs
 _meta_dir = os.path.join(_root_dir, 'metadata')
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''One pool of worker processes shared by the stages of a compile run (tilebuilder, tilesmerge, tiles_opt)
+
+   Workers are started with forkserver (where available) from a server process that has
+   already imported gdal, PIL and the mxmcc stages, so starting a worker is cheap and does not
+   copy the parent's memory.
+
+   Use shared_pool() around a run to keep one pool alive for every parallel_map() call inside of it,
+   parallel_map() starts (and stops) its own pool otherwise.
+
+   A parallel_map() state object is written to a temporary file once and loaded once per worker
+   process, tasks only carry the function reference and the item.
+
+   Workers import the mxmcc modules fresh (they are not forked from the parent), every config setting and
+   the module level settings registered with register_settings() (e.g. tiles_opt.png_colors) are copied from
+   the parent with every parallel_map() call so that runtime changes reach the workers.
+'''
+
+import collections
+import contextlib
+import importlib
+import multiprocessing
+import os
+import pickle
+import sys
+import tempfile
+import types
+import uuid
+
+_package = __name__.rpartition('.')[0]
+
+# modules imported by the forkserver process before it starts any workers
+_preload = ['osgeo.gdal', 'PIL.Image', 'numpy'] + \
+           ['%s.%s' % (_package, m) for m in ('tilebuilder', 'tilesmerge', 'tiles_opt') if _package]
+
+# number of parallel_map states a worker process keeps loaded
+_max_worker_states = 2
+
+_pool = None
+_worker_states = collections.OrderedDict()
+
+# module name: names of the module level settings copied to the workers or None for all (see register_settings)
+_settings = collections.OrderedDict()
+
+
+class KeyboardInterruptError(Exception):
+    pass
+
+
+def _context():
+    try:
+        ctx = multiprocessing.get_context('forkserver')
+    except ValueError:  # windows
+        return multiprocessing.get_context()
+    ctx.set_forkserver_preload(_preload)
+    return ctx
+
+
+def _new_pool(processes=None):
+    return _context().Pool(processes=processes or multiprocessing.cpu_count())
+
+
+@contextlib.contextmanager
+def shared_pool(processes=None):
+    """keeps one pool of worker processes for every parallel_map() call made inside of the with block"""
+    global _pool
+    if _pool is not None:  # already inside of a shared pool
+        yield _pool
+        return
+
+    _pool = _new_pool(processes)
+    try:
+        yield _pool
+    finally:
+        pool = _pool
+        _pool = None
+        pool.close()
+        pool.join()
+
+
+def register_settings(module_name, names=None):
+    """registers module level settings that are copied from the parent to the worker processes
+       module_name - __name__ of the module holding the settings
+       names - list of the setting (module global) names, None for every public module global that is not a
+               module, class or function (e.g. config)
+    """
+    if names is None:
+        _settings[module_name] = None
+    elif _settings.get(module_name, []) is not None:
+        _settings.setdefault(module_name, [])
+        _settings[module_name] += [name for name in names if name not in _settings[module_name]]
+
+
+def _module_settings(module):
+    """returns the names of the public module globals of a module that are not modules, classes or functions"""
+    return [name for name, value in sorted(vars(module).items()) if not name.startswith('_') and
+            not isinstance(value, types.ModuleType) and not isinstance(value, type) and not callable(value)]
+
+
+def _settings_snapshot():
+    """returns the list of (module name, list of (name, value)) of the registered settings"""
+    snapshot = []
+    for module_name, names in _settings.items():
+        module = sys.modules.get(module_name)
+        if module is not None:
+            if names is None:
+                names = _module_settings(module)
+            snapshot.append((module_name, [(name, getattr(module, name)) for name in names]))
+    return snapshot
+
+
+def _restore_settings(snapshot):
+    for module_name, values in snapshot:
+        module = importlib.import_module(module_name)
+        for name, value in values:
+            setattr(module, name, value)
+
+
+# the config paths and options read by the workers (e.g. config.unmerged_tile_dir, config.tile_cache_dir)
+if _package:
+    register_settings(_package + '.config')
+
+
+def _load_state(token):
+    """returns the state of a parallel_map() call after restoring the parent's settings in this worker"""
+    loaded = _worker_states.get(token)
+    if loaded is None:
+        with open(token, 'rb') as f:
+            loaded = pickle.load(f)
+        _worker_states[token] = loaded
+        while len(_worker_states) > _max_worker_states:
+            _worker_states.popitem(last=False)
+    snapshot, state = loaded
+    _restore_settings(snapshot)
+    return state
+
+
+def _run_task(task):
+    func, token, item = task
+    try:
+        state = _load_state(token)
+        if state is None:
+            return func(item)
+        return func(state, item)
+    except KeyboardInterrupt:  # http://jessenoller.com/2009/01/08/multiprocessingpool-and-keyboardinterrupt/
+        print('got KeyboardInterrupt')
+        raise KeyboardInterruptError()
+
+
+def call(state, item):
+    """parallel_map function that calls the state object with each item"""
+    return state(item)
+
+
+def parallel_map(func, iterable, state=None, chunksize=None):
+    """returns the list of func(item) or func(state, item) for every item computed by the worker processes
+       func - module level function (functions are sent to workers by reference)
+       state - picklable object sent to each worker process once
+    """
+    items = list(iterable)
+    if len(items) < 2:
+        if state is None:
+            return [func(item) for item in items]
+        return [func(state, item) for item in items]
+
+    fd, token = tempfile.mkstemp(prefix='mxmcc_%s_' % uuid.uuid4().hex, suffix='.state')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump((_settings_snapshot(), state), f, pickle.HIGHEST_PROTOCOL)
+
+    pool = _pool
+    if pool is None:
+        pool = _new_pool()
+
+    try:
+        return pool.map(_run_task, [(func, token, item) for item in items], chunksize)
+    finally:
+        if pool is not _pool:
+            pool.close()
+            pool.join()
+        os.remove(token)
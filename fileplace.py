@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Places tile files without duplicating their data when possible
+
+   place() tries a hard link, then a reflink (copy on write clone) and only then copies the file.
+   A placed file can share its data with the source file, so placed files must never be modified
+   in place. Write a new file and rename it over the old one instead (see save_image()).
+'''
+
+import errno
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# linux/fs.h _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning a method will not work for any file on this volume
+_unsupported = {errno.EXDEV, errno.EPERM, errno.EACCES, errno.EINVAL, errno.ENOTTY,
+                errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)}
+
+_use_link = True
+_use_reflink = fcntl is not None
+
+
+def _tmp_path(dst):
+    """hidden temporary file name next to dst, unique per process and thread"""
+    d, name = os.path.split(dst)
+    return os.path.join(d, '.%s.%d.%d.tmp' % (name, os.getpid(), threading.current_thread().ident))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as src_f:
+        with open(dst, 'wb') as dst_f:
+            fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+
+
+def place(src, dst):
+    """places the file src at dst (replacing dst if it exists) by hard link, reflink or copy
+       returns 'link', 'reflink' or 'copy'
+    """
+    global _use_link
+    global _use_reflink
+
+    tmp = _tmp_path(dst)
+    _remove(tmp)
+
+    if _use_link:
+        try:
+            os.link(src, tmp)
+            os.replace(tmp, dst)
+            return 'link'
+        except OSError as e:
+            _remove(tmp)
+            if e.errno in _unsupported:
+                _use_link = False
+
+    if _use_reflink:
+        try:
+            _reflink(src, tmp)
+            os.replace(tmp, dst)
+            return 'reflink'
+        except OSError as e:
+            _remove(tmp)
+            if e.errno in _unsupported:
+                _use_reflink = False
+
+    shutil.copy(src, tmp)
+    os.replace(tmp, dst)
+    return 'copy'
+
+
+def save_image(img, dst, format='PNG', **params):
+    """saves a PIL image to a new file and renames it over dst, dst may share data with other files"""
+    tmp = _tmp_path(dst)
+    try:
+        img.save(tmp, format=format, **params)
+        os.replace(tmp, dst)
+    except BaseException:
+        _remove(tmp)
+        raise
+
+
+def write_bytes(data, dst):
+    """writes data to a new file and renames it over dst, dst may share data with other files"""
+    tmp = _tmp_path(dst)
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, dst)
+    except BaseException:
+        _remove(tmp)
+        raise
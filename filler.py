@@ -19,17 +19,32 @@ from .regions import is_valid_region
 from .search import MapPathSearch
 from . import logger
 from . import config
+from . import fileplace
+from .tilecache import TransparencyCache, transparency
 
 
 MAX_ZOOM_TIMES = 8
 STD_ZOOM_TIMES = 6
 
+# tile directory: TransparencyCache
+_caches = {}
+
+
+def _transparency_cache(tile_dir):
+    if tile_dir not in _caches:
+        _caches[tile_dir] = TransparencyCache(tile_dir)
+    return _caches[tile_dir]
+
 
 def fill_all_in_region(region):
     for ea in get_tile_list(region):
         mt = MapTile(*get_tile(ea))
         mt.fill_if_necessary()
 
+    for cache in _caches.values():
+        cache.close()
+    _caches.clear()
+
 
 def get_tile(abs_path):
     z = -1
@@ -98,7 +113,7 @@ class MapTile:
         if self.has_transparency():
             abs_path = self.get_path()
             logger.log(logger.OFF, 'filling: ' + abs_path)
-            self.get_image().save(abs_path)
+            fileplace.save_image(self.get_image(), abs_path)
     
     def get_image(self):
         if self.has_transparency():
@@ -121,7 +136,14 @@ class MapTile:
         if not self.exists():
             return False
 
-        return _has_transparency(self._get_image())
+        cache = _transparency_cache(self.tile_dir)
+        tile = os.path.join(str(self.z), str(self.x), str(self.y) + '.png')
+        transp = cache.get(tile)
+        if transp is None:
+            transp = transparency(self._get_image())
+            cache.put(tile, transp)
+
+        return transp != 1
 
     def _get_image(self):
         if self.image is None:
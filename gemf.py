@@ -10,214 +10,557 @@ __copyright__ = 'Copyright (c) 2015, Matrix Mariner Inc.\n' + \
                 'A. Budden'
 __status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
 
-'''This parses through a given ZXY tiled map directory and generates a gemf file.'''
-
+'''This parses through a given ZXY tiled map directory and generates a gemf file (and reads tiles from gemf files).'''
+
+import abc
+import bisect
+import errno
+import hashlib
+import heapq
+import mmap
 import os
+import re
+import struct
+from array import array
+from multiprocessing.pool import ThreadPool
+
+import numpy
 from Crypto import Random
 from . import config
+from . import tilesystem
 from .tilesystem import tile_size
 
 
 file_size_limit = 2000000000
 
+# threads copying tile data into the archive
+copy_threads = 8
+
+# cost (in header bytes) of a range on top of its own bytes when ranges are packed, clients scan the ranges of a
+# zoom level linearly to find a tile, the higher the penalty the more empty tiles a merged range may have
+range_penalty = 64
+
+# tile file extensions, in order of preference if a tile exists with more than one
+extensions = ('.png.tile', '.jpg.tile', '.webp.tile', '.png', '.jpg', '.webp')
+_extension_index = dict((ext, i) for i, ext in enumerate(extensions))
+
+# order of the tile data: 'range' stores tiles in file info order (range by range, x major),
+# 'morton' and 'hilbert' store each zoom level along the curve so tiles next to each other on the chart
+# are next to each other on disk (ranges are ordered along the curve too)
+tile_orders = ('range', 'morton', 'hilbert')
+
+gemf_version = 4
+u32_size = 4
+u64_size = 8
+range_size = (u32_size * 6) + (u64_size * 1)  # xmin, xmax, ymin, ymax, zoom, source, offset
+file_info_size = u64_size + u32_size  # offset, length
+
+_range_struct = struct.Struct('>IIIIIIQ')  # zoom, xmin, xmax, ymin, ymax, source, offset
+_file_info_struct = struct.Struct('>QI')  # offset, length
+_file_info_dtype = numpy.dtype([('offset', '>u8'), ('size', '>u4')])
+
+
+def tile_keys(z, x, y):
+    """returns numpy array of sortable (zoom, x, y) keys of tile coordinates"""
+    return (numpy.asarray(z, dtype=numpy.uint64) << numpy.uint64(56)) | \
+           (numpy.asarray(x, dtype=numpy.uint64) << numpy.uint64(28)) | numpy.asarray(y, dtype=numpy.uint64)
+
+
+def tile_coordinates(keys):
+    """returns numpy arrays (z, x, y) of tile keys"""
+    keys = numpy.asarray(keys, dtype=numpy.uint64)
+    mask = numpy.uint64((1 << 28) - 1)
+    return keys >> numpy.uint64(56), (keys >> numpy.uint64(28)) & mask, keys & mask
+
+
+def _spread_bits(v):
+    """spreads the low 32 bits of v to the even bits of a uint64"""
+    v = v & numpy.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << numpy.uint64(shift))) & numpy.uint64(mask)
+    return v
+
+
+def _hilbert_index(z, x, y):
+    """returns the distance of each tile along the hilbert curve of its zoom level (2^z x 2^z tiles)"""
+    n = numpy.left_shift(1, z)
+    d = numpy.zeros(len(z), dtype=numpy.int64)
+    for b in range(int(z.max()) - 1 if len(z) > 0 else -1, -1, -1):
+        s = 1 << b
+        active = z > b
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += numpy.where(active, s * s * ((3 * rx) ^ ry), 0)
+        flip = active & ~ry & rx
+        x = numpy.where(flip, n - 1 - x, x)
+        y = numpy.where(flip, n - 1 - y, y)
+        swap = active & ~ry
+        x, y = numpy.where(swap, y, x), numpy.where(swap, x, y)
+    return d
+
+
+def curve_keys(z, x, y, order):
+    """returns numpy array of keys that sort tiles by zoom and then along the curve of a tile order
+       order - 'morton' or 'hilbert'
+    """
+    z = numpy.asarray(z, dtype=numpy.int64)
+    if order == 'morton':
+        d = _spread_bits(numpy.asarray(x, dtype=numpy.uint64)) | \
+            (_spread_bits(numpy.asarray(y, dtype=numpy.uint64)) << numpy.uint64(1))
+    elif order == 'hilbert':
+        d = _hilbert_index(z, numpy.asarray(x, dtype=numpy.int64), numpy.asarray(y, dtype=numpy.int64))
+    else:
+        raise Exception('%s is not a curve tile order' % order)
+    return (z.astype(numpy.uint64) << numpy.uint64(56)) | d.astype(numpy.uint64)
 
-def _valto_n_bytes(value, n):
-    result = []
-    for _ in range(n):
-        result.append(value & 0xFF)
-        value >>= 8
-    result.reverse()
-    return result
 
+def data_order(z, x, y, source_indexes, order):
+    """returns the indexes of tiles (given in archive order) in the order their data is stored
+       order - one of tile_orders
+    """
+    if order not in tile_orders:
+        raise Exception('%s is not one of %s' % (order, tile_orders))
+    if order == 'range':
+        return numpy.arange(len(z))
+    return numpy.lexsort((curve_keys(z, x, y, order), source_indexes))
+
+
+def archive_parts(path):
+    """returns the list of files of a (s)gemf archive (path, path-1, path-2 ...)"""
+    parts = []
+    part_path = path
+    while os.path.isfile(part_path):
+        parts.append(part_path)
+        part_path = '%s-%d' % (path, len(parts))
+    return parts
+
+
+def archive_size(path):
+    """returns the size in bytes of a (s)gemf archive including its parts"""
+    return sum([os.path.getsize(part) for part in archive_parts(path)])
+
+
+def remove_archive(path):
+    """removes a (s)gemf archive and every one of its -1, -2 ... parts (also parts left after a missing part)"""
+    part_pattern = re.compile(re.escape(os.path.basename(path)) + r'(-\d+)?$')
+    directory = os.path.dirname(path) or os.curdir
+    for each in os.listdir(directory):
+        if part_pattern.match(each):
+            os.remove(os.path.join(directory, each))
+
+
+def _tile_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+class TileSet(abc.ABC):
+    def __init__(self, zs, xs, ys, sizes):
+        """tiles of a gemf source
+           zs, xs, ys, sizes - sequences of tile zoom, x, y and size (in any order)
+           z, x, y, size - numpy arrays of every tile sorted by zoom, x and y
+           order - the sort order (indexes into zs, xs, ys and sizes)
+           digest - numpy array of the sha1 digest of every tile or None (needed to dedup)
+           zooms - sorted list of zoom levels
+        """
+        keys = tile_keys(zs, xs, ys)
+        self.order = numpy.argsort(keys)
+        self._keys_sorted = keys[self.order]
+        self.z = numpy.asarray(zs, dtype=numpy.uint32)[self.order]
+        self.x = numpy.asarray(xs, dtype=numpy.uint32)[self.order]
+        self.y = numpy.asarray(ys, dtype=numpy.uint32)[self.order]
+        self.size = numpy.asarray(sizes, dtype=numpy.uint64)[self.order]
+        self.zooms = numpy.unique(self.z).tolist()
+        self.digest = None
+
+    def __len__(self):
+        return len(self.y)
+
+    def lookup(self, z, x, y):
+        """returns the array indexes of zxy tiles (numpy arrays), -1 for tiles that do not exist"""
+        keys = tile_keys(numpy.full(len(x), z), x, y)
+        if len(self) == 0:
+            return numpy.full(len(keys), -1, dtype=numpy.int64)
+        index = numpy.minimum(numpy.searchsorted(self._keys_sorted, keys), len(self) - 1).astype(numpy.int64)
+        index[self._keys_sorted[index] != keys] = -1
+        return index
+
+    @abc.abstractmethod
+    def write_tiles(self, fds, part, position):
+        """writes tile i to file descriptor fds[part[i]] at position[i] for every tile with part[i] >= 0
+           (tiles may be written in any order), every kind of tile set reads its tiles from its own storage
+        """
+
+
+class TileScan(TileSet):
+    def __init__(self, tile_dir, hash_tiles=False):
+        """tiles of a zxy tile directory (scanned once)
+           ext - numpy array of the extension index (in extensions) of every tile
+           hash_tiles - set to true to compute the digest of every tile
+        """
+        self.tile_dir = tile_dir
+        zs = array('I')
+        xs = array('I')
+        ys = array('I')
+        sizes = array('Q')
+        exts = array('B')
+
+        for z_entry in os.scandir(tile_dir):
+            if not z_entry.name.isdigit():
+                continue
+            if not z_entry.is_dir():
+                print('Skipping ' + z_entry.path)
+                continue
+            z = int(z_entry.name)
 
-def _valto_4_bytes(value):
-    return _valto_n_bytes(value, 4)
+            for x_entry in os.scandir(z_entry.path):
+                if not x_entry.name.isdigit() or not x_entry.is_dir():
+                    print('Skipping ' + x_entry.path)
+                    continue
+                x = int(x_entry.name)
+
+                column = {}  # y: (extension index, dir entry)
+                for y_entry in os.scandir(x_entry.path):
+                    dot = y_entry.name.find('.')
+                    ext = _extension_index.get(y_entry.name[dot:])
+                    if dot <= 0 or ext is None or not y_entry.name[:dot].isdigit():
+                        continue
+                    y = int(y_entry.name[:dot])
+                    if y not in column or ext < column[y][0]:
+                        column[y] = (ext, y_entry)
+
+                for y in column:
+                    ext, y_entry = column[y]
+                    zs.append(z)
+                    xs.append(x)
+                    ys.append(y)
+                    sizes.append(y_entry.stat().st_size)
+                    exts.append(ext)
+
+        TileSet.__init__(self, zs, xs, ys, sizes)
+        self.ext = numpy.asarray(exts, dtype=numpy.uint8)[self.order]
+
+        if hash_tiles:
+            pool = ThreadPool(copy_threads)
+            try:
+                self.digest = numpy.array(pool.map(_tile_digest, [self.path(i) for i in range(len(self))], 64),
+                                          dtype='S20').reshape(-1)
+            finally:
+                pool.close()
+                pool.join()
+
+    def path(self, i):
+        return os.path.join(self.tile_dir, '%d/%d/%d%s' % (self.z[i], self.x[i], self.y[i], extensions[self.ext[i]]))
+
+    def write_tiles(self, fds, part, position):
+        tasks = [(self.path(i), fds[part[i]], int(position[i]), int(self.size[i]))
+                 for i in numpy.flatnonzero(part >= 0)]
+        pool = ThreadPool(copy_threads)
+        try:
+            for _ in pool.imap_unordered(_copy_tile, tasks, chunksize=64):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+
+class ArchiveTileSet(TileSet):
+    def __init__(self, readers, zs, xs, ys, sizes, reader_indexes, offsets):
+        """tiles read from gemf archives as a gemf source
+           readers - list of GemfReader
+           reader_indexes, offsets - the reader and archive offset of each tile's data (tiles of size 0 are empty)
+        """
+        TileSet.__init__(self, zs, xs, ys, sizes)
+        self.readers = readers
+        self.reader_index = numpy.asarray(reader_indexes, dtype=numpy.int64)[self.order]
+        self.offset = numpy.asarray(offsets, dtype=numpy.uint64)[self.order]
+
+    def write_tiles(self, fds, part, position):
+        for i in numpy.flatnonzero(part >= 0).tolist():
+            data = self.readers[self.reader_index[i]].read(int(self.offset[i]), int(self.size[i]))
+            write_at(fds[part[i]], data, int(position[i]))
+
+
+def archive_sources(reader, hash_tiles=False):
+    """returns list of (source name, ArchiveTileSet) of every source of a GemfReader (the reader must stay open
+       until the tile sets are written)
+       hash_tiles - set to true to compute the digest of every tile
+    """
+    sources = []
+    for source_index, name in enumerate(reader.sources):
+        z, x, y, offsets, sizes = reader.tile_index(source_index)
+        tiles = sizes > 0
+        tile_set = ArchiveTileSet([reader], z[tiles], x[tiles], y[tiles], sizes[tiles],
+                                  numpy.zeros(numpy.count_nonzero(tiles)), offsets[tiles])
+        if hash_tiles:
+            digests = [hashlib.sha1(reader.read(offset, size)).digest()
+                       for offset, size in zip(tile_set.offset.tolist(), tile_set.size.tolist())]
+            tile_set.digest = numpy.array(digests, dtype='S20').reshape(-1)
+        sources.append((name, tile_set))
+    return sources
+
+
+def _ranges(scan, allow_empty=False):
+    """returns a dictionary of zoom: list of (xmin, xmax, ymin, ymax) tile ranges sorted by zoom, xmin and ymin
+
+       the tiles of each column (zoom, x) are run length encoded into segments of consecutive y,
+       then segments with the same ymin and ymax in adjacent columns are merged into one range
+       with allow_empty there is one range (bounding box) per zoom level
+    """
+    ranges = dict((z, []) for z in scan.zooms)
+    if len(scan) == 0:
+        return ranges
 
+    z = scan.z.astype(numpy.int64)
+    x = scan.x.astype(numpy.int64)
+    y = scan.y.astype(numpy.int64)
 
-def _valto_8_bytes(value):
-    return _valto_n_bytes(value, 8)
+    if allow_empty:
+        first = numpy.flatnonzero(numpy.r_[True, z[1:] != z[:-1]])
+        for zoom, xs, ys in zip(z[first], numpy.split(x, first[1:]), numpy.split(y, first[1:])):
+            ranges[int(zoom)].append((int(xs.min()), int(xs.max()), int(ys.min()), int(ys.max())))
+        return ranges
 
+    # a tile starts a segment unless the tile before it is (zoom, x, y - 1)
+    starts = numpy.ones(len(y), dtype=bool)
+    starts[1:] = (z[1:] != z[:-1]) | (x[1:] != x[:-1]) | (y[1:] != y[:-1] + 1)
+    first = numpy.flatnonzero(starts)
+    last = numpy.append(first[1:] - 1, len(y) - 1)
+    z, x, ymin, ymax = z[first], x[first], y[first], y[last]
 
-def generate_gemf(name, add_uid=False):
-    """generates a (s)gemf archive for tiles in mapdir
-       name - name of the (s)gemf archive to be created in the config.compiled_dir directory
-       add_uid - set to true if the tiles are encrypted and have a 16 byte initial vector
-    """
+    # a segment starts a range unless the segment before it is (zoom, x - 1, ymin, ymax)
+    order = numpy.lexsort((x, ymax, ymin, z))
+    z, x, ymin, ymax = z[order], x[order], ymin[order], ymax[order]
+    starts = numpy.ones(len(x), dtype=bool)
+    starts[1:] = (z[1:] != z[:-1]) | (ymin[1:] != ymin[:-1]) | (ymax[1:] != ymax[:-1]) | (x[1:] != x[:-1] + 1)
+    first = numpy.flatnonzero(starts)
+    last = numpy.append(first[1:] - 1, len(x) - 1)
+    z, xmin, xmax, ymin, ymax = z[first], x[first], x[last], ymin[first], ymax[first]
 
-    if not os.path.isdir(os.path.join(config.merged_tile_dir, name)):
-        raise Exception(name + ' not a directory')
+    for i in numpy.lexsort((ymin, xmin, z)):
+        ranges[int(z[i])].append((int(xmin[i]), int(xmax[i]), int(ymin[i]), int(ymax[i])))
 
-    options = {}
-    if add_uid:
-        options['add-uid'] = True
+    return ranges
 
-    if add_uid:
-        ext = '.sgemf'
-    else:
-        ext = '.gemf'
 
-    base_name = name[:name.rfind('.')].upper()  # remove .enc or .opt
-    output_file = os.path.join(config.compiled_dir, base_name + ext)
-    tilesize = tile_size
+def _ranges_bytes(ranges):
+    """returns the header bytes (ranges and file infos) of a list of (xmin, xmax, ymin, ymax) ranges"""
+    tiles = sum([(xmax - xmin + 1) * (ymax - ymin + 1) for xmin, xmax, ymin, ymax in ranges])
+    return len(ranges) * range_size + tiles * file_info_size
 
-    extensions = ('.png.tile', '.jpg.tile', '.png', '.jpg')
 
-    all_sources = {}
-    source_order = []
-    source_index = 0
-    source_indices = {}
-    count = {}
+def _ranges_cost(ranges):
+    return _ranges_bytes(ranges) + len(ranges) * range_penalty
 
-    mapdir = config.merged_tile_dir
 
-    source_list = [name]
+def _pack_ranges(ranges):
+    """returns the (xmin, xmax, ymin, ymax) ranges of a zoom level packed to a lower _ranges_cost
 
-    for source in source_list:
-        results = {}
-        source_mapdir = os.path.join(mapdir, source)
-        if not os.path.isdir(source_mapdir):
-            print('Skipping ' + source_mapdir)
+       ranges are greedily merged (cheapest merge first) into their bounding range when the empty tiles of the
+       bounding range cost less than the ranges it replaces, a bounding range absorbs every range it overlaps,
+       the single bounding range of the zoom level is used if it is cheaper still
+       ranges - exact (non overlapping) ranges
+    """
+    if len(ranges) < 2:
+        return list(ranges)
+
+    r = numpy.array(ranges, dtype=numpy.int64).reshape(-1, 4)
+    area = (r[:, 1] - r[:, 0] + 1) * (r[:, 3] - r[:, 2] + 1)
+    alive = numpy.ones(len(r), dtype=bool)
+    version = numpy.zeros(len(r), dtype=numpy.int64)
+    cost = range_size + range_penalty
+
+    def merges(i):
+        # (cost change, i, j) of merging range i with every other live range into their bounding range
+        bounds = numpy.minimum(r[i, 0], r[:, 0]), numpy.maximum(r[i, 1], r[:, 1]), \
+            numpy.minimum(r[i, 2], r[:, 2]), numpy.maximum(r[i, 3], r[:, 3])
+        union = (bounds[1] - bounds[0] + 1) * (bounds[3] - bounds[2] + 1)
+        delta = (union - area[i] - area) * file_info_size - cost
+        candidates = numpy.flatnonzero(alive & (delta < 0))
+        return [(int(delta[j]), i, int(j), int(version[i]), int(version[j])) for j in candidates if j != i]
+
+    heap = []
+    for i in range(len(r)):
+        heap += [m for m in merges(i) if m[1] < m[2]]
+    heapq.heapify(heap)
+
+    while heap:
+        delta, i, j, version_i, version_j = heapq.heappop(heap)
+        if not alive[i] or not alive[j] or version[i] != version_i or version[j] != version_j:
             continue
 
-        source_indices[source] = source_index
-
-        # Generate results[zoom][x] = [y1,y2,...]
-        for zoom_level_str in os.listdir(source_mapdir):
-            zoom_level = int(zoom_level_str)
-            results[zoom_level] = {}
+        # the bounding range absorbs every range it overlaps (and grows) until no other range overlaps it
+        members = numpy.array([i, j])
+        while True:
+            xmin, xmax = r[members, 0].min(), r[members, 1].max()
+            ymin, ymax = r[members, 2].min(), r[members, 3].max()
+            overlapping = numpy.flatnonzero(alive & (r[:, 0] <= xmax) & (r[:, 1] >= xmin) &
+                                            (r[:, 2] <= ymax) & (r[:, 3] >= ymin))
+            if len(overlapping) == len(members):
+                break
+            members = overlapping
+
+        bounding_area = (xmax - xmin + 1) * (ymax - ymin + 1)
+        if (bounding_area - area[members].sum()) * file_info_size - cost * (len(members) - 1) >= 0:
+            continue
 
-            zoom_dir = os.path.join(source_mapdir, zoom_level_str)
-            if not os.path.isdir(zoom_dir):
-                print('Skipping ' + zoom_dir)
+        alive[members] = False
+        alive[i] = True
+        r[i] = xmin, xmax, ymin, ymax
+        area[i] = bounding_area
+        version[i] += 1
+        for m in merges(i):
+            heapq.heappush(heap, m)
+
+    packed = [tuple(int(v) for v in r[i]) for i in numpy.flatnonzero(alive)]
+    bounding = [(min([p[0] for p in packed]), max([p[1] for p in packed]),
+                 min([p[2] for p in packed]), max([p[3] for p in packed]))]
+    if _ranges_cost(bounding) < _ranges_cost(packed):
+        return bounding
+    return sorted(packed, key=lambda p: (p[0], p[2]))
+
+
+def _part_positions(sizes, first_part_size):
+    """returns (part index, position in the part) numpy arrays of each tile when the tiles are written in order
+       and a new part is started when a tile would make a part larger than file_size_limit
+       sizes - numpy array of the tile sizes
+       first_part_size - bytes in the first part before the first tile (not counting the uid)
+    """
+    part = numpy.zeros(len(sizes), dtype=numpy.int64)
+    position = numpy.zeros(len(sizes), dtype=numpy.int64)
+    ends = numpy.cumsum(sizes, dtype=numpy.int64)  # end of each tile if there was only one part
+    start = 0
+    index = 0
+    part_size = first_part_size
+    while start < len(sizes):
+        before = ends[start] - int(sizes[start])
+        stop = int(numpy.searchsorted(ends, before + file_size_limit - part_size, side='right'))
+        if stop == start:
+            if part_size > 0:  # the next tile does not fit, start a new part
+                index += 1
+                part_size = 0
                 continue
+            stop = start + 1  # a tile larger than file_size_limit has a part of its own
+        part[start:stop] = index
+        position[start:stop] = part_size + ends[start:stop] - sizes[start:stop].astype(numpy.int64) - before
+        start = stop
+        index += 1
+        part_size = 0
+    return part, position
+
+
+def write_at(fd, data, position):
+    """writes all of data to file descriptor fd at position"""
+    data = memoryview(data)
+    while len(data) > 0:
+        n = os.pwrite(fd, data, position)
+        data = data[n:]
+        position += n
+
+
+def _copy_tile(task):
+    """copies a tile file into an archive part
+       task - (tile path, part file descriptor, position in the part, tile size)
+
+       os.copy_file_range (Python 3.8+ on Linux) copies in the kernel, the tile is read and written with
+       pread / pwrite where it is not available or fails (e.g. EXDEV across file systems on older kernels)
+    """
+    path, fd, position, size = task
+    copied = 0
+    with open(path, 'rb') as f:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(f.fileno(), fd, size - copied, copied, position + copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        if copied < size:
+            data = os.pread(f.fileno(), size - copied, copied)
+            write_at(fd, data, position + copied)
+            copied += len(data)
+    if copied != size:
+        raise Exception('%s changed size while writing the archive' % path)
+
+
+def write_gemf(output_file, sources, add_uid=False, dedup=False, allow_empty=False, tile_order='range',
+               pack_ranges=False, zooms=None):
+    """writes a (s)gemf archive
+       output_file - path of the archive (parts after the first are output_file-1, output_file-2 ...)
+       sources - list of (source name, TileSet)
+       add_uid - set to true if the tiles are encrypted and have a 16 byte initial vector
+       dedup - set to true to store tiles with identical content once (their file infos share an offset),
+               the tile sets need digests
+       allow_empty - set to true for one range per zoom level, tiles missing from a range are empty
+       tile_order - order of the ranges and the tile data, one of tile_orders
+       pack_ranges - set to true to merge ranges into ranges with empty tiles where it lowers the header bytes
+                     plus range_penalty per range (see _pack_ranges)
+       zooms - (min zoom, max zoom) of the tiles written (default every zoom level)
+       returns output_file
+    """
+    if tile_order not in tile_orders:
+        raise Exception('%s is not one of %s' % (tile_order, tile_orders))
 
-            for x_str in os.listdir(zoom_dir):
-                x_set = []
-                x_val = int(x_str)
-
-                x_dir = os.path.join(zoom_dir, x_str)
-                if not os.path.isdir(x_dir):
-                    print('Skipping ' + x_dir)
-                    continue
+    if dedup and len([tiles for source, tiles in sources if tiles.digest is None]) > 0:
+        raise Exception('dedup needs the digest of every tile')
 
-                for y_str in os.listdir(x_dir):
-                    y_val = int(y_str.split('.')[0])
-                    x_set.append(y_val)
-
-                results[zoom_level][x_val] = x_set[:]
-
-        if 'allow-empty' in options:
-            full_sets = {}
-            for zoom_level in list(results.keys()):
-                full_sets[zoom_level] = []
-                xmax = max(results[zoom_level].keys())
-                xmin = min(results[zoom_level].keys())
-                y_vals = []
-                for x_val in list(results[zoom_level].keys()):
-                    y_vals += results[zoom_level][x_val]
-                ymax = max(y_vals)
-                ymin = min(y_vals)
-                full_sets[zoom_level].append({'xmin': xmin, 'xmax': xmax,
-                                              'ymin': ymin, 'ymax': ymax,
-                                              'source_index': source_index})
-
-        else:
-            # A record representing a square of 1-5 tiles at zoom 10
-            # unique_sets[zoom][Y values key] = [X values array]
-            # unique_sets[10]['1-2-3-4-5'] = [1,2,3,4,5]
-            unique_sets = {}
-            for zoom_level in list(results.keys()):
-                unique_sets[zoom_level] = {}
-                for x_val in list(results[zoom_level].keys()):
-
-                    # strkey: Sorted list of Y values for a zoom/X, eg: '1-2-3-4'
-                    strkey = '-'.join(['%d' % i for i in sorted(results[zoom_level][x_val])])
-                    if strkey in list(unique_sets[zoom_level].keys()):
-                        unique_sets[zoom_level][strkey].append(x_val)
-                    else:
-                        unique_sets[zoom_level][strkey] = [x_val, ]
-
-            # Find missing X rows in each unique_set record
-            split_xsets = {}
-            for zoom_level in list(results.keys()):
-                split_xsets[zoom_level] = []
-                for xset in list(unique_sets[zoom_level].values()):
-                    setxmin = min(xset)
-                    setxmax = max(xset)
-                    last_valid = None
-                    for xv in range(setxmin, setxmax+2):
-                        if xv not in xset and last_valid is not None:
-                            split_xsets[zoom_level].append({'xmin': last_valid, 'xmax': xv-1})
-                            last_valid = None
-                        elif xv in xset and last_valid is None:
-                            last_valid = xv
-
-            # Find missing Y rows in each unique_set chunk, create full_sets records for each complete chunk
-
-            full_sets = {}
-            for zoom_level in list(split_xsets.keys()):
-                full_sets[zoom_level] = []
-                for xr in split_xsets[zoom_level]:
-                    yset = results[zoom_level][xr['xmax']]
-                    setymin = min(yset)
-                    setymax = max(yset)
-                    last_valid = None
-                    for yv in range(setymin, setymax+2):
-                        if yv not in yset and last_valid is not None:
-                            full_sets[zoom_level].append({'xmin': xr['xmin'], 'xmax': xr['xmax'],
-                                                          'ymin': last_valid, 'ymax': yv-1,
-                                                          'source_index': source_index})
-                            last_valid = None
-                        elif yv in yset and last_valid is None:
-                            last_valid = yv
-
-        count[source] = {}
-        for zoom_level in list(full_sets.keys()):
-            count[source][zoom_level] = 0
-            for rangeset in full_sets[zoom_level]:
-                for xv in range(rangeset['xmin'], rangeset['xmax']+1):
-                    for yv in range(rangeset['ymin'], rangeset['ymax']+1):
-                        found = False
-                        for extension in extensions:
-                            fpath = os.path.join(source_mapdir, '%d/%d/%d%s' % (zoom_level, xv, yv, extension))
-                            if os.path.exists(fpath):
-                                found = True
-                                break
-                        if not found and 'allow-empty' not in options:
-                            raise IOError('Could not find file (%s, %d, %d, %d)' % (source, zoom_level, xv, yv))
-
-                        count[source][zoom_level] += 1
-            print(source_mapdir, zoom_level, count[source][zoom_level])
-
-        all_sources[source] = full_sets
-        source_order.append(source)
-        source_index += 1
-
-    u32_size = 4
-    u64_size = 8
-    range_size = (u32_size * 6) + (u64_size * 1)  # xmin, xmax, ymin, ymax, zoom, source, offset
-    file_info_size = u64_size + u32_size
-    number_of_ranges = 0
+    # (TileSet, array indexes of the range's tiles (-1 for an empty tile)) of every range in archive order
+    range_tiles = []
+    range_list = []  # (zoom, xmin, xmax, ymin, ymax, source index, index of the range's first tile)
+    file_coordinates = []  # (z, x, y, source index) numpy arrays of every range's tiles
     number_of_files = 0
-    for source in source_order:
-        full_sets = all_sources[source]
-        number_of_ranges += sum([len(full_sets[i]) for i in list(full_sets.keys())])
-        number_of_files += sum(count[source].values())
-    source_count = 0
-
-    source_list = []
-    for source in source_order:
-        source_list += _valto_4_bytes(source_indices[source])
-        source_list += _valto_4_bytes(len(source))
-        source_list += [i for i in source.encode('ascii', 'ignore')]
-        source_count += 1
-
-    source_list_size = len(source_list)
-
-    gemf_version = 4
+    exact_ranges = []
+    for source_index, (source, tiles) in enumerate(sources):
+        for zoom_level, zoom_ranges in _ranges(tiles, allow_empty).items():
+            if zooms is not None and not zooms[0] <= zoom_level <= zooms[1]:
+                continue
+            if pack_ranges:
+                exact_ranges += zoom_ranges
+                zoom_ranges = _pack_ranges(zoom_ranges)
+            if tile_order != 'range' and len(zoom_ranges) > 0:
+                centers = numpy.array(zoom_ranges, dtype=numpy.int64).reshape(-1, 4)
+                keys = curve_keys(numpy.full(len(centers), zoom_level), (centers[:, 0] + centers[:, 1]) // 2,
+                                  (centers[:, 2] + centers[:, 3]) // 2, tile_order)
+                zoom_ranges = [zoom_ranges[i] for i in numpy.argsort(keys, kind='stable')]
+            count = 0
+            for xmin, xmax, ymin, ymax in zoom_ranges:
+                nx = xmax - xmin + 1
+                ny = ymax - ymin + 1
+                xs = numpy.repeat(numpy.arange(xmin, xmax + 1, dtype=numpy.uint32), ny)
+                ys = numpy.tile(numpy.arange(ymin, ymax + 1, dtype=numpy.uint32), nx)
+                index = tiles.lookup(zoom_level, xs, ys)
+                if not allow_empty and not pack_ranges and (index < 0).any():
+                    i = int(numpy.flatnonzero(index < 0)[0])
+                    raise IOError('Could not find file (%s, %d, %d, %d)' % (source, zoom_level, xs[i], ys[i]))
+                range_list.append((zoom_level, xmin, xmax, ymin, ymax, source_index, number_of_files))
+                range_tiles.append((tiles, index))
+                file_coordinates.append((numpy.full(len(index), zoom_level, dtype=numpy.uint32), xs, ys,
+                                         numpy.full(len(index), source_index, dtype=numpy.uint32)))
+                number_of_files += len(index)
+                count += len(index)
+            print(source, zoom_level, count)
+
+    if pack_ranges:
+        packed_ranges = [r[1:5] for r in range_list]
+        print('range packing: %d -> %d ranges, %d -> %d header bytes (%d -> %d with range penalty %d)' %
+              (len(exact_ranges), len(packed_ranges), _ranges_bytes(exact_ranges), _ranges_bytes(packed_ranges),
+               _ranges_cost(exact_ranges), _ranges_cost(packed_ranges), range_penalty))
+
+    source_names = b''
+    for source_index, (source, tiles) in enumerate(sources):
+        encoded = source.encode('ascii', 'ignore')
+        source_names += struct.pack('>II', source_index, len(encoded)) + encoded
+
+    source_count = len(sources)
+    source_list_size = len(source_names)
+    number_of_ranges = len(range_list)
 
     uid_size = 0
-    if 'add-uid' in options:
+    if add_uid:
         uid_size = 16
 
     pre_info_size = (uid_size +  # Random 16 byte uid
@@ -229,121 +572,389 @@ def generate_gemf(name, add_uid=False):
                      number_of_ranges * range_size)  # Ranges
     header_size = (pre_info_size + (number_of_files * file_info_size))  # File header info
 
-    image_offset = header_size
-
     print('Source Count:', source_count)
     print('Source List Size:', source_list_size)
-    print('Source List:', repr(source_list))
+    print('Source List:', repr(source_names))
     print('Pre Info Size:', pre_info_size)
     print('Number of Ranges:', number_of_ranges)
     print('Number of files:', number_of_files)
     print('Header Size (first image location): 0x%08X' % header_size)
 
-    header = []
-
-    header += _valto_4_bytes(gemf_version)
-    header += _valto_4_bytes(tilesize)
-    header += _valto_4_bytes(source_count)
-    header += source_list
-
-    header += _valto_4_bytes(number_of_ranges)
-
-    data_locations = []
-    data_location_address = 0
-
-    file_list = []
-
-    first_range = True
-    first_tile = True
-
-    tile_count = 0
-    for tile_source in source_order:
-        full_source_set = all_sources[tile_source]
-
-        for zoom_level in list(full_source_set.keys()):
-            for rangeset in full_source_set[zoom_level]:
-                if first_range:
-                    h = len(header)
-                    print('First range at 0x%08X' % len(header))
-                header += _valto_4_bytes(zoom_level)
-                header += _valto_4_bytes(rangeset['xmin'])
-                header += _valto_4_bytes(rangeset['xmax'])
-                header += _valto_4_bytes(rangeset['ymin'])
-                header += _valto_4_bytes(rangeset['ymax'])
-                header += _valto_4_bytes(rangeset['source_index'])
-                header += _valto_8_bytes(data_location_address + pre_info_size)
-
-                if first_range:
-                    hb = header[h:]
-                    print('Range Data: [' + ','.join(['%02X' % i for i in hb]) + ']')
-                    print('First Data Location: 0x%08X' % (data_location_address + pre_info_size))
-                    first_range = False
-
-                for xv in range(rangeset['xmin'], rangeset['xmax']+1):
-                    for yv in range(rangeset['ymin'], rangeset['ymax']+1):
-                        found = False
-                        for extension in extensions:
-                            fpath = os.path.join(mapdir, '%s/%d/%d/%d%s' % (tile_source, zoom_level, xv, yv, extension))
-                            if os.path.exists(fpath):
-                                found = True
-                                break
-
-                        if not found:
-                            if 'allow-empty' in options:
-                                file_size = 0
-                            else:
-                                raise IOError('Could not find file (%s, %d, %d, %d)'
-                                              % (tile_source, zoom_level, xv, yv))
-                        else:
-                            file_size = os.path.getsize(fpath)
-                        file_list.append(fpath)
-
-                        # This file is at image_offset, length file_size
-                        data_locations += _valto_8_bytes(image_offset)
-                        data_locations += _valto_4_bytes(file_size)
-                        tile_count += 1
-
-                        if first_tile:
-                            print('First Tile Info: [' + ','.join(['%02X' % i for i in data_locations]) + ']')
-                            print('(0x%016X, 0x%08X)' % (image_offset, file_size))
-                            first_tile = False
-
-                        data_location_address += u64_size + u32_size
-
-                        # Update the image_offset
-                        image_offset += file_size
-
-    print('Header Length is 0x%08X' % len(header))
-    print('First tile expected at 0x%08X' % (len(header) + len(data_locations)))
-    print('Tile Count is %d (c.f. %d)' % (tile_count, number_of_files))
+    # ---- header (without the uid) packed into one buffer
+    header = bytearray(header_size - uid_size)
+    struct.pack_into('>III', header, 0, gemf_version, tile_size, source_count)
+    offset = 3 * u32_size
+    header[offset:offset + source_list_size] = source_names
+    offset += source_list_size
+    struct.pack_into('>I', header, offset, number_of_ranges)
+    offset += u32_size
+
+    if number_of_ranges > 0:
+        print('First range at 0x%08X' % offset)
+    for zoom_level, xmin, xmax, ymin, ymax, source_index, first_tile in range_list:
+        _range_struct.pack_into(header, offset, zoom_level, xmin, xmax, ymin, ymax, source_index,
+                                first_tile * file_info_size + pre_info_size)
+        offset += range_size
+
+    # file info (offset and size of every tile) written straight into the header buffer
+    sizes = numpy.zeros(number_of_files, dtype=numpy.uint64)
+    for (tiles, index), range_info in zip(range_tiles, range_list):
+        first_tile = range_info[-1]
+        found = index >= 0
+        sizes[first_tile:first_tile + len(index)][found] = tiles.size[index[found]]
+
+    # first[t] is the tile whose data tile t points at, with dedup the first tile with the same content
+    first = numpy.arange(number_of_files)
+    if dedup and number_of_files > 0:
+        digests = numpy.zeros(number_of_files, dtype='S20')
+        for (tiles, index), range_info in zip(range_tiles, range_list):
+            first_tile = range_info[-1]
+            found = index >= 0
+            digests[first_tile:first_tile + len(index)][found] = tiles.digest[index[found]]
+        unique, unique_first, inverse = numpy.unique(digests, return_index=True, return_inverse=True)
+        first = unique_first[inverse.reshape(-1)]
+    stored = (first == numpy.arange(number_of_files)) & (sizes > 0)
+    stored_sizes = numpy.where(stored, sizes, numpy.uint64(0))
+
+    # tiles are stored in data order, the file infos stay in archive order
+    data = numpy.arange(number_of_files)
+    if tile_order != 'range' and number_of_files > 0:
+        data = data_order(*[numpy.concatenate(c) for c in zip(*file_coordinates)], order=tile_order)
+    data_sizes = stored_sizes[data]
+
+    file_info = numpy.frombuffer(header, dtype=_file_info_dtype, count=number_of_files, offset=offset)
+    file_info['size'] = sizes
+    data_offsets = numpy.full(number_of_files, header_size, dtype=numpy.uint64)
+    data_offsets[1:] += numpy.cumsum(data_sizes, dtype=numpy.uint64)[:-1]
+    offsets = numpy.zeros(number_of_files, dtype=numpy.uint64)
+    offsets[data] = data_offsets
+    file_info['offset'] = offsets[first]
+
+    if dedup:
+        print('dedup: %d of %d tiles stored, %d of %d tile bytes (ratio %.2f)' %
+              (numpy.count_nonzero(stored), numpy.count_nonzero(sizes), stored_sizes.sum(), sizes.sum(),
+               float(sizes.sum()) / max(1, stored_sizes.sum())))
+
+    print('Header Length is 0x%08X' % offset)
+    print('First tile expected at 0x%08X' % len(header))
     print('')
 
-    gemf_f = open(output_file, 'wb')
-    if 'add-uid' in options:
-        gemf_f.write(Random.get_random_bytes(16))
-    gemf_f.write(bytes(header))
-    gemf_f.write(bytes(data_locations))
+    # ---- tile data, each tile set writes its tiles at the positions computed from the tile sizes
+    part = numpy.zeros(number_of_files, dtype=numpy.int64)
+    position = numpy.zeros(number_of_files, dtype=numpy.int64)
+    part[data], position[data] = _part_positions(data_sizes, len(header))
+    position[part == 0] += uid_size
+    part_sizes = numpy.zeros(int(part.max()) + 1 if number_of_files > 0 else 1, dtype=numpy.int64)
+    part_sizes[0] = header_size
+    numpy.maximum.at(part_sizes, part, position + stored_sizes.astype(numpy.int64))
+
+    # part and position of each tile set's tiles (part -1 for tiles that are not stored)
+    placements = dict((id(tiles), (numpy.full(len(tiles), -1, dtype=numpy.int64),
+                                   numpy.zeros(len(tiles), dtype=numpy.int64))) for source, tiles in sources)
+    for (tiles, index), range_info in zip(range_tiles, range_list):
+        first_tile = range_info[-1]
+        write = stored[first_tile:first_tile + len(index)]
+        tile_part, tile_position = placements[id(tiles)]
+        tile_part[index[write]] = part[first_tile:first_tile + len(index)][write]
+        tile_position[index[write]] = position[first_tile:first_tile + len(index)][write]
+
+    # parts of an earlier archive at output_file are not overwritten when this archive has less parts
+    remove_archive(output_file)
+    part_files = [output_file] + [output_file + '-%d' % p for p in range(1, len(part_sizes))]
+    fds = []
+    try:
+        for part_file, part_size in zip(part_files, part_sizes):
+            fds.append(os.open(part_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666))
+            os.ftruncate(fds[-1], int(part_size))
+
+        if add_uid:
+            write_at(fds[0], Random.get_random_bytes(16), 0)
+        write_at(fds[0], header, uid_size)
+
+        for source, tiles in sources:
+            tile_part, tile_position = placements[id(tiles)]
+            tiles.write_tiles(fds, tile_part, tile_position)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+    return output_file
+
+
+def generate_gemf(name, add_uid=False, dedup=False, tile_order='range', source_list=None, pack_ranges=False,
+                  zoom_bands=None):
+    """generates a (s)gemf archive for tiles in mapdir
+       name - name of the (s)gemf archive to be created in the config.compiled_dir directory
+       add_uid - set to true if the tiles are encrypted and have a 16 byte initial vector
+       dedup - set to true to store tiles with identical content once (their file infos share an offset)
+       tile_order - order of the ranges and the tile data, one of tile_orders
+       source_list - sources written into the archive in one pass (default [name]), each the name of a merged
+                     tile directory or the path of a .gemf (.sgemf with add_uid) or .mbtiles archive
+       pack_ranges - set to true to merge ranges into ranges with empty tiles where it lowers the header cost
+       zoom_bands - list of (min zoom, max zoom or None) to write an archive per zoom band instead (from one scan),
+                    named <NAME>.z<min>-<max>.(s)gemf after the zoom levels the band has
+       returns the path of the archive (the list of band archive paths with zoom_bands)
+    """
 
-    file_size = len(header) + len(data_locations)
-    index = 0
-    for fn in file_list:
-        if os.path.exists(fn):
-            this_file_size = os.path.getsize(fn)
-        else:
-            if 'allow-empty' in options:
-                this_file_size = 0
-            else:
-                raise IOError('Could not find file %s' % fn)
-        if (file_size + this_file_size) > file_size_limit:
-            gemf_f.close()
-            index += 1
-            gemf_f = open(output_file + '-%d' % index, 'wb')
-            file_size = 0
-
-        if os.path.exists(fn):
-            tile_f = open(fn, 'rb')
-            gemf_f.write(tile_f.read())
-            tile_f.close()
-        file_size += this_file_size
-
-    gemf_f.close()
+    if not os.path.isdir(os.path.join(config.merged_tile_dir, name)):
+        raise Exception(name + ' not a directory')
+
+    if add_uid:
+        ext = '.sgemf'
+    else:
+        ext = '.gemf'
+
+    base_name = name[:name.rfind('.')].upper()  # remove .enc or .opt
+    output_file = os.path.join(config.compiled_dir, base_name + ext)
+
+    mapdir = config.merged_tile_dir
+
+    if source_list is None:
+        source_list = [name]
+
+    sources = []
+    readers = []
+    try:
+        for source in source_list:
+            if source.endswith('gemf'):
+                if not source.endswith(ext):
+                    raise Exception('%s can not be a source of a %s archive' % (source, ext))
+                readers.append(GemfReader(source))
+                sources += archive_sources(readers[-1], hash_tiles=dedup)
+                continue
+
+            if source.endswith('.mbtiles'):
+                if add_uid:
+                    raise Exception('%s can not be a source of a %s archive' % (source, ext))
+                from . import gemf_mbtiles  # gemf_mbtiles imports gemf
+                source_name = os.path.basename(source)
+                sources.append((source_name[:source_name.rfind('.')],
+                                gemf_mbtiles.MBTilesSet(source, hash_tiles=dedup)))
+                continue
+
+            source_mapdir = os.path.join(mapdir, source)
+            if not os.path.isdir(source_mapdir):
+                print('Skipping ' + source_mapdir)
+                continue
+
+            sources.append((source, TileScan(source_mapdir, hash_tiles=dedup)))
+
+        # the archive (or zoom band archives) of an earlier run would be published next to the new archives
+        stale_pattern = re.compile(re.escape(base_name) + r'(\.z\d+-\d+)?' + re.escape(ext) + r'(-\d+)?$')
+        for each in os.listdir(config.compiled_dir):
+            if stale_pattern.match(each):
+                os.remove(os.path.join(config.compiled_dir, each))
+
+        if zoom_bands is None:
+            return write_gemf(output_file, sources, add_uid=add_uid, dedup=dedup, tile_order=tile_order,
+                              pack_ranges=pack_ranges)
+
+        zooms = sorted(set([z for source, tiles in sources for z in tiles.zooms]))
+        band_files = []
+        for zmin, zmax in zoom_bands:
+            band = [z for z in zooms if zmin <= z and (zmax is None or z <= zmax)]
+            if len(band) == 0:
+                print('Skipping zoom band', zmin, zmax)
+                continue
+            band_file = '%s.z%d-%d%s' % (output_file[:-len(ext)], band[0], band[-1], ext)
+            band_files.append(write_gemf(band_file, sources, add_uid=add_uid, dedup=dedup, tile_order=tile_order,
+                                         pack_ranges=pack_ranges, zooms=(band[0], band[-1])))
+        return band_files
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+class GemfReader:
+    def __init__(self, path):
+        """reads tiles from a (s)gemf archive and its -1, -2 ... parts (memory mapped)
+           tiles of an sgemf archive are returned as they are stored (encrypted)
+           ranges - list of (zoom, xmin, xmax, ymin, ymax, source index, file info offset)
+        """
+        self.path = path
+        self._files = []
+        self._maps = []
+        self._part_starts = []  # offset of each part in the archive
+        start = 0
+        for part_path in archive_parts(path):
+            f = open(part_path, 'rb')
+            self._files.append(f)
+            size = os.fstat(f.fileno()).st_size
+            self._maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b'')
+            self._part_starts.append(start)
+            start += size
+
+        if len(self._maps) == 0:
+            raise Exception(path + ' does not exist')
+
+        header = self._maps[0]
+        offset = 0
+        self.uid = None
+        if path.endswith('.sgemf'):
+            self.uid = bytes(header[:16])
+            offset = 16
+
+        version, self.tile_size, source_count = struct.unpack_from('>III', header, offset)
+        if version != gemf_version:
+            raise Exception('%s is gemf version %d, not %d' % (path, version, gemf_version))
+        offset += 3 * u32_size
+
+        self.sources = []
+        for i in range(source_count):
+            source_index, length = struct.unpack_from('>II', header, offset)
+            offset += 2 * u32_size
+            self.sources.append(bytes(header[offset:offset + length]).decode('ascii'))
+            offset += length
+
+        number_of_ranges, = struct.unpack_from('>I', header, offset)
+        offset += u32_size
+        self.ranges = [_range_struct.unpack_from(header, offset + i * range_size) for i in range(number_of_ranges)]
+        self._check_parts(start)
+        self._index = self._build_index()
+
+    def _check_parts(self, archive_size):
+        """raises if the file info tables or the tile data reach past the end of the archive (missing parts)"""
+        data_end = 0
+        for zoom, xmin, xmax, ymin, ymax, source, offset in self.ranges:
+            count = max(0, (xmax - xmin + 1) * (ymax - ymin + 1))
+            if offset + count * file_info_size > len(self._maps[0]):
+                raise Exception('%s file info table of zoom %d ends past the end of the file' % (self.path, zoom))
+            infos = numpy.frombuffer(self._maps[0], dtype=_file_info_dtype, count=count, offset=offset)
+            if count > 0:
+                data_end = max(data_end, int((infos['offset'].astype(numpy.uint64) + infos['size']).max()))
+        if data_end > archive_size:
+            raise Exception('%s tile data ends at 0x%X past the end of its %d parts (0x%X bytes), missing parts?' %
+                            (self.path, data_end, len(self._maps), archive_size))
+
+    def _build_index(self):
+        """returns a dictionary of (source index, zoom): (x slab boundaries, slabs)
+           the ranges of a zoom split the x axis into slabs where the same ranges cover every column,
+           each slab is (sorted ymin list, range list) of the ranges covering the slab
+           the slabs are built in one sweep over the columns where ranges start (xmin) and end (xmax + 1)
+        """
+        index = {}
+        zooms = {}
+        for r in self.ranges:
+            zooms.setdefault((r[5], r[0]), []).append(r)
+
+        for key, ranges in zooms.items():
+            events = {}  # x: (ranges starting at x, ranges ending before x)
+            for r in ranges:
+                if r[1] > r[2]:  # empty range
+                    continue
+                events.setdefault(r[1], ([], []))[0].append(r)
+                events.setdefault(r[2] + 1, ([], []))[1].append(r)
+            breaks = sorted(events)
+            slabs = []
+            ymins = []
+            covering = []  # ranges covering the current slab sorted by ymin
+            for x in breaks:
+                starting, ending = events[x]
+                for r in ending:
+                    i = bisect.bisect_left(ymins, r[3])
+                    while covering[i] is not r:
+                        i += 1
+                    del ymins[i], covering[i]
+                for r in starting:
+                    i = bisect.bisect_right(ymins, r[3])
+                    ymins.insert(i, r[3])
+                    covering.insert(i, r)
+                slabs.append((list(ymins), list(covering)))
+            index[key] = (breaks, slabs[:-1])
+        return index
+
+    @property
+    def zooms(self):
+        return sorted(set([r[0] for r in self.ranges]))
+
+    def file_info(self, z, x, y, source_index=0):
+        """returns the (archive offset, size) of a tile or None if the archive (source) does not have the tile"""
+        if (source_index, z) not in self._index:
+            return None
+
+        breaks, slabs = self._index[(source_index, z)]
+        slab = bisect.bisect_right(breaks, x) - 1
+        if slab < 0 or slab >= len(slabs):
+            return None
+
+        ymins, ranges = slabs[slab]
+        i = bisect.bisect_right(ymins, y) - 1
+        if i < 0 or y > ranges[i][4]:
+            return None
+
+        zoom, xmin, xmax, ymin, ymax, source_index, offset = ranges[i]
+        offset += ((x - xmin) * (ymax - ymin + 1) + (y - ymin)) * file_info_size
+        return _file_info_struct.unpack_from(self._maps[0], offset)
+
+    def read(self, offset, size):
+        """returns size bytes at an archive offset (see file_info)"""
+        part = bisect.bisect_right(self._part_starts, offset) - 1
+        start = offset - self._part_starts[part]
+        data = self._maps[part][start:start + size]
+        if len(data) != size:
+            raise Exception('%s read of %d bytes at 0x%X returned %d bytes' % (self.path, size, offset, len(data)))
+        return data
+
+    def get_tile(self, z, x, y, source_index=0):
+        """returns the bytes of a tile or None if the archive (source) does not have the tile"""
+        info = self.file_info(z, x, y, source_index)
+        if info is None or info[1] == 0:
+            return None
+        return self.read(*info)
+
+    def _source_ranges(self, source_index):
+        return [r for r in self.ranges if source_index is None or r[5] == source_index]
+
+    def tiles(self, source_index=None):
+        """yields (z, x, y, tile bytes) of every tile of a source (default every source) in archive order"""
+        for zoom, xmin, xmax, ymin, ymax, source, offset in self._source_ranges(source_index):
+            ny = ymax - ymin + 1
+            infos = numpy.frombuffer(self._maps[0], dtype=_file_info_dtype, count=(xmax - xmin + 1) * ny,
+                                     offset=offset).tolist()
+            for i, (tile_offset, size) in enumerate(infos):
+                if size > 0:
+                    yield zoom, xmin + i // ny, ymin + i % ny, self.read(tile_offset, size)
+
+    def tile_index(self, source_index=None):
+        """returns numpy arrays (z, x, y, offset, size) of every tile of a source (default every source)
+           in archive order (size is 0 for an empty tile)
+        """
+        zs, xs, ys, infos = [], [], [], []
+        ranges = self._source_ranges(source_index)
+        for zoom, xmin, xmax, ymin, ymax, source, offset in ranges:
+            nx = xmax - xmin + 1
+            ny = ymax - ymin + 1
+            zs.append(numpy.full(nx * ny, zoom, dtype=numpy.uint32))
+            xs.append(numpy.repeat(numpy.arange(xmin, xmax + 1, dtype=numpy.uint32), ny))
+            ys.append(numpy.tile(numpy.arange(ymin, ymax + 1, dtype=numpy.uint32), nx))
+            infos.append(numpy.frombuffer(self._maps[0], dtype=_file_info_dtype, count=nx * ny, offset=offset).copy())
+        if len(ranges) == 0:
+            empty = numpy.zeros(0, dtype=numpy.uint32)
+            return empty, empty, empty, numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.uint64)
+        infos = numpy.concatenate(infos)
+        return (numpy.concatenate(zs), numpy.concatenate(xs), numpy.concatenate(ys),
+                infos['offset'].astype(numpy.uint64), infos['size'].astype(numpy.uint64))
+
+    def metadata(self):
+        """returns a dictionary of bounds ('west,south,east,north' of the lowest zoom level), minzoom and maxzoom"""
+        zooms = self.zooms
+        ranges = [r for r in self.ranges if r[0] == zooms[0]]
+        bounds = tilesystem.tile_bounds_to_lat_lng_bounds(min([r[1] for r in ranges]), max([r[2] for r in ranges]),
+                                                          min([r[3] for r in ranges]), max([r[4] for r in ranges]),
+                                                          zooms[0])
+        return {'bounds': '%f,%f,%f,%f' % bounds, 'minzoom': zooms[0], 'maxzoom': zooms[-1]}
+
+    def close(self):
+        for m in self._maps:
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files:
+            f.close()
+        self._maps = []
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
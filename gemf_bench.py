@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Benchmarks the gemf tile orders (gemf.tile_orders) with simulated chart viewing sessions
+
+   A gemf archive is written for every tile order from the same (merged) zxy tile directory, then the same
+   simulated sessions are replayed against every archive. A session starts on a random tile and pans or zooms
+   a viewport of tiles around, the tiles that come into view are read out of the archive (row by row, like a
+   client without the tile in its cache would).
+
+   Reported per tile order: tile reads, seeks (reads that do not start within read_ahead bytes after the end
+   of the previous read), mean seek distance, read time and the seek reduction compared to the 'range' order.
+
+   usage: python gemf_bench.py <tile directory> <optional number of sessions> <optional output json path>
+'''
+
+import inspect
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+from mxmcc import gemf
+
+session_count = 200
+session_steps = 50
+
+# tiles wide, tiles high
+viewport = (4, 3)
+
+# chance that a session step pans (otherwise it zooms in or out)
+pan_probability = .8
+
+# bytes a read may skip forward and still be sequential (device / os read ahead)
+read_ahead = 128 * 1024
+
+
+def _viewport_tiles(z, cx, cy):
+    w, h = viewport
+    n = 1 << z
+    return [(z, x, y) for y in range(cy - h // 2, cy - h // 2 + h) for x in range(cx - w // 2, cx - w // 2 + w)
+            if 0 <= x < n and 0 <= y < n]
+
+
+def simulate_sessions(tiles, count=session_count, steps=session_steps, seed=0):
+    """returns a list of sessions, each a list of the (z, x, y) tiles read in order
+       tiles - gemf.TileSet the sessions start on and zoom within
+    """
+    rnd = random.Random(seed)
+    zooms = set(tiles.zooms)
+    sessions = []
+    for _ in range(count):
+        i = rnd.randrange(len(tiles))
+        z, cx, cy = int(tiles.z[i]), int(tiles.x[i]), int(tiles.y[i])
+        cached = set()
+        reads = []
+        for _ in range(steps):
+            for tile in _viewport_tiles(z, cx, cy):
+                if tile not in cached:
+                    cached.add(tile)
+                    reads.append(tile)
+
+            if rnd.random() < pan_probability:
+                dx, dy = rnd.choice([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy])
+                cx += dx
+                cy += dy
+            elif z + 1 in zooms and (rnd.random() < .5 or z - 1 not in zooms):
+                z, cx, cy = z + 1, cx * 2, cy * 2
+            elif z - 1 in zooms:
+                z, cx, cy = z - 1, cx // 2, cy // 2
+        sessions.append(reads)
+    return sessions
+
+
+def replay(reader, sessions):
+    """reads the tiles of every session out of an archive
+       returns a dictionary of reads, seeks, mean seek distance (bytes) and read time (milliseconds)
+    """
+    reads = 0
+    seeks = 0
+    seek_bytes = 0
+    t = time.time()
+    for session in sessions:
+        end = None
+        for z, x, y in session:
+            info = reader.file_info(z, x, y)
+            if info is None or info[1] == 0:
+                continue
+            offset, size = info
+            reader.read(offset, size)
+            reads += 1
+            if end is not None and not end <= offset <= end + read_ahead:
+                seeks += 1
+                seek_bytes += abs(offset - end)
+            end = offset + size
+    return {'reads': reads,
+            'seeks': seeks,
+            'mean_seek_bytes': int(seek_bytes / max(1, seeks)),
+            'read_ms': round(1000. * (time.time() - t), 1)}
+
+
+def run(tile_dir, count=session_count, out_path=None):
+    """benchmarks the tile orders on the tiles of tile_dir, prints a table and optionally writes json to out_path
+       returns the report dictionary
+    """
+    tiles = gemf.TileScan(tile_dir)
+    if len(tiles) == 0:
+        raise Exception('no tiles in %s' % tile_dir)
+
+    sessions = simulate_sessions(tiles, count)
+    report = {'tile_dir': os.path.abspath(tile_dir),
+              'tiles': len(tiles),
+              'sessions': len(sessions),
+              'session_steps': session_steps,
+              'viewport': list(viewport),
+              'read_ahead': read_ahead,
+              'orders': {}}
+
+    tmp_dir = tempfile.mkdtemp(prefix='mxmcc_gemf_bench_')
+    try:
+        for order in gemf.tile_orders:
+            path = gemf.write_gemf(os.path.join(tmp_dir, order + '.gemf'), [(os.path.basename(tile_dir), tiles)],
+                                   tile_order=order)
+            with gemf.GemfReader(path) as reader:
+                report['orders'][order] = replay(reader, sessions)
+            for part in gemf.archive_parts(path):
+                os.remove(part)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    baseline = report['orders']['range']['seeks']
+    for entry in report['orders'].values():
+        entry['seek_reduction'] = round(1. - float(entry['seeks']) / baseline, 3) if baseline > 0 else 0.
+
+    print('%-8s %8s %8s %14s %9s %10s' % ('order', 'reads', 'seeks', 'mean seek KiB', 'read ms', 'reduction'))
+    for order in gemf.tile_orders:
+        entry = report['orders'][order]
+        print('%-8s %8d %8d %14.1f %9.1f %9.1f%%' % (order, entry['reads'], entry['seeks'],
+                                                      entry['mean_seek_bytes'] / 1024., entry['read_ms'],
+                                                      100. * entry['seek_reduction']))
+
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    return report
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage:\n$python gemf_bench.py <tile directory> <optional number of sessions> '
+              '<optional output json path>')
+    else:
+        run(sys.argv[1],
+            int(sys.argv[2]) if len(sys.argv) >= 3 else session_count,
+            sys.argv[3] if len(sys.argv) >= 4 else None)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Validates finished .gemf and .sgemf archives before they are published
+
+   structure: the header parses, the file info tables follow the ranges back to back, ranges are inside of
+   their zoom level's tile grid and the ranges of a source do not overlap, tile data is inside of the archive
+   (and does not span two split files), stored tiles do not overlap and their offsets increase in one of the
+   gemf.tile_orders (tiles of a deduplicated archive may point back to an earlier tile of the same size)
+   decode: every (or a sampled fraction of every) stored tile is decoded by the worker processes and must be a
+   tile_size x tile_size image, tiles of an .sgemf archive are encrypted and only their lengths are checked
+
+   usage: python gemf_fsck.py <archive path> <optional fraction of tiles to decode (default 1.0)>
+                              <optional random seed of the sampled tiles (default 0)>
+   exits with status 1 if there are problems
+'''
+
+import bisect
+import heapq
+import inspect
+import io
+import os
+import sys
+import time
+
+import numpy
+from PIL import Image
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+from mxmcc import executor
+from mxmcc import gemf
+
+# number of tiles a worker process decodes per task
+decode_chunk_size = 2000
+
+# number of problems printed in the report
+max_report = 50
+
+
+class _TileDecoder:
+    def __init__(self, path, tile_size):
+        """parallel_map state that decodes tiles of an archive (opened once per worker process)"""
+        self.path = path
+        self.tile_size = tile_size
+        self._reader = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'tile_size': self.tile_size, '_reader': None}
+
+    def __call__(self, chunk):
+        """returns the list of (index, problem) of tiles in chunk (index, offset, size) that do not decode"""
+        if self._reader is None:
+            self._reader = gemf.GemfReader(self.path)
+        problems = []
+        for i, offset, size in chunk:
+            try:
+                img = Image.open(io.BytesIO(self._reader.read(offset, size)))
+                img.load()
+                if img.size != (self.tile_size, self.tile_size):
+                    problems.append((i, 'is %dx%d, not %dx%d' % (img.size + (self.tile_size, self.tile_size))))
+            except Exception as e:
+                problems.append((i, 'does not decode (%s)' % e))
+        return problems
+
+
+def _header_end(reader):
+    """returns the archive offset of the first file info table (right after the ranges)"""
+    offset = 0 if reader.uid is None else 16
+    offset += 3 * gemf.u32_size
+    offset += sum([2 * gemf.u32_size + len(source.encode('ascii')) for source in reader.sources])
+    return offset + gemf.u32_size + len(reader.ranges) * gemf.range_size
+
+
+def _check_ranges(reader, part_sizes):
+    """returns the list of problems of the ranges and their file info tables"""
+    problems = []
+    info_offset = _header_end(reader)
+    for i, (zoom, xmin, xmax, ymin, ymax, source_index, offset) in enumerate(reader.ranges):
+        name = 'range %d (z%d x%d-%d y%d-%d)' % (i, zoom, xmin, xmax, ymin, ymax)
+        if xmin > xmax or ymin > ymax:
+            problems.append('%s is empty' % name)
+            continue
+        if xmax >= 1 << zoom or ymax >= 1 << zoom:
+            problems.append('%s is outside of the zoom %d tile grid' % (name, zoom))
+        if source_index >= len(reader.sources):
+            problems.append('%s has source index %d of %d sources' % (name, source_index, len(reader.sources)))
+        if offset != info_offset:
+            problems.append('%s file info table at 0x%X, expected 0x%X' % (name, offset, info_offset))
+        info_offset = offset + (xmax - xmin + 1) * (ymax - ymin + 1) * gemf.file_info_size
+        if info_offset > part_sizes[0]:
+            problems.append('%s file info table ends at 0x%X past the end of %s' % (name, info_offset, reader.path))
+    if problems:
+        return problems
+
+    by_zoom = {}
+    for i, (zoom, xmin, xmax, ymin, ymax, source_index, offset) in enumerate(reader.ranges):
+        by_zoom.setdefault((source_index, zoom), []).append((xmin, xmax, ymin, ymax, i))
+    for source_index, zoom in sorted(by_zoom):
+        for a, b in _overlapping_ranges(by_zoom[(source_index, zoom)]):
+            problems.append('range %d overlaps range %d at zoom %d of source %d' % (a, b, zoom, source_index))
+    return problems
+
+
+def _overlapping_ranges(ranges):
+    """returns the list of (earlier index, index) of ranges (xmin, xmax, ymin, ymax, index) that overlap
+       sweeps the ranges in xmin order keeping the active ranges (the ones reaching the current column) in ymin
+       order, a range overlapping an active range is kept in a separate (short) list so that the active ranges
+       stay disjoint and are found with a binary search
+    """
+    overlaps = []
+    active = []  # (ymin, ymax, index) of the active disjoint ranges sorted by ymin
+    ends = []  # heap of (xmax, ymin, index) of the active disjoint ranges
+    overlapping = []  # (xmax, ymin, ymax, index) of the active ranges that overlap another range
+    for xmin, xmax, ymin, ymax, i in sorted(ranges):
+        while ends and ends[0][0] < xmin:
+            end, y, j = heapq.heappop(ends)
+            del active[bisect.bisect_left(active, (y, -1, -1))]
+        overlapping = [r for r in overlapping if r[0] >= xmin]
+
+        # the active ranges are disjoint, the ones starting at or before ymax that end at or after ymin overlap
+        found = [j for end, y0, y1, j in overlapping if y0 <= ymax and ymin <= y1]
+        k = bisect.bisect_right(active, (ymax, sys.maxsize, sys.maxsize))
+        while k > 0 and active[k - 1][1] >= ymin:
+            k -= 1
+            found.append(active[k][2])
+        overlaps.extend([(min(i, j), max(i, j)) for j in found])
+        if found:
+            overlapping.append((xmax, ymin, ymax, i))
+        else:
+            bisect.insort(active, (ymin, ymax, i))
+            heapq.heappush(ends, (xmax, ymin, i))
+    return overlaps
+
+
+def _check_tiles(reader, part_sizes):
+    """returns (problems, tile index, indexes of the distinct stored tiles, tile order)
+       tile index - numpy arrays (z, x, y, offset, size) of every tile in archive order
+       tile order - the gemf.tile_orders order the tile data is stored in (or closest to)
+    """
+    problems = []
+    z, x, y, offsets, sizes = index = reader.tile_index()
+
+    def tile(i):
+        return 'tile %d/%d/%d' % (z[i], x[i], y[i])
+
+    stored = numpy.flatnonzero(sizes > 0)
+    offsets = offsets[stored].astype(numpy.int64)
+    sizes = sizes[stored].astype(numpy.int64)
+    ends = offsets + sizes
+
+    part_starts = numpy.cumsum([0] + part_sizes[:-1])
+    part = numpy.searchsorted(part_starts, offsets, side='right') - 1
+    part_ends = part_starts[part] + numpy.array(part_sizes)[part]
+    first_tile = _header_end(reader) + len(z) * gemf.file_info_size
+    for i in numpy.flatnonzero(offsets < first_tile).tolist():
+        problems.append('%s at 0x%X is inside of the header (ends at 0x%X)' % (tile(stored[i]), offsets[i], first_tile))
+    for i in numpy.flatnonzero(ends > part_ends).tolist():
+        problems.append('%s at 0x%X size %d ends past the end of %s' %
+                        (tile(stored[i]), offsets[i], sizes[i], gemf.archive_parts(reader.path)[part[i]]))
+
+    # offsets of distinct tiles, tiles pointing to the same offset must have the same size
+    unique_offsets, first, inverse = numpy.unique(offsets, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for i in numpy.flatnonzero(sizes != sizes[first][inverse]).tolist():
+        j = first[inverse[i]]
+        problems.append('%s at 0x%X size %d shares its offset with %s size %d' %
+                        (tile(stored[i]), offsets[i], sizes[i], tile(stored[j]), sizes[j]))
+
+    # distinct tiles are stored one after the other in one of the tile orders
+    counts = [(r[2] - r[1] + 1) * (r[4] - r[3] + 1) for r in reader.ranges]
+    sources = numpy.repeat(numpy.array([r[5] for r in reader.ranges], dtype=numpy.int64), counts)
+    decreasing = None
+    for order in gemf.tile_orders:
+        rank = numpy.zeros(len(z), dtype=numpy.int64)
+        rank[gemf.data_order(z, x, y, sources, order)] = numpy.arange(len(z))
+        order_decreasing = numpy.flatnonzero(numpy.diff(rank[stored[first]]) < 0)
+        if decreasing is None or len(order_decreasing) < len(decreasing):
+            tile_order, decreasing = order, order_decreasing
+        if len(decreasing) == 0:
+            break
+    for i in decreasing.tolist():
+        a, b = first[i], first[i + 1]
+        problems.append('%s at 0x%X is stored after %s at 0x%X (offsets are not increasing in %s order)' %
+                        (tile(stored[b]), offsets[b], tile(stored[a]), offsets[a], tile_order))
+    for i in numpy.flatnonzero(unique_offsets[1:] < ends[first][:-1]).tolist():
+        a, b = first[i], first[i + 1]
+        problems.append('%s at 0x%X size %d overlaps %s at 0x%X' %
+                        (tile(stored[a]), offsets[a], sizes[a], tile(stored[b]), offsets[b]))
+
+    return problems, index, stored[first], tile_order
+
+
+def _decode_tiles(reader, index, distinct, sample, seed=0):
+    """returns (problems, number of decoded tiles) of decoding a sampled fraction of the distinct stored tiles
+       seed - random seed of the sample (the same archive, sample and seed decode the same tiles)
+    """
+    z, x, y, offsets, sizes = index
+    if sample < 1.:
+        count = min(len(distinct), int(numpy.ceil(len(distinct) * sample)))
+        distinct = numpy.sort(numpy.random.RandomState(seed).choice(distinct, count, replace=False))
+
+    tasks = list(zip(distinct.tolist(), offsets[distinct].tolist(), sizes[distinct].tolist()))
+    chunks = [tasks[i:i + decode_chunk_size] for i in range(0, len(tasks), decode_chunk_size)]
+    decoder = _TileDecoder(reader.path, reader.tile_size)
+    problems = []
+    for chunk_problems in executor.parallel_map(executor.call, chunks, state=decoder):
+        for i, problem in chunk_problems:
+            problems.append('tile %d/%d/%d at 0x%X %s' % (z[i], x[i], y[i], offsets[i], problem))
+    return problems, len(tasks)
+
+
+def fsck(path, sample=1., seed=0):
+    """validates a (s)gemf archive and prints a report
+       sample - fraction of the stored tiles decoded (tiles of an sgemf archive are not decoded)
+       seed - random seed of the sampled tiles
+       returns the list of problems (empty if the archive is valid)
+    """
+    t = time.time()
+    part_sizes = [os.path.getsize(part) for part in gemf.archive_parts(path)]
+    try:
+        reader = gemf.GemfReader(path)
+    except Exception as e:
+        problems = ['header: %s' % e]
+        reader = None
+
+    decoded = 0
+    if reader is not None:
+        with reader:
+            problems = _check_ranges(reader, part_sizes)
+            if not problems:
+                problems, index, distinct, tile_order = _check_tiles(reader, part_sizes)
+                print(path, '%d parts, %d ranges, %d tiles, %d stored in %s order' %
+                      (len(part_sizes), len(reader.ranges), len(index[0]), len(distinct), tile_order))
+                if not problems and reader.uid is None and sample > 0:
+                    problems, decoded = _decode_tiles(reader, index, distinct, sample, seed)
+
+    for problem in problems[:max_report]:
+        print(path, problem)
+    if len(problems) > max_report:
+        print(path, '... %d more problems' % (len(problems) - max_report))
+    print(path, 'FAILED' if problems else 'OK', '(%d tiles decoded in %.1f seconds)' % (decoded, time.time() - t))
+    return problems
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage:\n$python gemf_fsck.py <archive path> <optional fraction of tiles to decode (default 1.0)> '
+              '<optional random seed of the sampled tiles (default 0)>')
+        sys.exit(2)
+    sys.exit(1 if fsck(sys.argv[1], float(sys.argv[2]) if len(sys.argv) >= 3 else 1.,
+                       int(sys.argv[3]) if len(sys.argv) >= 4 else 0) else 0)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Converts mbtiles archives to gemf archives and back without a zxy tile directory
+
+   mbtiles to gemf: the tile sizes are queried first to build the gemf header, then the tile data is
+   streamed in zoom/column/row order and each tile is written at its final position in the archive.
+   gemf to mbtiles: the tiles are streamed from the memory mapped archive and inserted in batched transactions.
+
+   usage: python gemf_mbtiles.py <input .mbtiles or .gemf> <output .gemf or .mbtiles>
+'''
+
+import hashlib
+import inspect
+import os
+import pathlib
+import sqlite3
+import sys
+from array import array
+
+import numpy
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+from mxmcc import gemf
+
+# number of tiles inserted per mbtiles transaction
+batch_size = 1000
+
+
+def tile_format(data):
+    """returns the format ('png', 'jpg' or 'webp') of tile bytes or None"""
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:2] == b'\xff\xd8':
+        return 'jpg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _flip(z, y):
+    """zxy y to tms row or vise versa"""
+    return (1 << z) - 1 - y
+
+
+def read_only_uri(path):
+    """returns the sqlite read only uri of a database file (characters like ? # % in the path are escaped)"""
+    return pathlib.Path(path).resolve().as_uri() + '?mode=ro'
+
+
+def _connect_read_only(path):
+    if not os.path.isfile(path):
+        raise Exception(path + ' does not exist')
+    return sqlite3.connect(read_only_uri(path), uri=True)
+
+
+class MBTilesSet(gemf.TileSet):
+    def __init__(self, path, hash_tiles=False):
+        """tiles of an mbtiles archive as a gemf source (tms rows are flipped to zxy y)
+           hash_tiles - set to true to compute the digest of every tile (reads every tile)
+        """
+        self.path = path
+        zs = array('I')
+        xs = array('I')
+        ys = array('I')
+        sizes = array('Q')
+        digests = []
+
+        db = _connect_read_only(path)
+        try:
+            value = 'tile_data' if hash_tiles else 'length(tile_data)'
+            for z, x, row, data in db.execute('SELECT zoom_level, tile_column, tile_row, %s FROM tiles' % value):
+                zs.append(z)
+                xs.append(x)
+                ys.append(_flip(z, row))
+                if hash_tiles:
+                    sizes.append(len(data))
+                    digests.append(hashlib.sha1(data).digest())
+                else:
+                    sizes.append(data)
+        finally:
+            db.close()
+
+        gemf.TileSet.__init__(self, zs, xs, ys, sizes)
+        if hash_tiles:
+            self.digest = numpy.array(digests, dtype='S20').reshape(-1)[self.order]
+
+    def write_tiles(self, fds, part, position):
+        # rows come in zoom, column, tms row order, the index of each row's tile is known up front
+        tms_rows = _flip(self.z.astype(numpy.int64), self.y.astype(numpy.int64))
+        order = numpy.lexsort((tms_rows, self.x, self.z))
+        expected = zip(self.z[order].tolist(), self.x[order].tolist(), tms_rows[order].tolist(),
+                       part[order].tolist(), position[order].tolist())
+        db = _connect_read_only(self.path)
+        try:
+            query = 'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ' \
+                    'ORDER BY zoom_level, tile_column, tile_row'
+            count = 0
+            for (z, x, row, data), tile in zip(db.execute(query), expected):
+                tile_z, tile_x, tile_row, tile_part, tile_position = tile
+                if (z, x, row) != (tile_z, tile_x, tile_row):
+                    raise Exception('%s changed while writing the archive' % self.path)
+                if tile_part >= 0:
+                    gemf.write_at(fds[tile_part], data, tile_position)
+                count += 1
+            # zip stops at the shorter of the two, tiles added or removed at the end would go unnoticed
+            if count != len(self) or db.execute('SELECT count(*) FROM tiles').fetchone()[0] != len(self):
+                raise Exception('%s changed while writing the archive' % self.path)
+        finally:
+            db.close()
+
+
+def mbtiles_to_gemf(mbtiles_path, gemf_path, dedup=False):
+    """writes the tiles of an mbtiles archive to a gemf archive
+       dedup - set to true to store tiles with identical content once
+       returns gemf_path
+    """
+    if not gemf_path.endswith('.gemf'):
+        raise Exception('%s is not a .gemf path (tiles are not encrypted)' % gemf_path)
+
+    name = os.path.basename(mbtiles_path)
+    name = name[:name.rfind('.')]
+    tiles = MBTilesSet(mbtiles_path, hash_tiles=dedup)
+    return gemf.write_gemf(gemf_path, [(name, tiles)], dedup=dedup)
+
+
+def _insert(db, rows):
+    with db:
+        db.executemany('INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)', rows)
+
+
+def gemf_to_mbtiles(gemf_path, mbtiles_path, source_index=0):
+    """writes the tiles of a gemf archive (source) to an (existing one is replaced) mbtiles archive
+       returns mbtiles_path
+    """
+    if gemf_path.endswith('.sgemf'):
+        raise Exception('%s is encrypted and can not be converted' % gemf_path)
+
+    if os.path.isfile(mbtiles_path):
+        os.remove(mbtiles_path)
+
+    db = sqlite3.connect(mbtiles_path)
+    try:
+        db.execute('PRAGMA synchronous=OFF')
+        db.execute('PRAGMA locking_mode=EXCLUSIVE')
+        db.execute('CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+        db.execute('CREATE TABLE metadata (name text, value text)')
+
+        fmt = None
+        count = 0
+        with gemf.GemfReader(gemf_path) as reader:
+            rows = []
+            for z, x, y, data in reader.tiles(source_index):
+                if fmt is None:
+                    fmt = tile_format(data)
+                rows.append((z, x, _flip(z, y), data))
+                if len(rows) == batch_size:
+                    _insert(db, rows)
+                    count += len(rows)
+                    rows = []
+            _insert(db, rows)
+            count += len(rows)
+
+            name = os.path.basename(gemf_path)
+            metadata = reader.metadata()
+            metadata.update({'name': name[:name.rfind('.')], 'type': 'baselayer', 'version': '1',
+                             'description': name, 'format': fmt or 'png'})
+
+        with db:
+            db.executemany('INSERT INTO metadata (name, value) VALUES (?, ?)',
+                           [(key, str(value)) for key, value in sorted(metadata.items())])
+            db.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+            db.execute('CREATE UNIQUE INDEX name ON metadata (name)')
+        print(gemf_path, count, 'tiles written to', mbtiles_path)
+    finally:
+        db.close()
+
+    return mbtiles_path
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage:\n$python gemf_mbtiles.py <input .mbtiles or .gemf> <output .gemf or .mbtiles>')
+    elif sys.argv[1].endswith('.mbtiles'):
+        mbtiles_to_gemf(sys.argv[1], sys.argv[2])
+    else:
+        gemf_to_mbtiles(sys.argv[1], sys.argv[2])
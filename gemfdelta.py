@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Tile level delta (patch) archives between two editions of a region's gemf archive
+
+   A delta is a gemf archive of the tiles that were added or changed in the target edition and a
+   zero length (empty) tile for every tile that was removed. Tiles are compared by sha1 digest.
+   Applying a delta to the base archive gives an archive with the same tiles as the target.
+'''
+
+import hashlib
+
+import numpy
+
+from . import gemf
+
+
+def _archive_tiles(reader, hash_tiles=True):
+    """returns numpy arrays (keys, offsets, sizes, digests) of the (non empty) tiles of an archive sorted by key"""
+    if len(reader.sources) > 1:
+        raise Exception('deltas of multi source archives are not supported (%s)' % reader.path)
+    z, x, y, offsets, sizes = reader.tile_index()
+    tiles = sizes > 0
+    keys = gemf.tile_keys(z[tiles], x[tiles], y[tiles])
+    offsets = offsets[tiles]
+    sizes = sizes[tiles]
+
+    digests = None
+    if hash_tiles:
+        # tiles of a deduplicated archive share offsets, each stored tile is hashed once
+        unique_offsets, unique_first, inverse = numpy.unique(offsets, return_index=True, return_inverse=True)
+        unique_digests = [hashlib.sha1(reader.read(int(offsets[i]), int(sizes[i]))).digest()
+                          for i in unique_first.tolist()]
+        digests = numpy.array(unique_digests, dtype='S20').reshape(-1)[inverse.reshape(-1)]
+
+    order = numpy.argsort(keys)
+    return keys[order], offsets[order], sizes[order], None if digests is None else digests[order]
+
+
+def _source_name(reader):
+    return reader.sources[0] if len(reader.sources) > 0 else 'delta'
+
+
+def generate_delta(base_path, target_path, delta_path):
+    """writes a delta archive of the tiles added, changed or removed from base_path to target_path
+       returns a dictionary of the number of added, changed, removed tiles and the delta size in bytes
+    """
+    if base_path.endswith('.sgemf') or target_path.endswith('.sgemf'):
+        raise Exception('deltas of encrypted archives are not supported')
+
+    with gemf.GemfReader(base_path) as base, gemf.GemfReader(target_path) as target:
+        base_keys, base_offsets, base_sizes, base_digests = _archive_tiles(base)
+        keys, offsets, sizes, digests = _archive_tiles(target)
+
+        in_base = numpy.zeros(len(keys), dtype=bool)
+        changed = numpy.zeros(len(keys), dtype=bool)
+        if len(base_keys) > 0:
+            found = numpy.minimum(numpy.searchsorted(base_keys, keys), len(base_keys) - 1)
+            in_base = base_keys[found] == keys
+            changed = in_base & (base_digests[found] != digests)
+        added = ~in_base
+        removed = ~numpy.isin(base_keys, keys)
+
+        patch = added | changed
+        delta_keys = numpy.concatenate((keys[patch], base_keys[removed]))
+        empty = numpy.zeros(numpy.count_nonzero(removed), dtype=numpy.uint64)
+        delta_sizes = numpy.concatenate((sizes[patch], empty))
+        delta_offsets = numpy.concatenate((offsets[patch], empty))
+        z, x, y = gemf.tile_coordinates(delta_keys)
+        tiles = gemf.ArchiveTileSet([target], z, x, y, delta_sizes, numpy.zeros(len(delta_keys)), delta_offsets)
+        gemf.write_gemf(delta_path, [(_source_name(target), tiles)])
+
+    result = {'added': int(numpy.count_nonzero(added)),
+              'changed': int(numpy.count_nonzero(changed)),
+              'removed': int(numpy.count_nonzero(removed)),
+              'size_bytes': gemf.archive_size(delta_path)}
+    print('delta', base_path, '->', target_path, result)
+    return result
+
+
+def apply_delta(base_path, delta_path, output_path):
+    """writes the archive of base_path patched with the delta archive delta_path to output_path
+       returns output_path
+    """
+    with gemf.GemfReader(base_path) as base, gemf.GemfReader(delta_path) as delta:
+        base_keys, base_offsets, base_sizes, base_digests = _archive_tiles(base, hash_tiles=False)
+        z, x, y, delta_offsets, delta_sizes = delta.tile_index()
+        delta_keys = gemf.tile_keys(z, x, y)
+
+        # base tiles the delta does not replace or remove, and the delta tiles that are not removals
+        keep = ~numpy.isin(base_keys, delta_keys)
+        patch = delta_sizes > 0
+        keys = numpy.concatenate((base_keys[keep], delta_keys[patch]))
+        z, x, y = gemf.tile_coordinates(keys)
+        tiles = gemf.ArchiveTileSet([base, delta], z, x, y,
+                               numpy.concatenate((base_sizes[keep], delta_sizes[patch])),
+                               numpy.concatenate((numpy.zeros(numpy.count_nonzero(keep)),
+                                                  numpy.ones(numpy.count_nonzero(patch)))),
+                               numpy.concatenate((base_offsets[keep], delta_offsets[patch])))
+        return gemf.write_gemf(output_path, [(_source_name(base), tiles)])
@@ -9,17 +9,56 @@ __status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
 import json
 import hashlib
 import os
+import re
 from . import config
 import time
 from .zdata import get_zdat_epoch
+from . import gemf
+from . import gemfdelta
 
 BASE_URL = ''
 
+# number of deltas (newest first) kept in a region's manifest entry
+MAX_DELTAS = 5
+
+# zoom band archive names end with .z<min zoom>-<max zoom>.gemf (or .sgemf)
+_band_pattern = re.compile(r'\.z(\d+)-(\d+)\.s?gemf$')
+
+
+def _merge_deltas(old_entry, new_entry, epoch):
+    """carries the deltas of a region's (or zoom band's) previous manifest entry over to its new entry"""
+    deltas = list(new_entry.get('deltas', []))
+    epochs = set([delta['base_epoch'] for delta in deltas])
+    for delta in old_entry.get('deltas', []):
+        if delta['base_epoch'] not in epochs and delta['target_epoch'] <= epoch:
+            deltas.append(delta)
+            epochs.add(delta['base_epoch'])
+    deltas.sort(key=lambda delta: delta['target_epoch'], reverse=True)
+    if len(deltas) > 0:
+        new_entry['deltas'] = deltas[:MAX_DELTAS]
+
+
+def _matching_band(entry, band):
+    """returns the zoom band of a region manifest entry starting at the same zoom as band or None"""
+    for each in entry.get('bands', []):
+        if each['min_zoom'] == band['min_zoom']:
+            return each
+    return None
+
 
 def merge_manifest(json_path_old, json_path_new, json_path_result):
     json_old = json.load(open(json_path_old, 'r'))
     json_new = json.load(open(json_path_new, 'r'))
     for key in json_new['regions'].keys():
+        if key in json_old['regions']:
+            old_entry = json_old['regions'][key]
+            new_entry = json_new['regions'][key]
+            if 'gemf_url' in new_entry:
+                _merge_deltas(old_entry, new_entry, new_entry['epoch'])
+            for band in new_entry.get('bands', []):
+                old_band = _matching_band(old_entry, band)
+                if old_band is not None:
+                    _merge_deltas(old_band, band, new_entry['epoch'])
         json_old['regions'][key] = json_new['regions'][key]
 
     with open(json_path_result, 'w') as f:
@@ -41,36 +80,117 @@ def checksum(abs_path):
     return m.hexdigest()
 
 
-def generate(data=None, base_url=BASE_URL):
+def archive_checksum(abs_path):
+    """sha1 of a (s)gemf archive and its -1, -2 ... parts concatenated in order"""
+    m = hashlib.sha1()
+    for part in gemf.archive_parts(abs_path):
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                m.update(chunk)
+    return m.hexdigest()
+
+
+def _generate_delta(entry, epoch, abs_path_gemf, target_epoch, delta_name, base_url, base_dir):
+    """writes the delta from the previously published archive of a (zoom band) manifest entry to abs_path_gemf
+       epoch - epoch of the previously published archive
+       returns the manifest delta entry or None if there is no previous archive to compare to
+    """
+    base_path = os.path.join(base_dir, entry['gemf_url'].split('/')[-1])
+    if not abs_path_gemf.endswith('.gemf') or not base_path.endswith('.gemf') or not os.path.isfile(base_path):
+        print('no previous archive for delta', base_path)
+        return None
+
+    abs_path_delta = os.path.join(config.compiled_dir, delta_name)
+    result = gemfdelta.generate_delta(base_path, abs_path_gemf, abs_path_delta)
+    return {'base_epoch': epoch,
+            'target_epoch': target_epoch,
+            'delta_url': base_url + '/' + delta_name,
+            'delta_checksum': archive_checksum(abs_path_delta),
+            'size_bytes': result['size_bytes'],
+            'added': result['added'],
+            'changed': result['changed'],
+            'removed': result['removed']}
+
+
+def _publish_archive(file_name, ts, base_url):
+    """renames a compiled archive and its -1, -2 ... parts to their time stamped names
+       the checksum and size cover every part (clients download <gemf_url>-1 ... while size_bytes is not reached)
+       returns (manifest entry of the archive, path of the renamed archive)
+    """
+    abs_path_org = os.path.join(config.compiled_dir, file_name)
+    abs_path_gemf = os.path.join(config.compiled_dir, ts + '_' + file_name)
+    for part in gemf.archive_parts(abs_path_org):
+        os.rename(part, abs_path_gemf + part[len(abs_path_org):])
+    return {'gemf_url': base_url + '/' + ts + '_' + file_name,
+            'gemf_checksum': archive_checksum(abs_path_gemf),
+            'size_bytes': gemf.archive_size(abs_path_gemf)}, abs_path_gemf
+
+
+def generate(data=None, base_url=BASE_URL, base_dir=None):
+    """data - previous manifest, a delta from each region's previous archive (found in base_dir, default
+              config.compiled_dir) to its new archive is generated and linked in the new manifest entry
+       zoom band archives (<REGION>.z<min>-<max>.gemf) of a region are listed in the entry's 'bands'
+    """
+    if base_dir is None:
+        base_dir = config.compiled_dir
+
     if data is None:
         data = {'manifest_version': 1, 'regions': {}}
     elif data['manifest_version'] is not 1:
         raise Exception('Invalid data')
 
-    for ea in os.listdir(config.compiled_dir):
-        if ea.endswith('gemf'):
-            region_ts = ea[:ea.find('.')]
-            region = region_ts[region_ts.find('REGION'):]
-
-            abs_path_data_org = os.path.join(config.compiled_dir, region_ts + '.zdat')
-            abs_path_gemf_org = os.path.join(config.compiled_dir, ea)
-            epoch = int(get_zdat_epoch(abs_path_data_org))
-            ts = get_time_stamp(epoch, local=True)
+    # archives already renamed to TS_<time stamp>_<name> were published before (they are the delta bases)
+    archives = {}  # region_ts: list of (archive file name, (min zoom, max zoom) of a zoom band archive or None)
+    for ea in sorted(os.listdir(config.compiled_dir)):
+        if ea.endswith('gemf') and not ea.startswith('TS_'):
+            match = _band_pattern.search(ea)
+            band = None if match is None else (int(match.group(1)), int(match.group(2)))
+            archives.setdefault(ea[:ea.find('.')], []).append((ea, band))
+
+    for region_ts, region_archives in sorted(archives.items()):
+        region = region_ts[region_ts.find('REGION'):]
+
+        abs_path_data_org = os.path.join(config.compiled_dir, region_ts + '.zdat')
+        epoch = int(get_zdat_epoch(abs_path_data_org))
+        ts = get_time_stamp(epoch, local=True)
+
+        data_name = ts + '_' + region_ts + '.zdat'
+        abs_path_data = os.path.join(config.compiled_dir, data_name)
+        os.rename(abs_path_data_org, abs_path_data)
+        print(region)
+        entry = {'data_url': base_url + '/' + data_name,
+                 'data_checksum': checksum(abs_path_data),
+                 'epoch': epoch}
+
+        previous = data['regions'].get(region)
+        if previous is not None and previous['epoch'] >= epoch:
+            previous = None
+
+        bands = []
+        for ea, band in region_archives:
+            archive, abs_path_gemf = _publish_archive(ea, ts, base_url)
+            if band is None:
+                entry.update(archive)
+                archive = entry
+                base = previous if previous is not None and 'gemf_url' in previous else None
+                band_name = ''
+            else:
+                archive['min_zoom'], archive['max_zoom'] = band
+                bands.append(archive)
+                base = None if previous is None else _matching_band(previous, archive)
+                band_name = '.z%d-%d' % band
+
+            if base is not None:
+                delta_name = '%s_%s%s.since_%d.gemfdelta' % (ts, region, band_name, previous['epoch'])
+                delta = _generate_delta(base, previous['epoch'], abs_path_gemf, epoch, delta_name, base_url, base_dir)
+                if delta is not None:
+                    archive['deltas'] = [delta]
+                _merge_deltas(base, archive, epoch)
+
+        if len(bands) > 0:
+            entry['bands'] = sorted(bands, key=lambda b: b['min_zoom'])
+        data['regions'][region] = entry
 
-            gemf_name = ts + '_' + ea
-            data_name = ts + '_' + region_ts + '.zdat'
-            abs_path_gemf = os.path.join(config.compiled_dir, gemf_name)
-            abs_path_data = os.path.join(config.compiled_dir, data_name)
-
-            os.rename(abs_path_gemf_org, abs_path_gemf)
-            os.rename(abs_path_data_org, abs_path_data)
-            print(region)
-            data['regions'][region] = {'gemf_url': base_url + '/' + gemf_name,
-                                       'data_url': base_url + '/' + data_name,
-                                       'gemf_checksum': checksum(abs_path_gemf),
-                                       'data_checksum': checksum(abs_path_data),
-                                       'size_bytes': os.path.getsize(abs_path_gemf),
-                                       'epoch': epoch}
     abs_path_json = os.path.join(config.compiled_dir, 'manifest.json')
     if os.path.exists(abs_path_json):
         os.remove(abs_path_json)
@@ -111,7 +231,7 @@ def generate_chart_manifest(base_url=BASE_URL):
 
 def revert():
     for ea in os.listdir(os.path.join(config.compiled_dir)):
-        if 'TS_' in ea and ea.endswith('gemf') or ea.endswith('zdat'):
+        if 'TS_' in ea and (ea.endswith('gemf') or re.search(r'gemf-\d+$', ea)) or ea.endswith('zdat'):
             region_ts = ea[:ea.find('.')]
             region = region_ts[region_ts.find('REGION'):]
             ext = ea[ea.find('.'):]
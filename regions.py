@@ -16,6 +16,7 @@ from . import config
 from .noaaxml import NoaaXmlReader
 from . import lookups
 from . import wl_filter_list_generator
+from . import ukho_filter_list_generator
 from . import file_name_sanitizer
 from .region_constants import *
 from .search import MapPathSearch
@@ -209,6 +210,20 @@ def lookup_for_region(region):
         return lookups.BsbLookup()
 
 
+def boundary_for_region(region):
+    """returns the (latitude, longitude) boundary polygon for queried region
+       or None if the region is not limited by a boundary
+    """
+    provider = _db.provider_for_region(region)
+    region = region.upper()
+    if provider == provider_ukho:
+        return ukho_filter_list_generator.BOUNDARIES.get(region)
+    elif provider == provider_wavey_lines:
+        return wl_filter_list_generator.BOUNDARIES.get(region)
+
+    return None
+
+
 def provider_for_region(region):
     """returns the provider eg. noaa for queried region"""
     return _db.provider_for_region(region)
@@ -0,0 +1,236 @@
+import errno
+import os
+import random
+import shutil
+import struct
+import tempfile
+from unittest import TestCase, mock
+
+import pytest
+
+# gemf writes the 16 byte uid of .sgemf archives with pycrypto
+pytest.importorskip('Crypto')
+
+from . import gemf
+
+
+def _write_tree(tile_dir, seed=0):
+    """writes a zxy tile directory of random tile bytes with gaps in the columns and rows,
+       mixed extensions, a few tiles stored twice (with extensions of different priority) and repeated content
+    """
+    rnd = random.Random(seed)
+    shared = [bytes(rnd.getrandbits(8) for _ in range(rnd.randint(1, 200))) for _ in range(4)]
+    for z in (3, 5, 7):
+        for x in rnd.sample(range(40), 25):
+            ys = sorted(rnd.sample(range(30), rnd.choice([3, 6, 10])))
+            if rnd.random() < .5:
+                ys = list(range(4, 12))
+            x_dir = os.path.join(tile_dir, str(z), str(x))
+            os.makedirs(x_dir)
+            for y in ys:
+                exts = rnd.sample(gemf.extensions, 2 if rnd.random() < .1 else 1)
+                for ext in exts:
+                    if rnd.random() < .2:
+                        data = rnd.choice(shared)
+                    else:
+                        data = bytes(rnd.getrandbits(8) for _ in range(rnd.randint(1, 300)))
+                    with open(os.path.join(x_dir, '%d%s' % (y, ext)), 'wb') as f:
+                        f.write(data)
+
+
+def _reference_tiles(tile_dir):
+    """returns a dictionary of (z, x, y): tile path, the extension earliest in gemf.extensions wins"""
+    tiles = {}
+    for z in os.listdir(tile_dir):
+        for x in os.listdir(os.path.join(tile_dir, z)):
+            for name in os.listdir(os.path.join(tile_dir, z, x)):
+                y, ext = name[:name.find('.')], name[name.find('.'):]
+                key = (int(z), int(x), int(y))
+                if key not in tiles or gemf.extensions.index(ext) < gemf.extensions.index(tiles[key][0]):
+                    tiles[key] = (ext, os.path.join(tile_dir, z, x, name))
+    return dict((key, path) for key, (ext, path) in tiles.items())
+
+
+def _reference_ranges(keys):
+    """returns the list of (z, xmin, xmax, ymin, ymax) ranges of (z, x, y) tiles sorted by zoom, xmin and ymin
+       every column is split into runs of consecutive y, equal runs of adjacent columns share a range
+    """
+    columns = {}
+    for z, x, y in keys:
+        columns.setdefault((z, x), []).append(y)
+
+    ranges = []
+    open_ranges = {}  # (z, ymin, ymax): index of the range ending at the previous column
+    for z, x in sorted(columns):
+        ys = sorted(columns[(z, x)])
+        runs = []
+        for y in ys:
+            if runs and runs[-1][1] == y - 1:
+                runs[-1][1] = y
+            else:
+                runs.append([y, y])
+        for ymin, ymax in runs:
+            i = open_ranges.get((z, ymin, ymax))
+            if i is not None and ranges[i][2] == x - 1:
+                ranges[i][2] = x
+            else:
+                open_ranges[(z, ymin, ymax)] = len(ranges)
+                ranges.append([z, x, x, ymin, ymax])
+    return sorted([tuple(r) for r in ranges], key=lambda r: (r[0], r[1], r[3]))
+
+
+def _reference_gemf(tile_dir, name):
+    """returns the list of part bytes of the gemf archive of a tile directory written the plain way:
+       ranges in zoom, xmin, ymin order, tiles of a range column by column, a new part when the next tile
+       would make the part larger than gemf.file_size_limit
+    """
+    tiles = _reference_tiles(tile_dir)
+    ranges = _reference_ranges(tiles.keys())
+    ordered = [(z, x, y) for z, xmin, xmax, ymin, ymax in ranges
+               for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1)]
+
+    header = struct.pack('>III', gemf.gemf_version, 256, 1) + struct.pack('>II', 0, len(name)) + name.encode('ascii')
+    header += struct.pack('>I', len(ranges))
+    pre_info_size = len(header) + len(ranges) * gemf.range_size
+    offset = pre_info_size
+    for z, xmin, xmax, ymin, ymax in ranges:
+        header += struct.pack('>IIIIIIQ', z, xmin, xmax, ymin, ymax, 0, offset)
+        offset += (xmax - xmin + 1) * (ymax - ymin + 1) * gemf.file_info_size
+
+    datas = []
+    for key in ordered:
+        with open(tiles[key], 'rb') as f:
+            datas.append(f.read())
+
+    position = len(header) + len(ordered) * gemf.file_info_size
+    for data in datas:
+        header += struct.pack('>QI', position, len(data))
+        position += len(data)
+
+    parts = [header]
+    for data in datas:
+        if len(parts[-1]) + len(data) > gemf.file_size_limit:
+            parts.append(b'')
+        parts[-1] += data
+    return parts
+
+
+def _read_parts(path):
+    parts = []
+    for part in gemf.archive_parts(path):
+        with open(part, 'rb') as f:
+            parts.append(f.read())
+    return parts
+
+
+class Test_gemf(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tile_dir = os.path.join(self.tmp, 'REGION_TEST')
+        _write_tree(self.tile_dir)
+        self.file_size_limit = gemf.file_size_limit
+
+    def tearDown(self):
+        gemf.file_size_limit = self.file_size_limit
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, name='REGION_TEST.gemf', **kwargs):
+        tiles = gemf.TileScan(self.tile_dir, hash_tiles=kwargs.get('dedup', False))
+        return gemf.write_gemf(os.path.join(self.tmp, name), [('REGION_TEST', tiles)], **kwargs)
+
+    def test_matches_reference(self):
+        path = self._write()
+        self.assertEqual(_reference_gemf(self.tile_dir, 'REGION_TEST'), _read_parts(path))
+
+    def test_split_matches_reference(self):
+        gemf.file_size_limit = 5000
+        path = self._write()
+        parts = _read_parts(path)
+        self.assertGreater(len(parts), 2)
+        self.assertEqual(_reference_gemf(self.tile_dir, 'REGION_TEST'), parts)
+        for part in parts[1:]:
+            self.assertLessEqual(len(part), gemf.file_size_limit)
+
+    def test_ranges_match_reference(self):
+        for seed in range(1, 6):
+            tile_dir = os.path.join(self.tmp, 'ranges_%d' % seed)
+            _write_tree(tile_dir, seed)
+            scan = gemf.TileScan(tile_dir)
+            keys = list(zip(scan.z.tolist(), scan.x.tolist(), scan.y.tolist()))
+
+            ranges = gemf._ranges(scan)
+            self.assertEqual(_reference_ranges(keys), [(z,) + r for z in sorted(ranges) for r in ranges[z]])
+
+            ranges = gemf._ranges(scan, allow_empty=True)
+            for z in scan.zooms:
+                xs = [x for zoom, x, y in keys if zoom == z]
+                ys = [y for zoom, x, y in keys if zoom == z]
+                self.assertEqual([(min(xs), max(xs), min(ys), max(ys))], ranges[z])
+
+    def test_pack_ranges(self):
+        scan = gemf.TileScan(self.tile_dir)
+        keys = set(zip(scan.z.tolist(), scan.x.tolist(), scan.y.tolist()))
+        for z, ranges in gemf._ranges(scan).items():
+            packed = gemf._pack_ranges(ranges)
+            self.assertLessEqual(gemf._ranges_cost(packed), gemf._ranges_cost(ranges))
+            covered = [(x, y) for xmin, xmax, ymin, ymax in packed
+                       for x in range(xmin, xmax + 1) for y in range(ymin, ymax + 1)]
+            self.assertEqual(len(covered), len(set(covered)), 'packed ranges overlap at zoom %d' % z)
+            self.assertTrue(set([(x, y) for zoom, x, y in keys if zoom == z]) <= set(covered))
+
+        # single tiles on every other column of a block are cheaper as one range with empty tiles
+        checkered = [(x, x, y, y) for x in range(0, 8, 2) for y in range(4)]
+        self.assertEqual([(0, 6, 0, 3)], gemf._pack_ranges(checkered))
+
+        tiles = _reference_tiles(self.tile_dir)
+        path = self._write(pack_ranges=True)
+        with gemf.GemfReader(path) as reader:
+            self.assertLess(len(reader.ranges), len(_reference_ranges(tiles.keys())))
+            for key, tile_path in tiles.items():
+                with open(tile_path, 'rb') as f:
+                    self.assertEqual(f.read(), reader.get_tile(*key))
+            z, x, y, offsets, sizes = reader.tile_index()
+            for i in range(len(z)):
+                self.assertEqual((int(z[i]), int(x[i]), int(y[i])) in tiles, sizes[i] > 0)
+
+    def test_round_trip(self):
+        tiles = _reference_tiles(self.tile_dir)
+        gemf.file_size_limit = 5000
+        for tile_order in gemf.tile_orders:
+            for dedup in (False, True):
+                path = self._write(tile_order=tile_order, dedup=dedup)
+                with gemf.GemfReader(path) as reader:
+                    read = dict(((z, x, y), data) for z, x, y, data in reader.tiles())
+                    self.assertEqual(sorted(tiles), sorted(read))
+                    for key, tile_path in tiles.items():
+                        with open(tile_path, 'rb') as f:
+                            data = f.read()
+                        self.assertEqual(data, read[key], '%s %s tile %s' % (tile_order, dedup, key))
+                        self.assertEqual(data, reader.get_tile(*key))
+                    self.assertIsNone(reader.get_tile(3, 45, 45))
+
+    def test_missing_part(self):
+        gemf.file_size_limit = 5000
+        path = self._write()
+        os.remove(gemf.archive_parts(path)[-1])
+        with self.assertRaises(Exception):
+            gemf.GemfReader(path)
+
+    def test_copy_fallback(self):
+        gemf.file_size_limit = 5000
+        expected = _read_parts(self._write())
+
+        def copy_file_range(*args):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        with mock.patch.object(os, 'copy_file_range', copy_file_range, create=True):
+            self.assertEqual(expected, _read_parts(self._write('exdev.gemf')))
+
+        copy = getattr(os, 'copy_file_range', None)
+        if copy is not None:
+            del os.copy_file_range
+        try:
+            self.assertEqual(expected, _read_parts(self._write('pwrite.gemf')))
+        finally:
+            if copy is not None:
+                os.copy_file_range = copy
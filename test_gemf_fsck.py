@@ -0,0 +1,33 @@
+import random
+from unittest import TestCase
+
+import pytest
+
+pytest.importorskip('Crypto')
+
+from . import gemf_fsck
+
+
+def _reference_overlaps(ranges):
+    return set([(a[4], b[4]) for a in ranges for b in ranges if a[4] < b[4] and
+                a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]])
+
+
+class Test_gemf_fsck(TestCase):
+    def test_overlapping_ranges(self):
+        rnd = random.Random(0)
+        for n in range(200):
+            ranges = []
+            for i in range(rnd.randint(1, 40)):
+                xmin, ymin = rnd.randint(0, 30), rnd.randint(0, 30)
+                ranges.append((xmin, xmin + rnd.randint(0, 6), ymin, ymin + rnd.randint(0, 6), i))
+            expected = _reference_overlaps(ranges)
+            self.assertEqual(sorted(expected), sorted(gemf_fsck._overlapping_ranges(ranges)))
+
+        # a grid of disjoint ranges in every column has no overlaps, one range more overlaps two of them
+        cells = [(x, y) for x in range(0, 200, 2) for y in range(0, 300, 3)]
+        grid = [(x, x + 1, y, y + 2, i) for i, (x, y) in enumerate(cells)]
+        self.assertEqual([], gemf_fsck._overlapping_ranges(grid))
+        extra = (51, 52, 10, 10, len(grid))
+        self.assertEqual(sorted(_reference_overlaps(grid + [extra])),
+                         sorted(gemf_fsck._overlapping_ranges(grid + [extra])))
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import TestCase
+
+import pytest
+
+# zdata needs the gdal, pyproj and xlrd bindings (through catalog and regions), gemf needs pycrypto
+for module in ('osgeo', 'pyproj', 'xlrd', 'shapely', 'Crypto'):
+    pytest.importorskip(module)
+
+from . import config
+from . import gemf
+from . import manifestjson
+
+region = 'REGION_TEST'
+
+
+def _compile(compiled_dir, tile_dir, epoch, tiles):
+    """writes the <region>.gemf archive of tiles {(z, x, y): data} and its <region>.zdat like compiler.compile_region"""
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    for (z, x, y), data in tiles.items():
+        x_dir = os.path.join(tile_dir, str(z), str(x))
+        if not os.path.isdir(x_dir):
+            os.makedirs(x_dir)
+        with open(os.path.join(x_dir, '%d.png' % y), 'wb') as f:
+            f.write(data)
+    gemf.write_gemf(os.path.join(compiled_dir, region + '.gemf'), [(region, gemf.TileScan(tile_dir))])
+
+    sql_path = os.path.join(compiled_dir, region + '.sql')
+    with open(sql_path, 'w') as f:
+        f.write('--MXMARINER-DBVERSION:3\n')
+        f.write('UPDATE regions SET installeddate=\'%d\' WHERE name=\'%s\';\n' % (epoch, region))
+    with zipfile.ZipFile(os.path.join(compiled_dir, region + '.zdat'), 'w', zipfile.ZIP_DEFLATED) as zdat_file:
+        zdat_file.write(sql_path, region + '.sql')
+    os.remove(sql_path)
+
+
+class Test_manifestjson(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.compiled_dir = config.compiled_dir
+        config.compiled_dir = os.path.join(self.tmp, 'compiled')
+        os.makedirs(config.compiled_dir)
+
+    def tearDown(self):
+        config.compiled_dir = self.compiled_dir
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_generate_twice(self):
+        tile_dir = os.path.join(self.tmp, 'tiles')
+        tiles = dict(((5, x, y), b'tile %d %d' % (x, y)) for x in range(4) for y in range(3))
+        first_epoch = 1500000000
+        _compile(config.compiled_dir, tile_dir, first_epoch, tiles)
+        data = manifestjson.generate()
+        first = data['regions'][region]
+        self.assertEqual(first_epoch, first['epoch'])
+
+        # the next edition is compiled next to the published (time stamped) previous edition
+        tiles[(5, 1, 1)] = b'changed'
+        tiles[(6, 0, 0)] = b'added'
+        second_epoch = first_epoch + 86400
+        _compile(config.compiled_dir, tile_dir, second_epoch, tiles)
+        data = manifestjson.generate(data)
+
+        self.assertEqual([region], list(data['regions']))
+        second = data['regions'][region]
+        self.assertEqual(second_epoch, second['epoch'])
+        ts = manifestjson.get_time_stamp(second_epoch, local=True)
+        self.assertEqual('/%s_%s.gemf' % (ts, region), second['gemf_url'])
+        self.assertEqual('/%s_%s.zdat' % (ts, region), second['data_url'])
+        self.assertEqual([(first_epoch, second_epoch, 1, 1, 0)],
+                         [(d['base_epoch'], d['target_epoch'], d['added'], d['changed'], d['removed'])
+                          for d in second['deltas']])
+
+        # the previous edition is left as it was published
+        names = os.listdir(config.compiled_dir)
+        self.assertIn(first['gemf_url'][1:], names)
+        self.assertIn(first['data_url'][1:], names)
+        self.assertEqual(first['gemf_checksum'], manifestjson.archive_checksum(
+            os.path.join(config.compiled_dir, first['gemf_url'][1:])))
+        self.assertEqual([], [name for name in names if name.count('TS_') > 1])
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+import pytest
+
+# catalog, regions and tilebuilder need the gdal, pyproj and xlrd bindings
+for module in ('osgeo', 'pyproj', 'xlrd', 'shapely', 'PIL'):
+    pytest.importorskip(module)
+
+from PIL import Image
+from . import config
+from . import tilecull
+from . import tilesmerge
+
+zooms = (9, 10)
+
+# catalog order, lowest priority first: a large chart and a higher priority chart inside of it
+charts = [{'path': '/charts/A.KAP', 'outline': '47.0,-124.0:49.0,-124.0:49.0,-121.0:47.0,-121.0:47.0,-124.0'},
+          {'path': '/charts/B.KAP', 'outline': '47.4,-123.6:48.6,-123.6:48.6,-121.9:47.4,-121.9:47.4,-123.6'}]
+
+
+def _render(i, tile_dir, hidden=None):
+    """writes the tiles of a chart outline (stands in for tilebuilder.build_tiles_for_map)
+       chart A is opaque red, chart B is opaque blue with transparent and semitransparent columns of tiles
+       (no data inside of its outline)
+    """
+    poly = tilecull.outline_polygon(charts[i]['outline'])
+    for z in zooms:
+        for x, y in tilecull.tiles_for_polygon_bounds(poly, z):
+            if hidden is not None and (x, y) in hidden.get(z, ()):
+                continue
+            alpha = 255
+            if i == 1:
+                alpha = (0, 128, 255, 255)[x % 4]
+            rgba = numpy.zeros((256, 256, 4), dtype=numpy.uint8)
+            rgba[:, :] = (255, 0, 0, alpha) if i == 0 else (0, 0, 255, alpha)
+            tile_dir_x = os.path.join(tile_dir, str(z), str(x))
+            if not os.path.isdir(tile_dir_x):
+                os.makedirs(tile_dir_x)
+            Image.fromarray(rgba, 'RGBA').save(os.path.join(tile_dir_x, '%d.png' % y))
+
+
+def _read_tiles(tile_dir):
+    tiles = {}
+    for tile in tilesmerge.tile_list(tile_dir):
+        tiles[tile] = numpy.asarray(Image.open(os.path.join(tile_dir, tile)).convert('RGBA'))
+    return tiles
+
+
+class Test_tilecull(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = (config.catalog_dir, config.tile_cache_dir, config.merged_tile_dir)
+        config.catalog_dir = os.path.join(self.tmp, 'catalogs')
+        config.tile_cache_dir = os.path.join(self.tmp, 'cache')
+        config.merged_tile_dir = os.path.join(self.tmp, 'merged')
+        os.makedirs(config.catalog_dir)
+        with open(os.path.join(config.catalog_dir, 'REGION_TEST.json'), 'w') as f:
+            json.dump([dict(chart, min_zoom=zooms[0], max_zoom=zooms[-1]) for chart in charts], f)
+
+    def tearDown(self):
+        config.catalog_dir, config.tile_cache_dir, config.merged_tile_dir = self.config
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_merge_same_with_culling(self):
+        full_dirs = [os.path.join(self.tmp, 'full', str(i)) for i in range(len(charts))]
+        for i, tile_dir in enumerate(full_dirs):
+            _render(i, tile_dir)
+        tilesmerge.merge_list('FULL', full_dirs, nothreads=True)
+
+        plan = tilecull.plan_hidden_tiles('REGION_TEST')
+        hidden = [plan.get(chart['path']) for chart in charts]
+        self.assertTrue(hidden[0], 'chart A should have tiles hidden by chart B')
+
+        culled_dirs = [os.path.join(self.tmp, 'culled', str(i)) for i in range(len(charts))]
+        for i, tile_dir in enumerate(culled_dirs):
+            _render(i, tile_dir, hidden[i])
+        rerender = tilecull.confirm_hidden_tiles(culled_dirs, hidden)
+        self.assertEqual([0], list(rerender), 'the transparent tiles of chart B do not hide chart A')
+        for i, confirmed in rerender.items():
+            _render(i, culled_dirs[i], confirmed)
+        tilesmerge.merge_list('CULLED', culled_dirs, nothreads=True)
+
+        full = _read_tiles(os.path.join(config.merged_tile_dir, 'FULL'))
+        culled = _read_tiles(os.path.join(config.merged_tile_dir, 'CULLED'))
+        self.assertEqual(sorted(full), sorted(culled))
+        for tile in full:
+            self.assertTrue(numpy.array_equal(full[tile], culled[tile]), 'merged tile %s differs' % tile)
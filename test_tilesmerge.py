@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy
+import pytest
+
+# tilesmerge needs the gdal, pyproj and xlrd bindings (through catalog and tilecull)
+for module in ('osgeo', 'pyproj', 'xlrd', 'shapely', 'PIL'):
+    pytest.importorskip(module)
+
+from PIL import Image
+from . import config
+from . import tilesmerge
+
+# catalog order, lowest priority first: (color, first column, last column) of each chart's tiles at zoom 3
+charts = [((255, 0, 0), 0, 3), ((0, 255, 0), 1, 4), ((0, 0, 255), 2, 5)]
+
+
+def _render(tile_dir, seed, color, x_min, x_max):
+    """writes rows 0-1 of columns x_min-x_max at zoom 3, every pixel a random alpha (a third of them opaque)"""
+    rnd = numpy.random.RandomState(seed)
+    for x in range(x_min, x_max + 1):
+        tile_dir_x = os.path.join(tile_dir, '3', str(x))
+        os.makedirs(tile_dir_x)
+        for y in range(2):
+            rgba = numpy.zeros((256, 256, 4), dtype=numpy.uint8)
+            rgba[:, :, :3] = color
+            rgba[:, :, 3] = numpy.where(rnd.rand(256, 256) < .33, 255, rnd.randint(0, 256, (256, 256)))
+            Image.fromarray(rgba, 'RGBA').save(os.path.join(tile_dir_x, '%d.png' % y))
+
+
+def _reference(tile_dirs, tile):
+    """returns the float alpha over composite (straight rgb, alpha) of a tile, the last tile dir on top"""
+    rgb = numpy.zeros((256, 256, 3))
+    alpha = numpy.zeros((256, 256, 1))
+    for tile_dir in tile_dirs:
+        path = os.path.join(tile_dir, tile)
+        if os.path.exists(path):
+            src = numpy.asarray(Image.open(path).convert('RGBA'), dtype=numpy.float64) / 255.
+            rgb = src[:, :, :3] * src[:, :, 3:] + rgb * (1. - src[:, :, 3:])
+            alpha = src[:, :, 3:] + alpha * (1. - src[:, :, 3:])
+    rgb = numpy.divide(rgb, alpha, out=numpy.zeros_like(rgb), where=alpha > 0)
+    return numpy.concatenate((rgb, alpha), axis=2) * 255.
+
+
+class Test_tilesmerge(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = (config.tile_cache_dir, config.merged_tile_dir)
+        config.tile_cache_dir = os.path.join(self.tmp, 'cache')
+        config.merged_tile_dir = os.path.join(self.tmp, 'merged')
+
+    def tearDown(self):
+        config.tile_cache_dir, config.merged_tile_dir = self.config
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_modes_composite_alike(self):
+        tile_dirs = [os.path.join(self.tmp, 'charts', str(i)) for i in range(len(charts))]
+        for i, (tile_dir, chart) in enumerate(zip(tile_dirs, charts)):
+            _render(tile_dir, i, *chart)
+
+        merged = {}
+        for mode in (tilesmerge.MERGE_CHART_MAJOR, tilesmerge.MERGE_TILE_MAJOR, tilesmerge.MERGE_REVERSE):
+            tilesmerge.merge_list(mode, tile_dirs, nothreads=True, mode=mode)
+            merge_dir = os.path.join(config.merged_tile_dir, mode)
+            merged[mode] = dict((tile, numpy.asarray(Image.open(os.path.join(merge_dir, tile)).convert('RGBA')))
+                                for tile in tilesmerge.tile_list(merge_dir))
+
+        tiles = sorted(merged[tilesmerge.MERGE_CHART_MAJOR])
+        self.assertEqual(12, len(tiles))
+        for mode, mode_tiles in merged.items():
+            self.assertEqual(tiles, sorted(mode_tiles))
+            for tile in tiles:
+                layers = len([tile_dir for tile_dir in tile_dirs if os.path.exists(os.path.join(tile_dir, tile))])
+                expected = _reference(tile_dirs, tile)
+                error = numpy.abs(mode_tiles[tile].astype(numpy.float64) - expected)
+                # rgb under (nearly) transparent pixels is not meaningful after rounding the alpha to 8 bits
+                error[:, :, :3] *= expected[:, :, 3:] >= 8.
+                # one or two layers are composited from the 8 bit tiles exactly, three layers round in between
+                self.assertLessEqual(error.max(), .501 if layers < 3 else 2., '%s tile %s' % (mode, tile))
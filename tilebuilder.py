@@ -29,15 +29,15 @@ __status__ = "Development"  # "Prototype", "Development", or "Production"
         gdal command line utilities
 '''
 
+import collections
 import subprocess
 import os
 import shlex
-import multiprocessing
-from functools import partial
 import traceback
 import json
 import shutil
 
+import numpy
 from PIL import Image
 from osgeo import gdal
 import osr
@@ -47,6 +47,10 @@ from . import tilesystem
 from . import gdalds
 from . import catalog
 from . import config
+from . import tilecull
+from . import tilesmerge
+from . import fileplace
+from . import executor
 
 
 # http://www.gdal.org/formats_list.html
@@ -184,11 +188,57 @@ def build_tile_vrt_for_map(map_path, cutline=None):
     return map_stack
 
 
-def _render_tmp_vrt_stack_for_map(map_stack, zoom, out_dir):
+def _dataset_transforms(ds):
+    """returns the coordinate transform from lat lng to data set coords
+       and the inverted geo transform (data set coords to pixels) of a dataset
+    """
+    # ---- create coordinate transform from lat lng to data set coords
+    ds_wkt = gdalds.dataset_get_projection_wkt(ds)
+    ds_srs = osr.SpatialReference()
+    ds_srs.ImportFromWkt(ds_wkt)
+
+    wgs84_srs = osr.SpatialReference()
+    wgs84_srs.ImportFromEPSG(4326)
+
+    transform = osr.CoordinateTransformation(wgs84_srs, ds_srs)
+
+    # ---- grab inverted geomatrix from ground control points
+    geotransform = gdalds.get_geo_transform(ds)
+    inv_transform = gdal.InvGeoTransform(geotransform)
+
+    return transform, inv_transform
+
+
+def _tile_ranges(ds, zoom_level):
+    """returns a list of (tile_min_x, tile_max_x, tile_min_y, tile_max_y) tile ranges
+       covering a dataset at a zoom level
+    """
+    # fetch vrt data-set extends as tile bounds
+    lat_lng_bounds_wnes, is_north_up = gdalds.dataset_lat_lng_bounds(ds)
+
+    min_lng, max_lat, max_lng, min_lat = lat_lng_bounds_wnes
+
+    tile_bounds_wnes = tilesystem.lat_lng_bounds_to_tile_bounds_count(min_lng, max_lat, max_lng, min_lat, zoom_level)
+
+    tile_west, tile_north, tile_east, tile_south, tile_count_x, tile_count_y = tile_bounds_wnes
+
+    logger.log(log_on, 'west east', tile_west, tile_east)
+
+    if tile_west > tile_east:  # dateline wrap
+        logger.log(log_on, 'wrapping tile to dateline')
+        return [(0, tile_west, tile_south, tile_north),
+                (tile_east, tilesystem.map_size_tiles(zoom_level), tile_south, tile_north)]
+
+    return [(tile_west, tile_east, tile_south, tile_north)]
+
+
+def _render_tmp_vrt_stack_for_map(map_stack, zoom, out_dir, hidden_tiles=None, region_clip=None):
     """renders a stack of vrts built with _build_tmp_vrt_stack_for_map()
        into tiles for specified zoom level
        rendered tiles placed in out_dir directory
        if out_dir is None or not a directory, tiles placed in map_stack, map directory
+       hidden_tiles - set of (x, y) tiles at this zoom level that should not be rendered
+       region_clip - tilecull.RegionClip, tiles outside of the region are not rendered
     """
 
     logger.log(log_on, '_render_tmp_vrt_stack_for_map: out_dir = ' + out_dir + ', zoom = ' + zoom)
@@ -209,40 +259,14 @@ def _render_tmp_vrt_stack_for_map(map_stack, zoom, out_dir):
 
     zoom_level = int(zoom)
 
-    # fetch vrt data-set extends as tile bounds
-    lat_lng_bounds_wnes, is_north_up = gdalds.dataset_lat_lng_bounds(ds)
+    transform, inv_transform = _dataset_transforms(ds)
 
-    min_lng, max_lat, max_lng, min_lat = lat_lng_bounds_wnes
+    if hidden_tiles is None:
+        hidden_tiles = set()
 
-    tile_bounds_wnes = tilesystem.lat_lng_bounds_to_tile_bounds_count(min_lng, max_lat, max_lng, min_lat, zoom_level)
-
-    tile_west, tile_north, tile_east, tile_south, tile_count_x, tile_count_y = tile_bounds_wnes
-
-    # ---- create coordinate transform from lat lng to data set coords
-    ds_wkt = gdalds.dataset_get_projection_wkt(ds)
-    ds_srs = osr.SpatialReference()
-    ds_srs.ImportFromWkt(ds_wkt)
-
-    wgs84_srs = osr.SpatialReference()
-    wgs84_srs.ImportFromEPSG(4326)
-
-    transform = osr.CoordinateTransformation(wgs84_srs, ds_srs)
-
-    # ---- grab inverted geomatrix from ground control points
-    geotransform = gdalds.get_geo_transform(ds)
-    inv_transform = gdal.InvGeoTransform(geotransform)
-
-    logger.log(log_on, 'west east', tile_west, tile_east)
-
-    if tile_west > tile_east:  # dateline wrap
-        logger.log(log_on, 'wrapping tile to dateline')
-        _cut_tiles_in_range(0, tile_west, tile_south, tile_north, transform,
-                            inv_transform, zoom_level, out_dir, ds)
-        _cut_tiles_in_range(tile_east, tilesystem.map_size_tiles(zoom_level),
-                            tile_south, tile_north, transform, inv_transform, zoom_level, out_dir, ds)
-    else:
-        _cut_tiles_in_range(tile_west, tile_east, tile_south, tile_north, transform,
-                            inv_transform, zoom_level, out_dir, ds)
+    for tile_min_x, tile_max_x, tile_min_y, tile_max_y in _tile_ranges(ds, zoom_level):
+        _cut_tiles_in_range(tile_min_x, tile_max_x, tile_min_y, tile_max_y, transform,
+                            inv_transform, zoom_level, out_dir, ds, hidden_tiles, region_clip)
 
     del ds
 
@@ -295,7 +319,7 @@ def _scale_tile(tile_dir, z, x, y):
 
 
 def _cut_tiles_in_range(tile_min_x, tile_max_x, tile_min_y, tile_max_y, transform,
-                        inv_transform, zoom_level, out_dir, ds):
+                        inv_transform, zoom_level, out_dir, ds, hidden_tiles=(), region_clip=None):
     for tile_x in range(int(tile_min_x), int(tile_max_x) + 1, 1):
         tile_dir = os.path.join(out_dir, '%s/%s' % (zoom_level, tile_x))
 
@@ -303,6 +327,16 @@ def _cut_tiles_in_range(tile_min_x, tile_max_x, tile_min_y, tile_max_y, transfor
             tile_path = os.path.join(tile_dir, '%s.png' % tile_y)
             logger.log(log_on, tile_path)
 
+            # skip tile that will be covered by a higher priority chart when merged
+            if (tile_x, tile_y) in hidden_tiles:
+                logger.log(log_on, 'skipping hidden tile', tile_path)
+                continue
+
+            # skip tile outside of the region boundary
+            if region_clip is not None and not region_clip.contains(zoom_level, tile_x, tile_y):
+                logger.log(log_on, 'skipping tile outside of region', tile_path)
+                continue
+
             # logger.debug = True
 
             # skip tile if exists
@@ -323,125 +357,162 @@ def _cut_tiles_in_range(tile_min_x, tile_max_x, tile_min_y, tile_max_y, transfor
 
             # logger.debug = False
 
-            m_px, m_py = tilesystem.tile_xy_to_pixel_xy(tile_x, tile_y)
-            lat, lng = tilesystem.pixel_xy_to_lat_lng(m_px, m_py, zoom_level)
-            geo_x, geo_y = transform.TransformPoint(float(lng), float(lat))[:2]
-            ds_px = int(inv_transform[0] + inv_transform[1] * geo_x + inv_transform[2] * geo_y)
-            ds_py = int(inv_transform[3] + inv_transform[4] * geo_x + inv_transform[5] * geo_y)
-
-            lat, lng = tilesystem.pixel_xy_to_lat_lng(m_px + tilesystem.tile_size, m_py + tilesystem.tile_size,
-                                                      zoom_level)
-            geo_x, geo_y = transform.TransformPoint(float(lng), float(lat))[:2]
-            ds_pxx = int(inv_transform[0] + inv_transform[1] * geo_x + inv_transform[2] * geo_y)
-            ds_pyy = int(inv_transform[3] + inv_transform[4] * geo_x + inv_transform[5] * geo_y)
-
-            logger.log(log_on, 'ds_px, ds_py is the datset coordinate of tile (upper left)')
-            logger.log(log_on, 'ds_px', ds_px, 'ds_py', ds_py)
-            logger.log(log_on, 'ds_pxx, ds_pyy is the datset coordinate of tile (lower right)')
-            logger.log(log_on, 'ds_pxx', ds_pxx, 'ds_pyy', ds_pyy)
-            logger.log(log_on, 'lat lng', lat, lng)
-            logger.log(log_on, 'geo', geo_x, geo_y)
-            logger.log(log_on, 'raster actual size x y', ds.RasterXSize, ds.RasterYSize)
-
-            ds_px_clip = tilesystem.clip(ds_px, 0, ds.RasterXSize)
-            ds_pxx_clip = tilesystem.clip(ds_pxx, 0, ds.RasterXSize)
-            x_size_clip = ds_pxx_clip - ds_px_clip
-
-            ds_py_clip = tilesystem.clip(ds_py, 0, ds.RasterYSize)
-            ds_pyy_clip = tilesystem.clip(ds_pyy, 0, ds.RasterYSize)
-            y_size_clip = ds_pyy_clip - ds_py_clip
-
-            if x_size_clip <= 0 or y_size_clip <= 0:
-                continue
-
-            logger.log(log_on, 'ds_px_clip', ds_px_clip)
-            logger.log(log_on, 'ds_py_clip', ds_py_clip)
-            logger.log(log_on, 'x_size_clip', x_size_clip)
-            logger.log(log_on, 'y_size_clip', y_size_clip)
-            logger.log(log_on, '-----------------------------')
-
-            logger.log(log_on, 'reading dataset')
-            data = ds.ReadRaster(int(ds_px_clip), int(ds_py_clip), int(x_size_clip), int(y_size_clip))
-
-            transparent = True
-            if data is not None:
-                for ea in data:
-                    if ea != 0:
-                        transparent = False
-                        break
+            tile = _render_tile(ds, transform, inv_transform, zoom_level, tile_x, tile_y)
 
             # only create tiles that have data (not completely transparent)
-            if not transparent:
-                x_size = ds_pxx - ds_px
-                y_size = ds_pyy - ds_py
-                logger.log(log_on, 'x_size', x_size)
-                logger.log(log_on, 'y_size', y_size)
-
+            if tile is not None:
                 if not os.path.isdir(tile_dir):
                     os.makedirs(tile_dir)
 
-                logger.log(log_on, 'ds_pxx', ds_pxx)
-                logger.log(log_on, 'ds_pxx_clip', ds_pxx_clip)
-                logger.log(log_on, 'ds_pyy', ds_pyy)
-                logger.log(log_on, 'ds_pyy_clip', ds_pyy_clip)
-
-                if ds_pxx == ds_pxx_clip:
-                    xoff = x_size - x_size_clip
-                elif ds_px_clip == 0 and ds_px < 0:
-                    xoff = abs(ds_px)
-                else:
-                    xoff = 0
-                if ds_pyy == ds_pyy_clip:
-                    yoff = y_size - y_size_clip
-                elif ds_py_clip == 0 and ds_py < 0:
-                    yoff = abs(ds_py)
-                else:
-                    yoff = 0
-
-                logger.log(log_on, 'xoff', xoff)
-                logger.log(log_on, 'yoff', yoff)
-                tile_bands = ds.RasterCount + 1
-
-                logger.log(log_on, 'create mem window')
-                tmp = mem_driver.Create('', int(x_size), int(y_size), bands=ds.RasterCount)
-
-                logger.log(log_on, 'write mem window')
-                tmp.WriteRaster(int(xoff), int(yoff), int(x_size_clip), int(y_size_clip), data,
-                                band_list=range(1, tile_bands))
-
-                logger.log(log_on, 'create mem tile')
-                tile = mem_driver.Create('', tilesystem.tile_size, tilesystem.tile_size, bands=ds.RasterCount)
-
-                scaling_up = int(x_size) < tilesystem.tile_size or int(y_size) < tilesystem.tile_size
-
-                # check if we're scaling image up
-                if scaling_up:
-                    logger.log(log_on, 'scaling up')
-                    tmp.SetGeoTransform((0.0, tilesystem.tile_size / float(x_size), 0.0,
-                                         0.0, 0.0, tilesystem.tile_size / float(y_size)))
-                    tile.SetGeoTransform((0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
-                    gdal.ReprojectImage(tmp, tile, None, None, gdal_resampling)
-                # or scaling image down
-                else:
-                    logger.log(log_on, 'scaling down')
-                    for i in range(1, ds.RasterCount + 1):
-                        gdal.RegenerateOverview(tmp.GetRasterBand(i), tile.GetRasterBand(i), resampling)
-
                 logger.log(log_on, 'write to file')
                 png_driver.CreateCopy(tile_path, tile, strict=0)
 
-                del data
-                del tmp
                 del tile
 
 
-def build_tiles_for_map(kap, map_path, start_zoom, stop_zoom, cutline=None, out_dir=None):
+def _render_tile(ds, transform, inv_transform, zoom_level, tile_x, tile_y, max_window=None):
+    """renders a tile from a dataset
+       max_window - if set, dataset windows larger than this many pixels (width or height) are
+       reduced while reading so lower zoom levels can be rendered directly from the dataset
+       returns a MEM dataset of the tile or None if the tile would be fully transparent
+    """
+    m_px, m_py = tilesystem.tile_xy_to_pixel_xy(tile_x, tile_y)
+    lat, lng = tilesystem.pixel_xy_to_lat_lng(m_px, m_py, zoom_level)
+    geo_x, geo_y = transform.TransformPoint(float(lng), float(lat))[:2]
+    ds_px = int(inv_transform[0] + inv_transform[1] * geo_x + inv_transform[2] * geo_y)
+    ds_py = int(inv_transform[3] + inv_transform[4] * geo_x + inv_transform[5] * geo_y)
+
+    lat, lng = tilesystem.pixel_xy_to_lat_lng(m_px + tilesystem.tile_size, m_py + tilesystem.tile_size,
+                                              zoom_level)
+    geo_x, geo_y = transform.TransformPoint(float(lng), float(lat))[:2]
+    ds_pxx = int(inv_transform[0] + inv_transform[1] * geo_x + inv_transform[2] * geo_y)
+    ds_pyy = int(inv_transform[3] + inv_transform[4] * geo_x + inv_transform[5] * geo_y)
+
+    logger.log(log_on, 'ds_px, ds_py is the datset coordinate of tile (upper left)')
+    logger.log(log_on, 'ds_px', ds_px, 'ds_py', ds_py)
+    logger.log(log_on, 'ds_pxx, ds_pyy is the datset coordinate of tile (lower right)')
+    logger.log(log_on, 'ds_pxx', ds_pxx, 'ds_pyy', ds_pyy)
+    logger.log(log_on, 'lat lng', lat, lng)
+    logger.log(log_on, 'geo', geo_x, geo_y)
+    logger.log(log_on, 'raster actual size x y', ds.RasterXSize, ds.RasterYSize)
+
+    ds_px_clip = tilesystem.clip(ds_px, 0, ds.RasterXSize)
+    ds_pxx_clip = tilesystem.clip(ds_pxx, 0, ds.RasterXSize)
+    x_size_clip = ds_pxx_clip - ds_px_clip
+
+    ds_py_clip = tilesystem.clip(ds_py, 0, ds.RasterYSize)
+    ds_pyy_clip = tilesystem.clip(ds_pyy, 0, ds.RasterYSize)
+    y_size_clip = ds_pyy_clip - ds_py_clip
+
+    if x_size_clip <= 0 or y_size_clip <= 0:
+        return None
+
+    logger.log(log_on, 'ds_px_clip', ds_px_clip)
+    logger.log(log_on, 'ds_py_clip', ds_py_clip)
+    logger.log(log_on, 'x_size_clip', x_size_clip)
+    logger.log(log_on, 'y_size_clip', y_size_clip)
+    logger.log(log_on, '-----------------------------')
+
+    x_size = ds_pxx - ds_px
+    y_size = ds_pyy - ds_py
+    logger.log(log_on, 'x_size', x_size)
+    logger.log(log_on, 'y_size', y_size)
+
+    if ds_pxx == ds_pxx_clip:
+        xoff = x_size - x_size_clip
+    elif ds_px_clip == 0 and ds_px < 0:
+        xoff = abs(ds_px)
+    else:
+        xoff = 0
+    if ds_pyy == ds_pyy_clip:
+        yoff = y_size - y_size_clip
+    elif ds_py_clip == 0 and ds_py < 0:
+        yoff = abs(ds_py)
+    else:
+        yoff = 0
+
+    # reduce the window while reading
+    reduce = 1
+    if max_window is not None:
+        while max(x_size, y_size) / reduce > max_window:
+            reduce *= 2
+
+    logger.log(log_on, 'reading dataset')
+    if reduce == 1:
+        data = ds.ReadRaster(int(ds_px_clip), int(ds_py_clip), int(x_size_clip), int(y_size_clip))
+    else:
+        logger.log(log_on, 'reducing window by', reduce)
+        x_size = max(1, int(x_size / reduce))
+        y_size = max(1, int(y_size / reduce))
+        x_size_clip = max(1, min(x_size, int(x_size_clip / reduce)))
+        y_size_clip = max(1, min(y_size, int(y_size_clip / reduce)))
+        xoff = min(int(xoff / reduce), x_size - x_size_clip)
+        yoff = min(int(yoff / reduce), y_size - y_size_clip)
+        data = ds.ReadRaster(int(ds_px_clip), int(ds_py_clip), int(ds_pxx_clip - ds_px_clip),
+                             int(ds_pyy_clip - ds_py_clip), buf_xsize=int(x_size_clip), buf_ysize=int(y_size_clip),
+                             resample_alg=gdal.GRIORA_Average)
+
+    transparent = True
+    if data is not None:
+        for ea in data:
+            if ea != 0:
+                transparent = False
+                break
+
+    # only create tiles that have data (not completely transparent)
+    if transparent:
+        return None
+
+    logger.log(log_on, 'ds_pxx', ds_pxx)
+    logger.log(log_on, 'ds_pxx_clip', ds_pxx_clip)
+    logger.log(log_on, 'ds_pyy', ds_pyy)
+    logger.log(log_on, 'ds_pyy_clip', ds_pyy_clip)
+
+    logger.log(log_on, 'xoff', xoff)
+    logger.log(log_on, 'yoff', yoff)
+    tile_bands = ds.RasterCount + 1
+
+    logger.log(log_on, 'create mem window')
+    tmp = mem_driver.Create('', int(x_size), int(y_size), bands=ds.RasterCount)
+
+    logger.log(log_on, 'write mem window')
+    tmp.WriteRaster(int(xoff), int(yoff), int(x_size_clip), int(y_size_clip), data,
+                    band_list=range(1, tile_bands))
+
+    logger.log(log_on, 'create mem tile')
+    tile = mem_driver.Create('', tilesystem.tile_size, tilesystem.tile_size, bands=ds.RasterCount)
+
+    scaling_up = int(x_size) < tilesystem.tile_size or int(y_size) < tilesystem.tile_size
+
+    # check if we're scaling image up
+    if scaling_up:
+        logger.log(log_on, 'scaling up')
+        tmp.SetGeoTransform((0.0, tilesystem.tile_size / float(x_size), 0.0,
+                             0.0, 0.0, tilesystem.tile_size / float(y_size)))
+        tile.SetGeoTransform((0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+        gdal.ReprojectImage(tmp, tile, None, None, gdal_resampling)
+    # or scaling image down
+    else:
+        logger.log(log_on, 'scaling down')
+        for i in range(1, ds.RasterCount + 1):
+            gdal.RegenerateOverview(tmp.GetRasterBand(i), tile.GetRasterBand(i), resampling)
+
+    del data
+    del tmp
+    return tile
+
+
+def build_tiles_for_map(kap, map_path, start_zoom, stop_zoom, cutline=None, out_dir=None, hidden_tiles=None,
+                        region_clip=None):
     """builds tiles for a map_path - path to map to render tiles for
        zoom_level - int or string representing int of the single zoom level to render
        cutline - string defining the map border cutout... this can be None if the whole
        map should be rendered.
        out_dir - path to where tiles will be rendered to, if set to None then
        tiles will be rendered int map_path's base directory
+       hidden_tiles - dictionary of zoom: set of (x, y) tiles that should not be rendered
+       (see tilecull.plan_hidden_tiles)
+       region_clip - tilecull.RegionClip, tiles outside of the region will not be rendered
 
        cutline string format example: 48.3,-123.2:48.5,-123.2:48.5,-122.7:48.3,-122.7:48.3,-123.2
        : dilineated latitude/longitude WGS-84 coordinates (in decimal degrees)
@@ -471,11 +542,14 @@ def build_tiles_for_map(kap, map_path, start_zoom, stop_zoom, cutline=None, out_
 
     logger.log(log_on, 'out_dir', out_dir)
 
+    if hidden_tiles is None:
+        hidden_tiles = {}
+
     try:
         # Mxmcc tiler
         for z in zoom_range:
             logger.log(log_on, 'rendering map_stack peek')
-            _render_tmp_vrt_stack_for_map(map_stack, str(z), out_dir)
+            _render_tmp_vrt_stack_for_map(map_stack, str(z), out_dir, hidden_tiles.get(z), region_clip)
 
         if single_z_mode:
             oz_dir = os.path.join(out_dir, str(stop_zoom + 1))
@@ -531,31 +605,299 @@ def copy_viewer(dest):
         shutil.copy(src, dst)
 
 
-def _build_tiles_for_map_helper(entry, name):
-    """helper method for multiprocessing pool map_async
+def _map_tile_dir(catalog_name, entry):
+    """unmerged tile output directory of a catalog entry's map"""
+    m_name = os.path.basename(entry['path'])
+    return os.path.join(config.unmerged_tile_dir, catalog_name, m_name[0:m_name.rfind('.')])
+
+
+def _build_tiles_for_map_helper(state, task):
+    """helper method for executor.parallel_map
+       state - tuple of catalog name, tilecull.RegionClip or None
+       task - tuple of catalog entry, hidden tiles for the entry's map
     """
     try:
+        name, region_clip = state
+        entry, hidden_tiles = task
         m_name = os.path.basename(entry['path'])
-        out_dir = os.path.join(config.unmerged_tile_dir, name, m_name[0:m_name.rfind('.')])
+        out_dir = _map_tile_dir(name, entry)
         m_path = entry['path']
         min_zoom = int(entry['min_zoom'])
         max_zoom = int(entry['max_zoom'])
         m_outline = entry['outline']
-        build_tiles_for_map(m_name, m_path, min_zoom, max_zoom, cutline=m_outline, out_dir=out_dir)
+        build_tiles_for_map(m_name, m_path, min_zoom, max_zoom, cutline=m_outline, out_dir=out_dir,
+                            hidden_tiles=hidden_tiles, region_clip=region_clip)
 
     except BaseException as e:
         traceback.print_exc()
         logger.log(log_on, e)
 
 
-def build_tiles_for_catalog(catalog_name):
+def build_tiles_for_catalog(catalog_name, cull_hidden=True):
     """builds tiles for every map in a catalog
        tiles output to tile directory in config.py
+       cull_hidden - set to False to render tiles that will be covered by higher priority maps
+       tiles outside of the region boundary (if the region has one) are not rendered
     """
     catalog_name = catalog_name.upper()
 
     reader = catalog.get_reader_for_region(catalog_name)
-    pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-    pool.map_async(partial(_build_tiles_for_map_helper, name=catalog_name), reader)
-    pool.close()
-    pool.join()  # wait for pool to empty
+    if cull_hidden:
+        hidden = tilecull.plan_hidden_tiles(catalog_name)
+    else:
+        hidden = {}
+
+    region_clip = tilecull.region_clip_for_region(catalog_name)
+
+    tasks = [(entry, hidden.get(entry['path'])) for entry in reader]
+    executor.parallel_map(_build_tiles_for_map_helper, tasks, state=(catalog_name, region_clip), chunksize=1)
+
+    if cull_hidden:
+        # the higher priority maps may have rendered transparent inside of their outlines, maps are rendered
+        # again where their hidden tiles are not covered by an opaque tile
+        tile_dirs = [_map_tile_dir(catalog_name, entry) for entry, hidden_tiles in tasks]
+        rerender = tilecull.confirm_hidden_tiles(tile_dirs, [hidden_tiles for entry, hidden_tiles in tasks],
+                                                 region_clip)
+        tasks = [(tasks[i][0], confirmed) for i, confirmed in sorted(rerender.items())]
+        executor.parallel_map(_build_tiles_for_map_helper, tasks, state=(catalog_name, region_clip), chunksize=1)
+
+
+# ---- fused render and merge
+
+# destination tiles are assigned to workers in blocks of block_size x block_size tiles
+fused_block_size = 8
+
+# lower zoom levels are rendered directly from the charts in fused mode (not scaled from the next zoom level up),
+# chart windows wider or taller than this many pixels are reduced while reading
+fused_max_window = tilesystem.tile_size * 4
+
+# number of chart datasets a worker process keeps open in fused mode (least recently used ones are closed)
+fused_max_datasets = 32
+
+# settings above that may be changed at runtime
+executor.register_settings(__name__, ['resampling', 'gdal_resampling', 'fused_block_size', 'fused_max_window',
+                                      'fused_max_datasets'])
+
+
+def _tile_to_rgba(tile):
+    """returns a rendered MEM tile dataset as an rgba numpy uint8 array"""
+    bands = tile.RasterCount
+    size = tilesystem.tile_size
+    data = numpy.frombuffer(tile.ReadRaster(0, 0, size, size), dtype=numpy.uint8).reshape((bands, size, size))
+    rgba = numpy.empty((size, size, 4), dtype=numpy.uint8)
+    if bands < 3:  # gray or gray alpha
+        rgba[:, :, 0] = rgba[:, :, 1] = rgba[:, :, 2] = data[0]
+    else:
+        rgba[:, :, 0] = data[0]
+        rgba[:, :, 1] = data[1]
+        rgba[:, :, 2] = data[2]
+    if bands == 2 or bands == 4:
+        rgba[:, :, 3] = data[-1]
+    else:
+        rgba[:, :, 3] = 255
+    return rgba
+
+
+def _build_vrt_stack_helper(entry):
+    """helper method for executor.parallel_map
+       returns the vrt stack of a catalog entry and a dictionary of zoom: list of tile ranges
+       or None if the vrt stack could not be built
+    """
+    try:
+        map_stack = build_tile_vrt_for_map(entry['path'], cutline=entry['outline'])
+        ds = gdal.Open(stack_peek(map_stack), gdal.GA_ReadOnly)
+        if ds is None:
+            _cleanup_tmp_vrt_stack(map_stack)
+            return None
+
+        ranges = {}
+        for z in range(int(entry['min_zoom']), int(entry['max_zoom']) + 1):
+            ranges[z] = _tile_ranges(ds, z)
+        del ds
+        return map_stack, ranges
+
+    except BaseException as e:
+        traceback.print_exc()
+        logger.log(log_on, e)
+        return None
+
+
+def _in_ranges(ranges, x, y):
+    for tile_min_x, tile_max_x, tile_min_y, tile_max_y in ranges:
+        if tile_min_x <= x <= tile_max_x and tile_min_y <= y <= tile_max_y:
+            return True
+    return False
+
+
+class FusedBlockRender:
+    def __init__(self, charts, merged_dir, region_clip=None, unmerged_dirs=None):
+        """renders and merges blocks of destination tiles
+           charts - list of (vrt stack, {zoom: tile ranges}) in catalog order (lowest priority first)
+           merged_dir - merged zxy tile output directory
+           region_clip - tilecull.RegionClip, tiles outside of the region are not rendered
+           unmerged_dirs - list of per chart tile output directories (same order as charts) or None
+        """
+        self.charts = charts
+        self.merged_dir = merged_dir
+        self.region_clip = region_clip
+        self.unmerged_dirs = unmerged_dirs
+        self._datasets = collections.OrderedDict()
+
+    def __getstate__(self):
+        # gdal datasets can not be pickled (sent to worker processes)
+        state = self.__dict__.copy()
+        state['_datasets'] = collections.OrderedDict()
+        return state
+
+    def _dataset(self, i):
+        """opened dataset and transforms of a chart
+           the fused_max_datasets most recently used datasets are kept open while the worker process holds this state
+        """
+        if i in self._datasets:
+            self._datasets.move_to_end(i)
+        else:
+            ds = gdal.Open(stack_peek(self.charts[i][0]), gdal.GA_ReadOnly)
+            transform, inv_transform = _dataset_transforms(ds)
+            self._datasets[i] = ds, transform, inv_transform
+            while len(self._datasets) > max(1, fused_max_datasets):
+                self._datasets.popitem(last=False)  # dropping the last reference closes the dataset
+        return self._datasets[i]
+
+    @staticmethod
+    def _write(rgba, tile_dir, y):
+        if not os.path.isdir(tile_dir):
+            try:  # process race safety
+                os.makedirs(tile_dir)
+            except os.error:
+                pass
+        fileplace.save_image(Image.fromarray(rgba, 'RGBA'), os.path.join(tile_dir, '%s.png' % y))
+
+    def _render(self, i, z, x, y):
+        """returns the rgba numpy array of a chart's tile or None if the chart does not cover the tile"""
+        ds, transform, inv_transform = self._dataset(i)
+        tile = _render_tile(ds, transform, inv_transform, z, x, y, fused_max_window)
+        if tile is None:
+            return None
+
+        rgba = _tile_to_rgba(tile)
+        del tile
+
+        if self.unmerged_dirs is not None:
+            self._write(rgba, os.path.join(self.unmerged_dirs[i], str(z), str(x)), y)
+        return rgba
+
+    def __call__(self, task):
+        """renders a (zoom, block x, block y, [chart indexes highest priority first]) task
+           returns (the number of merged tiles written, list of (chart index, z, x, y, error) of failed tiles)
+           a tile is not written if one of its charts failed to render
+        """
+        count = 0
+        failures = []
+        try:
+            z, bx, by, chart_indexes = task
+            for x in range(bx * fused_block_size, (bx + 1) * fused_block_size):
+                for y in range(by * fused_block_size, (by + 1) * fused_block_size):
+                    if self.region_clip is not None and not self.region_clip.contains(z, x, y):
+                        continue
+
+                    acc = tilesmerge.AlphaOver()
+                    top = None
+                    failed = False
+                    for i in chart_indexes:
+                        if not _in_ranges(self.charts[i][1][z], x, y):
+                            continue
+
+                        try:
+                            rgba = self._render(i, z, x, y)
+                        except Exception as e:
+                            traceback.print_exc()
+                            logger.log(log_on, e)
+                            failures.append((i, z, x, y, str(e)))
+                            failed = True
+                            break
+
+                        if rgba is None:
+                            continue
+
+                        if top is None:
+                            top = rgba
+
+                        # the charts under an opaque tile would not show
+                        if acc.add(rgba) and self.unmerged_dirs is None:
+                            break
+
+                    if failed or acc.is_transparent():
+                        continue
+
+                    if acc.count > 1:
+                        top = acc.result()
+
+                    self._write(top, os.path.join(self.merged_dir, str(z), str(x)), y)
+                    count += 1
+
+        except KeyboardInterrupt:  # http://jessenoller.com/2009/01/08/multiprocessingpool-and-keyboardinterrupt/
+            print('got KeyboardInterrupt')
+            raise executor.KeyboardInterruptError()
+
+        return count, failures
+
+
+def _plan_blocks(charts):
+    """returns a sorted list of (zoom, block x, block y, [chart indexes highest priority first]) tasks"""
+    plan = {}
+    for i in range(len(charts) - 1, -1, -1):
+        for z, ranges in charts[i][1].items():
+            for tile_min_x, tile_max_x, tile_min_y, tile_max_y in ranges:
+                for bx in range(int(tile_min_x) // fused_block_size, int(tile_max_x) // fused_block_size + 1):
+                    for by in range(int(tile_min_y) // fused_block_size, int(tile_max_y) // fused_block_size + 1):
+                        indexes = plan.setdefault((z, bx, by), [])
+                        if len(indexes) == 0 or indexes[-1] != i:  # dateline wrapped ranges can share a block
+                            indexes.append(i)
+
+    return [(z, bx, by, indexes) for (z, bx, by), indexes in sorted(plan.items())]
+
+
+def build_merged_tiles_for_catalog(catalog_name, keep_unmerged=False):
+    """renders and merges the tiles of every map in a catalog in one pass
+       merged tiles output to config.merged_tile_dir + catalog_name (the same as tilesmerge.merge_catalog)
+       keep_unmerged - set to True to also write each map's tiles to config.unmerged_tile_dir (for debugging)
+       tiles outside of the region boundary (if the region has one) are not rendered
+
+       note: every zoom level is rendered directly from the maps rather than scaled down from the
+       next zoom level up, config.use_single_zoom_over_zoom is not used
+    """
+    catalog_name = catalog_name.upper()
+
+    entries = list(catalog.get_reader_for_region(catalog_name))
+    region_clip = tilecull.region_clip_for_region(catalog_name)
+
+    merge_dir = os.path.join(config.merged_tile_dir, catalog_name)
+    if os.path.isdir(merge_dir):
+        shutil.rmtree(merge_dir, ignore_errors=True)
+    os.makedirs(merge_dir)
+
+    unmerged_dirs = None
+    if keep_unmerged:
+        unmerged_dirs = [_map_tile_dir(catalog_name, entry) for entry in entries]
+
+    charts = executor.parallel_map(_build_vrt_stack_helper, entries, chunksize=1)
+
+    try:
+        for i in range(len(entries)):
+            if charts[i] is None:
+                raise Exception('could not build vrt for map: ' + entries[i]['path'])
+
+        tasks = _plan_blocks(charts)
+        print('rendering', len(tasks), 'blocks of tiles from', len(charts), 'maps into', merge_dir)
+        render = FusedBlockRender(charts, merge_dir, region_clip, unmerged_dirs)
+        results = executor.parallel_map(executor.call, tasks, state=render, chunksize=1)
+        failures = [failure for count, block_failures in results for failure in block_failures]
+        for i, z, x, y, error in failures[:10]:
+            print('failed to render tile %d/%d/%d of map %s: %s' % (z, x, y, entries[i]['path'], error))
+        if len(failures) > 0:
+            raise Exception('%d tiles failed to render for %s' % (len(failures), catalog_name))
+        print('wrote', sum([count for count, block_failures in results]), 'merged tiles for', catalog_name)
+    finally:
+        for chart in charts:
+            if chart is not None:
+                _cleanup_tmp_vrt_stack(chart[0])
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Persistent cache of tile transparency values shared by tilesmerge, verify and filler
+
+   There is one sqlite database per zxy tile directory in config.tile_cache_dir (see cache_path). Values are
+   keyed by the tile path relative to the tile directory along with the tile's file size and
+   modification time, so a tile that is re-rendered or rewritten is evaluated again.
+'''
+
+import hashlib
+import os
+import re
+import sqlite3
+
+from . import config
+
+
+def transparency(img):
+    """estimate transparency of an rgba image
+       returns 1 if fully opaque, 0 if fully transparent or -1 if partially transparent
+    """
+    (r, g, b, a) = img.split()
+    (a_min, a_max) = a.getextrema()  # get min/max values for alpha channel
+    return 1 if a_min == 255 else 0 if a_max == 0 else -1
+
+
+def cache_path(tile_dir):
+    """path to the cache database of a zxy tile directory
+       named after the directory's base name (readability) and a digest of its absolute path (uniqueness)
+    """
+    abs_path = os.path.abspath(tile_dir)
+    name = re.sub(r'\W+', '_', os.path.basename(abs_path)).strip('_')
+    digest = hashlib.sha1(abs_path.encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    return os.path.join(config.tile_cache_dir, '%s_%s.sqlite' % (name, digest))
+
+
+class TransparencyCache:
+    def __init__(self, tile_dir):
+        """transparency values for the tiles in tile_dir
+           tiles are referenced by their z/x/y.png path relative to tile_dir
+        """
+        self.tile_dir = tile_dir
+        self.path = cache_path(tile_dir)
+        self._db = None
+
+    def __getstate__(self):
+        # sqlite connections can not be pickled (sent to worker processes)
+        return {'tile_dir': self.tile_dir, 'path': self.path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._db = None
+
+    def _connection(self):
+        if self._db is None:
+            if not os.path.isdir(config.tile_cache_dir):
+                try:  # thread race safety
+                    os.makedirs(config.tile_cache_dir)
+                except os.error:
+                    pass
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute('CREATE TABLE IF NOT EXISTS transparency '
+                             '(tile TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, value INTEGER)')
+        return self._db
+
+    def _stat(self, tile):
+        st = os.stat(os.path.join(self.tile_dir, tile))
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, tile):
+        """cached transparency value of a tile or None"""
+        row = self._connection().execute('SELECT size, mtime, value FROM transparency WHERE tile=?',
+                                         (tile,)).fetchone()
+        if row is None:
+            return None
+
+        size, mtime, value = row
+        try:
+            if (size, mtime) == self._stat(tile):
+                return value
+        except OSError:
+            pass
+
+        return None
+
+    def get_all(self, tiles):
+        """returns a dictionary of tile: cached transparency value or None for a list of tiles"""
+        rows = {}
+        for tile, size, mtime, value in self._connection().execute('SELECT tile, size, mtime, value FROM transparency'):
+            rows[tile] = (size, mtime, value)
+
+        result = {}
+        for tile in tiles:
+            result[tile] = None
+            if tile in rows:
+                size, mtime, value = rows[tile]
+                try:
+                    if (size, mtime) == self._stat(tile):
+                        result[tile] = value
+                except OSError:
+                    pass
+
+        return result
+
+    def put(self, tile, value):
+        """caches a tile's transparency value, call commit() when done"""
+        size, mtime = self._stat(tile)
+        self._connection().execute('INSERT OR REPLACE INTO transparency VALUES (?, ?, ?, ?)',
+                                   (tile, size, mtime, value))
+
+    def put_all(self, items):
+        """caches a list of (tile, transparency value) and commits"""
+        for tile, value in items:
+            if value is not None:
+                try:
+                    self.put(tile, value)
+                except OSError:
+                    pass
+        self.commit()
+
+    def commit(self):
+        if self._db is not None:
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Plans which tiles a chart does not need to render because they will be completely covered
+   when merged.
+
+   tilesmerge.merge_catalog paints the charts of a catalog in catalog order (smallest scale first)
+   so a later chart's opaque tiles overwrite an earlier chart's tiles at the same zoom level.
+   A tile is hidden when it lies completely inside the union of the outlines of the later
+   (higher priority) charts that render the same zoom level.
+
+   An outline only bounds a chart's data, the chart can still render transparent inside of it (no data,
+   transparent insets). After the charts are rendered, confirm_hidden_tiles keeps a hidden tile only where
+   a higher priority chart rendered an opaque tile, the other hidden tiles have to be rendered after all.
+
+   Regions limited by a boundary polygon (see regions.boundary_for_region) are also clipped,
+   tiles that do not touch the boundary (plus a margin) are never rendered or merged.
+
+   Polygons use (latitude, longitude) coordinates like the region BOUNDARIES in
+   ukho_filter_list_generator and wl_filter_list_generator.
+'''
+
+import os
+
+from PIL import Image
+from shapely.geometry import Polygon, box
+from shapely.prepared import prep
+
+from . import catalog
+from . import executor
+from . import regions
+from . import tilesystem
+from .tilecache import TransparencyCache, transparency
+
+# a tile (grown by this many pixels on each side) must be inside the occluding outlines,
+# this absorbs the difference between cutline edges that are straight in chart pixels
+# and edges that are straight in latitude / longitude
+margin_px = 8
+
+# tiles within this many degrees of a region boundary are kept
+region_margin = 0.02
+
+
+def outline_polygon(outline):
+    """returns a polygon for a catalog outline (cutline) string or None if there is no usable outline
+
+       cutline string format example: 48.3,-123.2:48.5,-123.2:48.5,-122.7:48.3,-122.7:48.3,-123.2
+    """
+    if not outline:
+        return None
+
+    try:
+        points = [tuple(float(v) for v in latlng.split(',')) for latlng in outline.split(':')]
+    except ValueError:
+        return None
+
+    if len(points) < 3:
+        return None
+
+    # outlines crossing the dateline would become a polygon wrapping the whole globe
+    lngs = [lng for lat, lng in points]
+    if max(lngs) - min(lngs) > 180.:
+        return None
+
+    poly = Polygon(points)
+    if not poly.is_valid:
+        poly = poly.buffer(0)
+
+    if poly.is_empty:
+        return None
+
+    return poly
+
+
+def tile_polygon(z, x, y, margin=0):
+    """returns the (latitude, longitude) polygon of a zxy tile grown by margin pixels"""
+    px, py = tilesystem.tile_xy_to_pixel_xy(x, y)
+    north, west = tilesystem.pixel_xy_to_lat_lng(px - margin, py - margin, z)
+    south, east = tilesystem.pixel_xy_to_lat_lng(px + tilesystem.tile_size + margin,
+                                                 py + tilesystem.tile_size + margin, z)
+    return box(south, west, north, east)
+
+
+def tiles_for_polygon_bounds(poly, z):
+    """returns a list of (x, y) tiles covering the bounding box of a (latitude, longitude) polygon"""
+    min_lat, min_lng, max_lat, max_lng = poly.bounds
+    west, north = tilesystem.lat_lng_to_tile_xy(max_lat, min_lng, z)
+    east, south = tilesystem.lat_lng_to_tile_xy(min_lat, max_lng, z)
+    return [(x, y) for x in range(int(west), int(east) + 1) for y in range(int(north), int(south) + 1)]
+
+
+def _children(tiles):
+    for x, y in tiles:
+        xx = x << 1
+        yy = y << 1
+        yield xx, yy
+        yield xx + 1, yy
+        yield xx, yy + 1
+        yield xx + 1, yy + 1
+
+
+def _hidden_tiles(poly, min_zoom, max_zoom, occluders):
+    """hidden tiles of a single chart
+       occluders - dictionary of zoom: union of higher priority chart outlines
+
+       tilebuilder renders the lower zoom levels of a chart by scaling down the next zoom level
+       up, so a tile is only hidden when its parent tile (down to min_zoom) is hidden as well
+    """
+    hidden = {}
+    candidates = tiles_for_polygon_bounds(poly, min_zoom)
+    for z in range(min_zoom, max_zoom + 1):
+        if z not in occluders:
+            break
+
+        union = prep(occluders[z])
+        covered = set()
+        for x, y in candidates:
+            if union.contains(tile_polygon(z, x, y, margin_px)):
+                covered.add((x, y))
+
+        if len(covered) == 0:
+            break
+
+        hidden[z] = covered
+        candidates = _children(covered)
+
+    return hidden
+
+
+def _is_completely_hidden(poly, min_zoom, max_zoom, hidden):
+    if len(hidden) != max_zoom - min_zoom + 1:
+        return False
+
+    if len(hidden[min_zoom]) != len(tiles_for_polygon_bounds(poly, min_zoom)):
+        return False
+
+    for z in range(min_zoom + 1, max_zoom + 1):
+        if len(hidden[z]) != 4 * len(hidden[z - 1]):
+            return False
+
+    return True
+
+
+def plan_hidden_tiles(catalog_name):
+    """returns a dictionary of chart path: {zoom: set of (x, y) tiles} that each chart in a catalog
+       is guaranteed to lose to higher priority charts when the catalog is merged
+
+       charts without a usable outline are never culled and never hide other charts
+       charts that would be hidden completely are left alone so every chart still has tiles
+    """
+    reader = catalog.get_reader_for_region(catalog_name)
+    occluders = {}
+    plan = {}
+    hidden_count = 0
+
+    # walk the catalog from the highest priority (last) chart down
+    for entry in reversed(list(reader)):
+        poly = outline_polygon(entry['outline'])
+        if poly is None:
+            continue
+
+        min_zoom = int(entry['min_zoom'])
+        max_zoom = int(entry['max_zoom'])
+
+        hidden = _hidden_tiles(poly, min_zoom, max_zoom, occluders)
+        if len(hidden) > 0:
+            if _is_completely_hidden(poly, min_zoom, max_zoom, hidden):
+                print('chart is completely hidden, not culling', entry['path'])
+            else:
+                plan[entry['path']] = hidden
+                hidden_count += sum([len(ea) for ea in hidden.values()])
+
+        for z in range(min_zoom, max_zoom + 1):
+            if z in occluders:
+                occluders[z] = occluders[z].union(poly)
+            else:
+                occluders[z] = poly
+
+    print('%s hidden tiles will not be rendered for %s' % (hidden_count, catalog_name))
+    return plan
+
+
+class HiddenTileCheck:
+    def __init__(self, tile_dirs, region_clip=None):
+        """parallel_map state that confirms planned hidden tiles against the rendered tiles
+           tile_dirs - rendered zxy tile directory of each chart in catalog order (lowest priority first)
+           region_clip - RegionClip the charts were rendered with or None
+        """
+        self.tile_dirs = tile_dirs
+        self.region_clip = region_clip
+        self.caches = [TransparencyCache(tile_dir) for tile_dir in tile_dirs]
+
+    def _is_opaque(self, j, z, x, y):
+        tile = os.path.join(str(z), str(x), '%d.png' % y)
+        path = os.path.join(self.tile_dirs[j], tile)
+        if not os.path.isfile(path):
+            return False
+
+        transp = self.caches[j].get(tile)
+        if transp is None:
+            transp = transparency(Image.open(path).convert('RGBA'))
+        return transp == 1
+
+    def _is_covered(self, i, z, x, y):
+        if self.region_clip is not None and not self.region_clip.contains(z, x, y):
+            return True  # not rendered by any chart
+
+        for j in range(len(self.tile_dirs) - 1, i, -1):
+            if self._is_opaque(j, z, x, y):
+                return True
+        return False
+
+    def __call__(self, task):
+        """returns (chart index, confirmed hidden tiles) of a (chart index, {zoom: set of (x, y)}) task
+           a tile stays hidden if a higher priority chart rendered an opaque tile over it and its parent tile
+           stays hidden (lower zoom levels are scaled down from the next zoom level up)
+        """
+        i, hidden = task
+        confirmed = {}
+        for z in sorted(hidden):
+            parents = confirmed.get(z - 1)
+            covered = set([(x, y) for x, y in hidden[z] if (parents is None or (x >> 1, y >> 1) in parents) and
+                           self._is_covered(i, z, x, y)])
+            if len(covered) == 0:
+                break
+            confirmed[z] = covered
+
+        return i, confirmed
+
+
+def confirm_hidden_tiles(tile_dirs, hidden_tiles, region_clip=None):
+    """confirms the hidden tiles of plan_hidden_tiles after the charts were rendered without them
+       tile_dirs - rendered zxy tile directory of each chart in catalog order (lowest priority first)
+       hidden_tiles - {zoom: set of (x, y)} hidden tiles (or None) of each chart (same order as tile_dirs)
+       region_clip - RegionClip the charts were rendered with or None
+       returns a dictionary of chart index: confirmed hidden tiles for the charts that have to be rendered again
+       with only the confirmed hidden tiles left out
+    """
+    tasks = [(i, hidden) for i, hidden in enumerate(hidden_tiles) if hidden]
+    rerender = {}
+    unconfirmed_count = 0
+    for i, confirmed in executor.parallel_map(executor.call, tasks, state=HiddenTileCheck(tile_dirs, region_clip)):
+        unconfirmed = sum([len(ea) for ea in hidden_tiles[i].values()]) - sum([len(ea) for ea in confirmed.values()])
+        if unconfirmed > 0:
+            rerender[i] = confirmed
+            unconfirmed_count += unconfirmed
+
+    print('%s hidden tiles are not covered by an opaque tile, rendering %s charts again' %
+          (unconfirmed_count, len(rerender)))
+    return rerender
+
+
+class RegionClip:
+    def __init__(self, boundary, margin=region_margin):
+        """answers if a tile touches a (latitude, longitude) region boundary polygon grown by margin degrees
+           a tile outside of the boundary means all of the tiles under it at higher zoom levels are outside too
+        """
+        self.boundary = boundary.buffer(margin)
+        self._prepared = None
+        self._states = {}
+
+    def __getstate__(self):
+        # prepared geometries can not be pickled (sent to worker processes)
+        return {'boundary': self.boundary}
+
+    def __setstate__(self, state):
+        self.boundary = state['boundary']
+        self._prepared = None
+        self._states = {}
+
+    _OUTSIDE, _EDGE, _INSIDE = range(3)
+
+    def _tile_state(self, z, x, y, parent_state):
+        if parent_state != RegionClip._EDGE:
+            return parent_state
+
+        if self._prepared is None:
+            self._prepared = prep(self.boundary)
+
+        tile = tile_polygon(z, x, y)
+        if not self._prepared.intersects(tile):
+            return RegionClip._OUTSIDE
+        if self._prepared.contains(tile):
+            return RegionClip._INSIDE
+        return RegionClip._EDGE
+
+    def _parent_state(self, z, x, y):
+        if z == 0:
+            return RegionClip._EDGE
+
+        key = (z - 1, x >> 1, y >> 1)
+        state = self._states.get(key)
+        if state is None:
+            state = self._tile_state(z - 1, x >> 1, y >> 1, self._parent_state(*key))
+            self._states[key] = state
+
+        return state
+
+    def contains(self, z, x, y):
+        """returns if the zxy tile touches the region"""
+        z = int(z)
+        x = int(x)
+        y = int(y)
+        return self._tile_state(z, x, y, self._parent_state(z, x, y)) != RegionClip._OUTSIDE
+
+
+def region_clip_for_region(region):
+    """returns a RegionClip for a region or None if the region is not limited by a boundary"""
+    boundary = regions.boundary_for_region(region)
+    if boundary is None:
+        return None
+
+    return RegionClip(boundary)
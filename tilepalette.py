@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Shared (region wide) tile palettes for tiles_opt
+
+   Charts use a small set of colors across a whole region, so one palette is built from a sample
+   of the region's tiles (or one palette per zoom band) and every tile is mapped to it with a
+   lookup table instead of being quantized on its own.
+
+   Palette entries with transparency are ordered first so a tile's tRNS chunk only lists those,
+   and each tile is written with only the palette entries it uses (smaller PLTE, fewer bits per pixel).
+'''
+
+import bisect
+import hashlib
+import random
+
+import numpy
+from PIL import Image, features
+
+# number of tiles sampled for each palette
+sample_tiles = 512
+
+# every nth pixel (in x and y) of a sampled tile is used to build the palette
+sample_step = 4
+
+# bits of red, green, blue and alpha used to index the lookup table
+lut_bits = (5, 5, 5, 4)
+
+
+def _quantize_method():
+    _quantize = getattr(Image, 'Quantize', Image)
+    if features.check('libimagequant'):
+        return _quantize.LIBIMAGEQUANT
+    return _quantize.FASTOCTREE  # median cut does not support rgba
+
+
+def _clear_transparent(rgba):
+    """sets the color of fully transparent pixels to 0 so they are all the same color"""
+    rgba[rgba[:, :, 3] == 0] = 0
+    return rgba
+
+
+def _lut_index(rgba):
+    r_bits, g_bits, b_bits, a_bits = lut_bits
+    r = rgba[..., 0].astype(numpy.uint32) >> (8 - r_bits)
+    g = rgba[..., 1].astype(numpy.uint32) >> (8 - g_bits)
+    b = rgba[..., 2].astype(numpy.uint32) >> (8 - b_bits)
+    a = rgba[..., 3].astype(numpy.uint32) >> (8 - a_bits)
+    return (((r << g_bits | g) << b_bits | b) << a_bits) | a
+
+
+def _color_key(rgba):
+    rgba = rgba.astype(numpy.uint32)
+    return rgba[..., 0] << 24 | rgba[..., 1] << 16 | rgba[..., 2] << 8 | rgba[..., 3]
+
+
+class SharedPalette:
+    def __init__(self, colors):
+        """a palette of up to 256 rgba colors (numpy uint8 array of shape (n, 4)) with a lookup table
+           that maps any rgba color to the nearest palette entry
+        """
+        colors = numpy.asarray(colors, dtype=numpy.uint8)
+        # entries with transparency first
+        order = numpy.argsort(colors[:, 3] == 255, kind='stable')
+        self.colors = colors[order]
+        self.translucent = int(numpy.count_nonzero(self.colors[:, 3] < 255))
+        self.digest = hashlib.sha1(self.colors.tobytes() + bytes(lut_bits)).hexdigest()
+        self.lut = self._build_lut()
+
+        # palette colors are always mapped to themselves (they can share a lookup table cell)
+        keys = _color_key(self.colors)
+        self._key_order = numpy.argsort(keys)
+        self._keys = keys[self._key_order]
+
+    def _build_lut(self):
+        """nearest palette entry for the center of each lookup table cell"""
+        size = 1 << sum(lut_bits)
+        index = numpy.arange(size, dtype=numpy.uint32)
+        cells = numpy.empty((size, 4), dtype=numpy.float32)
+        shift = 0
+        for channel in (3, 2, 1, 0):
+            bits = lut_bits[channel]
+            value = (index >> shift) & ((1 << bits) - 1)
+            # center of the cell, but keep 0 and 255 (transparent and opaque) exact
+            cells[:, channel] = numpy.minimum(255, (value << (8 - bits)) + ((1 << (8 - bits)) >> 1))
+            cells[value == 0, channel] = 0
+            cells[value == (1 << bits) - 1, channel] = 255
+            shift += bits
+
+        palette = self.colors.astype(numpy.float32)
+        lut = numpy.empty(size, dtype=numpy.uint8)
+        chunk = 1 << 12
+        for i in range(0, size, chunk):
+            # alpha weighs more than color so transparency is not lost
+            diff = cells[i:i + chunk, None, :] - palette[None, :, :]
+            diff[:, :, 3] *= 2.
+            lut[i:i + chunk] = numpy.argmin((diff * diff).sum(axis=2), axis=1)
+        return lut
+
+    def map(self, img):
+        """returns a palette (P mode) PIL image of an image using only the palette entries it needs"""
+        rgba = _clear_transparent(numpy.array(img.convert('RGBA')))
+        indexes = self.lut[_lut_index(rgba)]
+
+        keys = _color_key(rgba)
+        found = numpy.minimum(numpy.searchsorted(self._keys, keys), len(self._keys) - 1)
+        exact = self._keys[found] == keys
+        indexes[exact] = self._key_order[found[exact]]
+
+        # trim the palette to the entries used, keeping their order (entries with transparency first)
+        used = numpy.flatnonzero(numpy.bincount(indexes.ravel(), minlength=len(self.colors)))
+        remap = numpy.zeros(len(self.colors), dtype=numpy.uint8)
+        remap[used] = numpy.arange(len(used), dtype=numpy.uint8)
+
+        out = Image.fromarray(remap[indexes], 'P')
+        colors = self.colors[used]
+        out.putpalette(colors[:, :3].tobytes())
+        translucent = int(numpy.count_nonzero(used < self.translucent))
+        if translucent > 0:
+            out.info['transparency'] = colors[:translucent, 3].tobytes()
+        return out
+
+    def save(self, img, dst):
+        out = self.map(img)
+        out.save(dst, optimize=True, transparency=out.info.get('transparency'))
+
+
+def build_palette(tile_paths, colors=256):
+    """builds a SharedPalette from a random sample of tile_paths"""
+    if len(tile_paths) > sample_tiles:
+        tile_paths = random.Random(0).sample(tile_paths, sample_tiles)
+
+    samples = []
+    for path in tile_paths:
+        rgba = numpy.asarray(Image.open(path).convert('RGBA'))
+        samples.append(rgba[::sample_step, ::sample_step].reshape(-1, 4))
+    pixels = _clear_transparent(numpy.concatenate(samples).reshape(-1, 1, 4))
+
+    unique = numpy.unique(pixels.reshape(-1, 4), axis=0)
+    if len(unique) <= colors:
+        return SharedPalette(unique)
+
+    q = Image.fromarray(pixels, 'RGBA').quantize(colors=colors, method=_quantize_method())
+    unique = numpy.unique(numpy.asarray(q.convert('RGBA')).reshape(-1, 4), axis=0)
+    return SharedPalette(unique)
+
+
+def zoom_band(zoom_bands, z):
+    """index of the zoom band of zoom level z
+       zoom_bands - sorted list of the first zoom level of each band after the first e.g. [10, 14]
+    """
+    return bisect.bisect_right(zoom_bands, z)
+
+
+def build_palettes(tile_paths, zoom_bands=(), colors=256):
+    """builds a dictionary of zoom band index: SharedPalette
+       tile_paths - list of (zoom, path) of the tiles to sample from
+    """
+    bands = {}
+    for z, path in tile_paths:
+        bands.setdefault(zoom_band(zoom_bands, z), []).append(path)
+
+    palettes = {}
+    for band, paths in bands.items():
+        palettes[band] = build_palette(paths, colors)
+        print('band', band, 'palette has', len(palettes[band].colors), 'colors')
+    return palettes
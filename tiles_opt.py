@@ -26,18 +26,63 @@ import re
 import shutil
 import logging
 import itertools
+import hashlib
+import io
 import sys
 import os
-from .config import png_nq_binary
+from .config import png_nq_binary, png_quantizer, tile_cache_dir, tile_opt_cache, opt_min_psnr
+from . import executor
+from . import fileplace
+from . import tilepalette
 from subprocess import *
-from .tilesystem import tile_size
 
-from PIL import Image
+import numpy
+from PIL import Image, features
 
 
 tick_rate = 50
 tick_count = 0
 
+# png quantizer backends (config.png_quantizer)
+QUANTIZER_PIL = 'pil'  # in process with Pillow (libimagequant if Pillow was built with it)
+QUANTIZER_PNGNQ = 'pngnq'  # external pngnq binary (config.png_nq_binary)
+QUANTIZER_SHARED = 'shared'  # one palette for the whole directory (tilepalette)
+
+# shared palette quantizer: first zoom level of each zoom band after the first, each band gets its own palette
+# e.g. [10, 14] for zoom levels below 10, 10 to 13 and 14 and above
+palette_zoom_bands = []
+
+# number of palette colors
+png_colors = 256
+
+# tile output format policies (config.opt_policies)
+POLICY_PNG8 = 'png8'  # palette png (config.png_quantizer)
+POLICY_PNG32 = 'png32'  # lossless rgba png
+POLICY_JPEG = 'jpeg'  # jpeg for opaque tiles, png8 for tiles with transparency
+POLICY_WEBP = 'webp'  # webp (lossy, with transparency)
+POLICY_AUTO = 'auto'  # smallest of png8, jpeg or png32 with a psnr of config.opt_min_psnr, png8 with transparency
+
+# file extensions of each tile format
+_extensions = {POLICY_PNG8: '.png', POLICY_PNG32: '.png', POLICY_JPEG: '.jpg', POLICY_WEBP: '.webp'}
+
+# extensions a policy may write
+policy_extensions = {POLICY_PNG8: ('.png',),
+                     POLICY_PNG32: ('.png',),
+                     POLICY_JPEG: ('.jpg', '.png'),
+                     POLICY_WEBP: ('.webp',),
+                     POLICY_AUTO: ('.png', '.jpg')}
+
+jpeg_quality = 75
+webp_quality = 80
+
+# number of files optimized per worker task
+batch_size = 64
+
+# settings above (and the config values imported at the top) that may be changed at runtime
+executor.register_settings(__name__, ['palette_zoom_bands', 'png_colors', 'jpeg_quality', 'webp_quality', 'batch_size',
+                                      'png_nq_binary', 'png_quantizer', 'tile_cache_dir', 'tile_opt_cache',
+                                      'opt_min_psnr'])
+
 try:
     import multiprocessing  # available in python 2.6 and above
 
@@ -56,17 +101,15 @@ def set_nothreads():
     multiprocessing = None
 
 
-def parallel_map(func, iterable):
+def parallel_map(func, iterable, state=None):
+    """see executor.parallel_map"""
     if multiprocessing is None or len(iterable) < 2:
-        return list(map(func, iterable))
+        if state is None:
+            return list(map(func, iterable))
+        return [func(state, item) for item in iterable]
     else:
-        # map in parallel
-        mp_pool = multiprocessing.Pool()  # multiprocessing pool
-        res = mp_pool.map(func, iterable)
-        # wait for threads to finish
-        mp_pool.close()
-        mp_pool.join()
-    return res
+        # map in parallel (executor.shared_pool if there is one)
+        return executor.parallel_map(func, iterable, state)
 
 
 def ld(*parms):
@@ -155,11 +198,50 @@ def counter():
         return False
 
 
-def optimize_png(src, dst, dpath):
-    'optimize png using pngnq utility'
+def _quantize_method(img):
+    _quantize = getattr(Image, 'Quantize', Image)
+    if features.check('libimagequant'):
+        return _quantize.LIBIMAGEQUANT
+    if img.mode == 'RGB':
+        return _quantize.MEDIANCUT
+    return _quantize.FASTOCTREE  # median cut does not support rgba
+
+
+def _png8_image(img, palette=None):
+    """returns a palette (P mode) image of img quantized in process"""
+    if palette is not None:
+        return palette.map(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGBA')
+        if img.getextrema()[3][0] == 255:  # opaque, no need for a palette with transparency
+            img = img.convert('RGB')
+    return img.quantize(colors=png_colors, method=_quantize_method(img))
+
+
+def quantize_png(src, dst):
+    'optimize png by quantizing it to a palette in process'
+    _png8_image(Image.open(src)).save(dst, optimize=True)
+
+
+def optimize_pngs(srcs, dpath):
+    'optimize pngs (of the same destination directory) using pngnq utility'
+    srcs = [src for src in srcs if not os.path.basename(src).startswith('.')]
+    if len(srcs) > 0:
+        command([png_nq_binary, '-s1', '-g2.2', '-n', str(png_colors), '-e', '.png', '-d', dpath] + srcs)
+
+
+def optimize_png(src, dst, dpath, palette=None):
+    'optimize png using the config.png_quantizer backend'
     png_tile = os.path.basename(src)
     if not png_tile.startswith('.'):
-        command([png_nq_binary, '-s1', '-g2.2', '-n', str(tile_size), '-e', '.png', '-d', dpath, src])
+        if png_quantizer == QUANTIZER_PNGNQ:
+            optimize_pngs([src], dpath)
+        elif png_quantizer == QUANTIZER_SHARED and palette is not None:
+            palette.save(Image.open(src), dst)
+        elif png_quantizer in (QUANTIZER_PIL, QUANTIZER_SHARED):
+            quantize_png(src, dst)
+        else:
+            raise Exception('unknown png quantizer: %s' % png_quantizer)
 
 
 def to_jpeg(src, dst, dpath):
@@ -169,29 +251,209 @@ def to_jpeg(src, dst, dpath):
     img.save(dst_jpg, optimize=True, quality=75)
 
 
+def encode(img, fmt, palette=None):
+    """returns the bytes of an image encoded as fmt (POLICY_PNG8, POLICY_PNG32, POLICY_JPEG or POLICY_WEBP)"""
+    buf = io.BytesIO()
+    if fmt == POLICY_PNG8:
+        _png8_image(img, palette).save(buf, 'PNG', optimize=True)
+    elif fmt == POLICY_PNG32:
+        img.save(buf, 'PNG', optimize=True)
+    elif fmt == POLICY_JPEG:
+        img.convert('RGB').save(buf, 'JPEG', optimize=True, quality=jpeg_quality)
+    elif fmt == POLICY_WEBP:
+        img.save(buf, 'WEBP', quality=webp_quality, method=4)
+    else:
+        raise Exception('unknown tile format: %s' % fmt)
+    return buf.getvalue()
+
+
+def psnr(img, data):
+    """peak signal to noise ratio (dB) of the color of encoded image data compared to an rgba image"""
+    a = numpy.asarray(img.convert('RGBA'), dtype=numpy.float32)[:, :, :3]
+    b = numpy.asarray(Image.open(io.BytesIO(data)).convert('RGBA'), dtype=numpy.float32)[:, :, :3]
+    mse = numpy.mean((a - b) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 10. * numpy.log10(255. ** 2 / mse)
+
+
+def encode_tile(src, policy, palette=None):
+    """encodes a png tile according to an output format policy
+       returns tuple of file extension, bytes
+    """
+    img = Image.open(src).convert('RGBA')
+    opaque = img.getextrema()[3][0] == 255
+
+    if policy in (POLICY_PNG32, POLICY_WEBP):
+        fmt = policy
+    elif policy == POLICY_PNG8 or not opaque:
+        fmt = POLICY_PNG8
+    elif policy == POLICY_JPEG:
+        fmt = POLICY_JPEG
+    elif policy == POLICY_AUTO:
+        # smallest lossy encoding that is good enough, or lossless
+        best = encode(img, POLICY_PNG32)
+        fmt = POLICY_PNG32
+        for candidate in (POLICY_PNG8, POLICY_JPEG):
+            data = encode(img, candidate, palette)
+            if len(data) < len(best) and psnr(img, data) >= opt_min_psnr:
+                best = data
+                fmt = candidate
+        return _extensions[fmt], best
+    else:
+        raise Exception('unknown tile format policy: %s' % policy)
+
+    return _extensions[fmt], encode(img, fmt, palette)
+
+
 class KeyboardInterruptError(Exception): pass
 
 
-def proc_file(f):
-    try:
-        src = os.path.join(src_dir, f)
-        dst = os.path.join(dst_dir, f)
-        dpath = os.path.split(dst)[0]
-        if not os.path.exists(dpath):
+def _make_dirs(dpath):
+    if not os.path.exists(dpath):
+        try:  # process race safety
             os.makedirs(dpath)
-        if f.lower().endswith('.png'):
-            optimize_png(src, dst, dpath)
-        else:
-            shutil.copy(src, dpath)
-        counter()
+        except os.error:
+            pass
+
+
+def _tile_zoom(f):
+    """zoom level of a ./z/x/y.png path or None"""
+    parts = path2list(f)
+    if len(parts) >= 4 and parts[-4].isdigit():
+        return int(parts[-4])
+    return None
+
+
+def _palette_for(palettes, f):
+    if palettes is None:
+        return None
+    z = _tile_zoom(f)
+    if z is None:
+        return None
+    return palettes.get(tilepalette.zoom_band(palette_zoom_bands, z))
+
+
+def _settings_key(policy, palette=None):
+    """key of the optimizer settings, cached optimized tiles are only reused with the same settings"""
+    settings = [policy, png_quantizer, str(png_colors)]
+    if png_quantizer == QUANTIZER_PNGNQ and policy == POLICY_PNG8:
+        settings.append(png_nq_binary)
+    else:
+        settings += [Image.__version__, str(features.check('libimagequant'))]
+    if policy != POLICY_PNG8:
+        settings += [str(jpeg_quality), str(webp_quality), str(opt_min_psnr)]
+    if palette is not None:
+        settings.append(palette.digest)
+    return hashlib.sha1(' '.join(settings).encode()).hexdigest()[:16]
+
+
+def _cache_path(src, policy, palette=None):
+    """path (without extension) of the optimized tile for the content of src in the optimize cache"""
+    with open(src, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return os.path.join(tile_cache_dir, 'opt', _settings_key(policy, palette), digest[:2], digest)
+
+
+def _cache_get(cached, policy):
+    """cached optimized tile path or None"""
+    for ext in policy_extensions[policy]:
+        if os.path.isfile(cached + ext):
+            return cached + ext
+    return None
+
+
+def _cache_put(dst, cached):
+    if cached is not None and os.path.isfile(dst):
+        _make_dirs(os.path.dirname(cached))
+        fileplace.place(dst, cached + os.path.splitext(dst)[1])
+
+
+def proc_file(state, f):
+    """optimizes a file
+       state - tuple of source directory, destination directory, shared palettes (or None), format policy
+       f - path of the file relative to the source directory
+       returns tuple of optimize cache hits, misses, dictionary of zoom: [source bytes, optimized bytes]
+    """
+    return proc_batch(state, [f])
+
+
+def proc_batch(state, files):
+    """optimizes a batch of files
+       state - tuple of source directory, destination directory, shared palettes (or None), format policy
+       files - list of paths of the files relative to the source directory
+       returns tuple of optimize cache hits, misses, dictionary of zoom: [source bytes, optimized bytes]
+    """
+    try:
+        src_dir, dst_dir, palettes, policy = state
+        hits = 0
+        misses = 0
+        written = []  # (zoom, source, destination)
+        pngnq_batches = {}  # destination directory: [(source png, destination png, cache path)]
+        for f in files:
+            src = os.path.join(src_dir, f)
+            dst = os.path.join(dst_dir, f)
+            dpath = os.path.split(dst)[0]
+            _make_dirs(dpath)
+            if f.lower().endswith('.png') and not os.path.basename(f).startswith('.'):
+                palette = _palette_for(palettes, f)
+                cached = None
+                if tile_opt_cache:
+                    cached = _cache_path(src, policy, palette)
+                    hit = _cache_get(cached, policy)
+                    if hit is not None:
+                        dst = os.path.splitext(dst)[0] + os.path.splitext(hit)[1]
+                        fileplace.place(hit, dst)
+                        written.append((_tile_zoom(f), src, dst))
+                        hits += 1
+                        counter()
+                        continue
+                    misses += 1
+
+                if policy != POLICY_PNG8:
+                    ext, data = encode_tile(src, policy, palette)
+                    dst = os.path.splitext(dst)[0] + ext
+                    fileplace.write_bytes(data, dst)
+                    _cache_put(dst, cached)
+                elif png_quantizer == QUANTIZER_PNGNQ:
+                    # one pngnq process per destination directory
+                    pngnq_batches.setdefault(dpath, []).append((src, dst, cached))
+                else:
+                    optimize_png(src, dst, dpath, palette)
+                    _cache_put(dst, cached)
+                written.append((_tile_zoom(f), src, dst))
+            elif not f.lower().endswith('.png'):
+                shutil.copy(src, dpath)
+            counter()
+
+        for dpath, items in pngnq_batches.items():
+            optimize_pngs([src for src, dst, cached in items], dpath)
+            for src, dst, cached in items:
+                _cache_put(dst, cached)
+
+        zoom_bytes = {}
+        for z, src, dst in written:
+            if z is not None and os.path.isfile(dst):
+                sizes = zoom_bytes.setdefault(z, [0, 0])
+                sizes[0] += os.path.getsize(src)
+                sizes[1] += os.path.getsize(dst)
+
+        return hits, misses, zoom_bytes
     except KeyboardInterrupt:  # http://jessenoller.com/2009/01/08/multiprocessingpool-and-keyboardinterrupt/
         pf('got KeyboardInterrupt')
         raise KeyboardInterruptError()
 
 
-def optimize_dir(directory):
-    global src_dir
-    global dst_dir
+def optimize_dir(directory, policy=POLICY_PNG8):
+    """optimizes the tiles of directory into directory + .opt
+       policy - tile output format policy (POLICY_PNG8, POLICY_PNG32, POLICY_JPEG, POLICY_WEBP or POLICY_AUTO)
+       returns tuple of optimize cache hits, misses
+
+       note: jpeg and webp tiles are written with a .jpg or .webp extension in place of .png
+    """
+    if policy not in policy_extensions:
+        raise Exception('unknown tile format policy: %s' % policy)
+
     src_dir = directory
     dst_dir = src_dir + '.opt'
     pf('%s -> %s ' % (src_dir, dst_dir), end='')
@@ -208,7 +470,34 @@ def optimize_dir(directory):
     finally:
         os.chdir(cwd)
 
-    parallel_map(proc_file, src_lst)
+    # first pass of the shared palette quantizer, build the palettes from a sample of the tiles
+    palettes = None
+    if png_quantizer == QUANTIZER_SHARED:
+        tiles = [(_tile_zoom(f), os.path.join(src_dir, f)) for f in src_lst
+                 if f.lower().endswith('.png') and _tile_zoom(f) is not None]
+        palettes = tilepalette.build_palettes(tiles, palette_zoom_bands, png_colors)
+
+    # files of the same directory are listed together so batches share destination directories
+    batches = [src_lst[i:i + batch_size] for i in range(0, len(src_lst), batch_size)]
+    results = parallel_map(proc_batch, batches, state=(src_dir, dst_dir, palettes, policy))
+
+    hits = sum([h for h, m, zb in results])
+    misses = sum([m for h, m, zb in results])
+    if hits + misses > 0:
+        pf('\noptimize cache: %d hits, %d misses (%.1f%% hit rate)' % (hits, misses, 100. * hits / (hits + misses)))
+
+    zoom_bytes = {}
+    for h, m, zb in results:
+        for z, (src_bytes, dst_bytes) in zb.items():
+            sizes = zoom_bytes.setdefault(z, [0, 0])
+            sizes[0] += src_bytes
+            sizes[1] += dst_bytes
+    pf('\n%s bytes saved per zoom level:' % policy)
+    for z in sorted(zoom_bytes):
+        src_bytes, dst_bytes = zoom_bytes[z]
+        pf('  z%d: %d -> %d (%d saved)' % (z, src_bytes, dst_bytes, src_bytes - dst_bytes))
+
+    return hits, misses
 
 
 if __name__ == '__main__':
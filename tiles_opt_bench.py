@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Benchmarks the tile encoders of tiles_opt on a sample of tiles from a (merged) zxy tile directory
+
+   Every backend encodes every sampled tile, reported per backend (means per tile):
+   encode time, decode time, bytes, psnr and ssim (of the tile composited over white, so
+   transparency errors count).
+
+   usage: python tiles_opt_bench.py <tile directory> <optional sample size> <optional output json path>
+
+   The json output (sorted keys, one backend per key) is meant to be kept and diffed between releases.
+'''
+
+import inspect
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+from PIL import Image, features
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+from mxmcc import config
+from mxmcc import executor
+from mxmcc import tiles_opt
+from mxmcc import tilepalette
+
+sample_size = 200
+
+zlib_levels = (1, 6, 9)
+jpeg_qualities = (50, 75, 90)
+webp_qualities = (75, 90)
+
+
+def _png8_pil(img, src, palette):
+    return tiles_opt.encode(img, tiles_opt.POLICY_PNG8)
+
+
+def _png8_shared(img, src, palette):
+    return tiles_opt.encode(img, tiles_opt.POLICY_PNG8, palette)
+
+
+def _png8_pngnq(img, src, palette):
+    tmp_dir = tempfile.mkdtemp(prefix='mxmcc_bench_')
+    try:
+        subprocess.check_call([config.png_nq_binary, '-s1', '-g2.2', '-n', str(tiles_opt.png_colors),
+                               '-e', '.png', '-d', tmp_dir, src], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(os.path.join(tmp_dir, os.path.basename(src)), 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _png32(level):
+    def png32(img, src, palette):
+        buf = io.BytesIO()
+        img.save(buf, 'PNG', compress_level=level)
+        return buf.getvalue()
+    return png32
+
+
+def _jpeg(quality):
+    def jpeg(img, src, palette):
+        if img.getextrema()[3][0] != 255:  # jpeg has no transparency
+            return None
+        buf = io.BytesIO()
+        img.convert('RGB').save(buf, 'JPEG', optimize=True, quality=quality)
+        return buf.getvalue()
+    return jpeg
+
+
+def _webp(quality):
+    def webp(img, src, palette):
+        buf = io.BytesIO()
+        if quality is None:
+            img.save(buf, 'WEBP', lossless=True)
+        else:
+            img.save(buf, 'WEBP', quality=quality, method=4)
+        return buf.getvalue()
+    return webp
+
+
+def backends():
+    """dictionary of backend name: encoder function(rgba image, source path, shared palette)
+       returns bytes or None when the backend does not apply to the tile
+    """
+    result = {'png8-pil': _png8_pil, 'png8-shared': _png8_shared}
+    if shutil.which(config.png_nq_binary) is not None:
+        result['png8-pngnq'] = _png8_pngnq
+    for level in zlib_levels:
+        result['png32-z%d' % level] = _png32(level)
+    for quality in jpeg_qualities:
+        result['jpeg-q%d' % quality] = _jpeg(quality)
+    if features.check('webp'):
+        for quality in webp_qualities:
+            result['webp-q%d' % quality] = _webp(quality)
+        result['webp-lossless'] = _webp(None)
+    return result
+
+
+def _over_white(img):
+    rgba = numpy.asarray(img.convert('RGBA'), dtype=numpy.float64)
+    alpha = rgba[:, :, 3:] / 255.
+    return rgba[:, :, :3] * alpha + 255. * (1. - alpha)
+
+
+def _box_mean(a, size=7):
+    """mean of each size x size window (valid windows only)"""
+    c = numpy.cumsum(numpy.cumsum(numpy.pad(a, ((1, 0), (1, 0))), axis=0), axis=1)
+    return (c[size:, size:] - c[:-size, size:] - c[size:, :-size] + c[:-size, :-size]) / (size * size)
+
+
+def ssim(a, b):
+    """mean structural similarity of the luma of two rgb float arrays"""
+    ya = a.dot([.299, .587, .114])
+    yb = b.dot([.299, .587, .114])
+    c1 = (.01 * 255.) ** 2
+    c2 = (.03 * 255.) ** 2
+    mu_a = _box_mean(ya)
+    mu_b = _box_mean(yb)
+    var_a = _box_mean(ya * ya) - mu_a * mu_a
+    var_b = _box_mean(yb * yb) - mu_b * mu_b
+    cov = _box_mean(ya * yb) - mu_a * mu_b
+    s = ((2. * mu_a * mu_b + c1) * (2. * cov + c2)) / ((mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2))
+    return float(s.mean())
+
+
+def psnr(a, b):
+    mse = numpy.mean((a - b) ** 2)
+    if mse == 0:
+        return 100.  # identical (json has no infinity)
+    return float(10. * numpy.log10(255. ** 2 / mse))
+
+
+def bench_tile(palette, src):
+    """runs every backend on a tile
+       returns dictionary of backend name: (encode seconds, decode seconds, bytes, psnr, ssim) or None
+    """
+    img = Image.open(src).convert('RGBA')
+    reference = _over_white(img)
+    result = {}
+    for name, encoder in sorted(backends().items()):
+        t = time.perf_counter()
+        data = encoder(img, src, palette)
+        encode_time = time.perf_counter() - t
+        if data is None:
+            result[name] = None
+            continue
+
+        t = time.perf_counter()
+        decoded = Image.open(io.BytesIO(data))
+        decoded.load()
+        decode_time = time.perf_counter() - t
+
+        decoded = _over_white(decoded)
+        result[name] = (encode_time, decode_time, len(data), psnr(reference, decoded), ssim(reference, decoded))
+    return result
+
+
+def sample_tiles(tile_dir, size=sample_size):
+    """random (repeatable) sample of the png tiles of a zxy tile directory"""
+    tiles = sorted(os.path.join(tile_dir, t) for t in _tile_list(tile_dir))
+    if len(tiles) > size:
+        tiles = random.Random(0).sample(tiles, size)
+    return tiles
+
+
+def _tile_list(tile_dir):
+    tiles = []
+    for path, dirs, files in os.walk(tile_dir):
+        for f in files:
+            if f.lower().endswith('.png') and not f.startswith('.'):
+                tiles.append(os.path.relpath(os.path.join(path, f), tile_dir))
+    return tiles
+
+
+def run(tile_dir, size=sample_size, out_path=None):
+    """benchmarks the backends on a sample of tile_dir, prints a table and optionally writes json to out_path
+       returns the report dictionary
+    """
+    tiles = sample_tiles(tile_dir, size)
+    if len(tiles) == 0:
+        raise Exception('no png tiles in %s' % tile_dir)
+
+    palette = tilepalette.build_palette(tiles, tiles_opt.png_colors)
+    results = executor.parallel_map(bench_tile, tiles, state=palette)
+
+    report = {'tile_dir': os.path.abspath(tile_dir),
+              'sample': len(tiles),
+              'pillow': Image.__version__,
+              'libimagequant': features.check('libimagequant'),
+              'backends': {}}
+
+    for name in sorted(backends()):
+        rows = [r[name] for r in results if r.get(name) is not None]
+        entry = {'tiles': len(rows), 'skipped': len(results) - len(rows)}
+        if len(rows) > 0:
+            encode_time, decode_time, size_bytes, tile_psnr, tile_ssim = [numpy.mean(c) for c in zip(*rows)]
+            entry.update({'encode_ms': round(1000. * encode_time, 3),
+                          'decode_ms': round(1000. * decode_time, 3),
+                          'bytes': int(round(size_bytes)),
+                          'psnr': round(tile_psnr, 2),
+                          'ssim': round(tile_ssim, 5)})
+        report['backends'][name] = entry
+
+    print('%-14s %6s %10s %10s %8s %7s %8s' % ('backend', 'tiles', 'encode ms', 'decode ms', 'bytes', 'psnr', 'ssim'))
+    for name, entry in sorted(report['backends'].items()):
+        if entry['tiles'] == 0:
+            print('%-14s %6d' % (name, 0))
+        else:
+            print('%-14s %6d %10.2f %10.2f %8d %7.2f %8.4f' % (name, entry['tiles'], entry['encode_ms'],
+                                                                entry['decode_ms'], entry['bytes'],
+                                                                entry['psnr'], entry['ssim']))
+
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    return report
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage:\n$python tiles_opt_bench.py <tile directory> <optional sample size> <optional output json path>')
+    else:
+        run(sys.argv[1],
+            int(sys.argv[2]) if len(sys.argv) >= 3 else sample_size,
+            sys.argv[3] if len(sys.argv) >= 4 else None)
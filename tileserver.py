@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+__author__ = 'Will Kamp'
+__copyright__ = 'Copyright 2015, Matrix Mariner Inc.'
+__license__ = 'BSD'
+__email__ = 'will@mxmariner.com'
+__status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
+
+'''Local http tile server for previewing finished .gemf and .mbtiles archives with the chart viewer
+
+   Each archive is served under its file name (without the extension):
+   /<archive>/google.html - the viewer (google.html and viewer.js)
+   /<archive>/metadata.json - bounds, minzoom and maxzoom
+   /<archive>/<z>/<x>/<y>.png - tiles (zxy, whatever format the archive holds)
+   /stats - request latency percentiles (json)
+
+   usage: python tileserver.py <optional port> <optional archive paths (default: every archive in compiled_dir)>
+'''
+
+import collections
+import inspect
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+sys.path.insert(0, parent_dir)
+
+from mxmcc import config
+from mxmcc import gemf
+from mxmcc import gemf_mbtiles
+from mxmcc import tilesystem
+
+port = 8000
+
+# number of tiles kept in memory
+cache_tiles = 4096
+
+# number of recent requests latency percentiles are computed from
+latency_window = 10000
+latency_percentiles = (50, 90, 99)
+
+_viewer_files = {'google.html': 'text/html', 'viewer.js': 'application/javascript'}
+
+
+class MBTilesReader:
+    def __init__(self, path):
+        """reads zxy tiles from an mbtiles archive (tiles are stored with tms y)"""
+        if not os.path.isfile(path):
+            raise Exception(path + ' does not exist')
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(gemf_mbtiles.read_only_uri(self.path), uri=True)
+            self._local.db = db
+        return db
+
+    def get_tile(self, z, x, y):
+        """returns the bytes of a tile or None if the archive does not have the tile"""
+        row = self._connection().execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? '
+                                         'AND tile_row=?', (z, x, (1 << z) - 1 - y)).fetchone()
+        return None if row is None else row[0]
+
+    def metadata(self):
+        """returns a dictionary of bounds ('west,south,east,north'), minzoom and maxzoom"""
+        db = self._connection()
+        metadata = dict(db.execute('SELECT name, value FROM metadata').fetchall())
+        if 'minzoom' not in metadata or 'maxzoom' not in metadata:
+            metadata['minzoom'], metadata['maxzoom'] = db.execute('SELECT MIN(zoom_level), MAX(zoom_level) '
+                                                                  'FROM tiles').fetchone()
+        if 'bounds' not in metadata:
+            z = int(metadata['minzoom'])
+            xmin, xmax, rmin, rmax = db.execute('SELECT MIN(tile_column), MAX(tile_column), MIN(tile_row), '
+                                                'MAX(tile_row) FROM tiles WHERE zoom_level=?', (z,)).fetchone()
+            bounds = tilesystem.tile_bounds_to_lat_lng_bounds(xmin, xmax, (1 << z) - 1 - rmax, (1 << z) - 1 - rmin, z)
+            metadata['bounds'] = '%f,%f,%f,%f' % bounds
+        return {'bounds': metadata['bounds'], 'minzoom': int(metadata['minzoom']), 'maxzoom': int(metadata['maxzoom'])}
+
+
+_content_types = {'png': 'image/png', 'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+def _content_type(data):
+    # e.g. encrypted sgemf tiles are not an image format
+    return _content_types.get(gemf_mbtiles.tile_format(data), 'application/octet-stream')
+
+
+class TileCache:
+    def __init__(self, size=cache_tiles):
+        """least recently used tiles (thread safe)"""
+        self.size = size
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """returns the cached value of key or caches and returns load()"""
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key]
+            self.misses += 1
+
+        value = load()
+        with self._lock:
+            self._tiles[key] = value
+            while len(self._tiles) > self.size:
+                self._tiles.popitem(last=False)
+        return value
+
+
+class LatencyStats:
+    def __init__(self, window=latency_window):
+        """request latencies (seconds) of the last window requests"""
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.count += 1
+
+    def report(self):
+        """returns a dictionary of request count and latency percentiles (milliseconds)"""
+        with self._lock:
+            latencies = numpy.array(self._latencies)
+        report = {'requests': self.count}
+        if len(latencies) > 0:
+            for p, ms in zip(latency_percentiles, numpy.percentile(latencies, latency_percentiles) * 1000.):
+                report['p%d_ms' % p] = round(float(ms), 3)
+        return report
+
+
+def open_archive(path):
+    if path.endswith('.mbtiles'):
+        return MBTilesReader(path)
+    if path.endswith('gemf'):
+        return gemf.GemfReader(path)
+    raise Exception('%s is not a .gemf, .sgemf or .mbtiles archive' % path)
+
+
+class TileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, archive_paths, server_port=port):
+        """serves the tiles of the archives at archive_paths"""
+        self.archives = {}
+        for path in archive_paths:
+            name = os.path.basename(path)
+            self.archives[name[:name.rfind('.')]] = open_archive(path)
+        self.metadata = {}
+        self.cache = TileCache()
+        self.latency = LatencyStats()
+        ThreadingHTTPServer.__init__(self, ('localhost', server_port), _Handler)
+
+    def get_metadata(self, name):
+        if name not in self.metadata:
+            self.metadata[name] = self.archives[name].metadata()
+        return self.metadata[name]
+
+    def get_tile(self, name, z, x, y):
+        return self.cache.get((name, z, x, y), lambda: self.archives[name].get_tile(z, x, y))
+
+    def stats(self):
+        report = self.latency.report()
+        report.update({'cache_hits': self.cache.hits, 'cache_misses': self.cache.misses})
+        return report
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        for reader in self.archives.values():
+            if isinstance(reader, gemf.GemfReader):
+                reader.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        t = time.perf_counter()
+        try:
+            status, content_type, body = self._response(self.path.split('?')[0].strip('/').split('/'))
+        except Exception as e:
+            status, content_type, body = 500, 'text/plain', str(e).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.latency.add(time.perf_counter() - t)
+
+    def _response(self, parts):
+        """returns (status, content type, body) of a request path split on /"""
+        server = self.server
+        if parts == ['stats']:
+            return 200, 'application/json', json.dumps(server.stats(), sort_keys=True).encode()
+
+        if parts == ['']:
+            links = ['<a href="/%s/google.html">%s</a><br/>' % (name, name) for name in sorted(server.archives)]
+            return 200, 'text/html', ('<html><body>%s</body></html>' % ''.join(links)).encode()
+
+        if len(parts) < 2 or parts[0] not in server.archives:
+            return 404, 'text/plain', b'not found'
+
+        name = parts[0]
+        if len(parts) == 2 and parts[1] in _viewer_files:
+            with open(os.path.join(current_dir, parts[1]), 'rb') as f:
+                return 200, _viewer_files[parts[1]], f.read()
+
+        if parts[1:] == ['metadata.json']:
+            return 200, 'application/json', json.dumps(server.get_metadata(name)).encode()
+
+        if len(parts) == 4 and parts[1].isdigit() and parts[2].isdigit() and parts[3].split('.')[0].isdigit():
+            tile = server.get_tile(name, int(parts[1]), int(parts[2]), int(parts[3].split('.')[0]))
+            if tile is not None:
+                return 200, _content_type(tile), tile
+
+        return 404, 'text/plain', b'not found'
+
+    def log_message(self, format, *args):
+        pass  # latency is reported by /stats instead
+
+
+def serve(archive_paths=None, server_port=port):
+    """serves archive_paths (default: every archive in config.compiled_dir) until interrupted"""
+    if archive_paths is None:
+        archive_paths = [os.path.join(config.compiled_dir, f) for f in sorted(os.listdir(config.compiled_dir))
+                         if f.endswith('.mbtiles') or f.endswith('gemf')]
+
+    server = TileServer(archive_paths, server_port)
+    for name in sorted(server.archives):
+        print('serving http://localhost:%d/%s/google.html' % (server_port, name))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.stats(), sort_keys=True))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1].isdigit():
+        serve(sys.argv[2:] or None, int(sys.argv[1]))
+    else:
+        serve(sys.argv[1:] or None)
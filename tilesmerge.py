@@ -27,34 +27,46 @@
 #******************************************************************************
 
 from PIL import Image
+import numpy
 import glob
 from . import catalog
 from . import config
+from . import tilecull
+from . import fileplace
+from . import executor
+from .tilecache import TransparencyCache, transparency
 import os
-import pickle
 import re
 import shutil
 import sys
 import multiprocessing
 from .tilesystem import tile_size
 
+# chart-major: merge one source chart at a time into the destination (MergeSet)
+MERGE_CHART_MAJOR = 'chart'
+# tile-major: composite every chart contributing to a destination tile in one pass (TileMajorMerge)
+MERGE_TILE_MAJOR = 'tile'
+# reverse: chart-major from the highest priority chart down, skipping destination tiles that are already opaque
+MERGE_REVERSE = 'reverse'
+# every mode composites with the alpha over operator (AlphaOver), the results are the same except that the
+# chart-major modes round to 8 bits after each chart, tiles with three or more semitransparent layers may
+# differ by a unit or two
+
 
 def set_nothreads():
     global multiprocessing
     multiprocessing = None
 
 
-def parallel_map(func, iterable):
+def parallel_map(func, iterable, state=None):
+    """see executor.parallel_map"""
     if multiprocessing is None or len(iterable) < 2:
-        return map(func, iterable)
+        if state is None:
+            return list(map(func, iterable))
+        return [func(state, item) for item in iterable]
     else:
-        # map in parallel
-        mp_pool = multiprocessing.Pool()  # multiprocessing pool
-        res = mp_pool.map(func, iterable)
-        # wait for threads to finish
-        mp_pool.close()
-        mp_pool.join()
-    return res
+        # map in parallel (executor.shared_pool if there is one)
+        return executor.parallel_map(func, iterable, state)
 
 
 def re_sub_file(fname, subs_list):
@@ -72,16 +84,99 @@ class KeyboardInterruptError(Exception):
     pass
 
 
-def transparency(img):
-    """estimate transparency of an image"""
-    (r, g, b, a) = img.split()
-    (a_min, a_max) = a.getextrema()  # get min/max values for alpha channel
-    return 1 if a_min == 255 else 0 if a_max == 0 else -1
+def tile_list(tile_dir):
+    """relative z/x/y.png paths of the tiles in a zxy tile directory"""
+    try:
+        cwd = os.getcwd()
+        os.chdir(tile_dir)
+        return glob.glob('[0-9]*/*/*.png')
+    finally:
+        os.chdir(cwd)
+
+
+class AlphaOver:
+    def __init__(self):
+        """composites rgba images with the alpha over operator, the first image added is on top"""
+        self.rgb = None
+        self.alpha = None
+        self.count = 0
+
+    def add(self, img):
+        """adds an rgba PIL image or numpy uint8 array under the images already added
+           returns True once the result is opaque (further images would not show)
+        """
+        src = numpy.asarray(img, dtype=numpy.float32) / 255.
+        src_alpha = src[:, :, 3:]
+        self.count += 1
+        if self.rgb is None:
+            # accumulate premultiplied color
+            self.rgb = src[:, :, :3] * src_alpha
+            self.alpha = src_alpha.copy()
+        else:
+            remaining = 1. - self.alpha
+            self.rgb += src[:, :, :3] * src_alpha * remaining
+            self.alpha += src_alpha * remaining
+
+        return self.is_opaque()
+
+    def is_opaque(self):
+        return self.alpha is not None and self.alpha.min() >= 1. - .5 / 255.
+
+    def is_transparent(self):
+        return self.alpha is None or self.alpha.max() < .5 / 255.
+
+    def result(self):
+        """returns the rgba result as a numpy uint8 array"""
+        rgb = self.rgb
+        alpha = self.alpha
+        rgba = numpy.empty(rgb.shape[:2] + (4,), dtype=numpy.uint8)
+        rgba[:, :, :3] = numpy.rint(255. * numpy.divide(rgb, alpha, out=numpy.zeros_like(rgb), where=alpha > 0))
+        rgba[:, :, 3:] = numpy.rint(255. * alpha)
+        return rgba
+
+
+def alpha_over(tile_paths):
+    """composites tiles with the alpha over operator, the first tile is on top
+       stops reading tiles as soon as the result is opaque
+       returns the rgba result as a numpy uint8 array and the number of tiles read
+    """
+    acc = AlphaOver()
+    for path in tile_paths:
+        if acc.add(Image.open(path).convert('RGBA')):
+            break
+
+    return acc.result(), acc.count
+
+
+def composite(top, bottom):
+    """returns the rgba PIL image of top composited over bottom with the alpha over operator"""
+    acc = AlphaOver()
+    if not acc.add(top):
+        acc.add(bottom)
+    return Image.fromarray(acc.result(), 'RGBA')
+
+
+def tile_zxy(tile):
+    """zoom, x, y of a relative z/x/y.png tile path"""
+    z, x, y = tile.split(os.sep)[-3:]
+    return int(z), int(x), int(y[:y.find('.')])
+
+
+def _is_opaque(opaque, tile):
+    z, x, y = tile_zxy(tile)
+    return z in opaque and (x, y) in opaque[z]
 
 
 class MergeSet:
-    def __init__(self, src_dir, dst_dir):
+    def __init__(self, src_dir, dst_dir, region_clip=None, opaque=None):
+        """merges the tiles of src_dir into dst_dir
+           region_clip - tilecull.RegionClip, tiles outside of the region are not merged
+           opaque - set to a dictionary of zoom: set of (x, y) destination tiles that are opaque to merge
+           src_dir underneath dst_dir (reverse painter's order), opaque destination tiles are skipped
+           and the dictionary is updated with the destination tiles that became opaque
+        """
         (self.src, self.dest) = (src_dir, dst_dir)
+        self.underlay = opaque is not None
         self.tile_sz = (tile_size, tile_size) #tuple(map(int, options.tile_size.split(',')))
 
         #if options.strip_src_ext:
@@ -102,15 +197,15 @@ class MergeSet:
             os.chdir(cwd)
             #ld(self.src_lst)
 
+        if region_clip is not None:
+            self.src_lst = [tile for tile in self.src_lst if region_clip.contains(*tile_zxy(tile))]
+
+        if self.underlay:
+            self.src_lst = [tile for tile in self.src_lst if not _is_opaque(opaque, tile)]
+
         # load cached tile transparency data if any
-        self.src_transp = dict.fromkeys(self.src_lst, None)
-        self.src_cache_path = os.path.join(self.src, 'merge-cache')
-        try:
-            self.src_transp.update(pickle.load(open(self.src_cache_path, 'r')))
-        except:
-            pass
-            #ld("cache load failed")
-        #ld(repr(self.src_transp))
+        self.src_cache = TransparencyCache(self.src)
+        self.src_transp = self.src_cache.get_all(self.src_lst)
 
         # define crop map for underlay function
         tsx, tsy = self.tile_sz
@@ -120,7 +215,7 @@ class MergeSet:
         ]
 
         # do the thing
-        self.merge_dirs()
+        self.merge_dirs(opaque)
 
     def __call__(self, tile):
         """called by map() to merge a source tile into the destination tile set"""
@@ -129,11 +224,27 @@ class MergeSet:
             dst_tile = os.path.join(self.dest, tile)
             dpath = os.path.dirname(dst_tile)
             src_raster = None
+            dst_transp = None
             transp = self.src_transp[tile]
             if transp == None:  # transparency value not cached yet
                 src_raster = Image.open(src_path).convert("RGBA")
                 transp = transparency(src_raster)
-            if transp != 0:  # fully transparent
+            if transp != 0 and self.underlay:  # merge underneath the destination
+                if not os.path.exists(dpath):
+                    try:  # thread race safety
+                        os.makedirs(dpath)
+                    except os.error:
+                        pass
+                if not os.path.exists(dst_tile):
+                    fileplace.place(src_path, dst_tile)
+                    dst_transp = transp
+                else:  # semitransparent destination (opaque destination tiles are not merged)
+                    if not src_raster:
+                        src_raster = Image.open(src_path).convert("RGBA")
+                    dst_raster = composite(Image.open(dst_tile).convert("RGBA"), src_raster)
+                    fileplace.save_image(dst_raster, dst_tile)
+                    dst_transp = transparency(dst_raster)
+            elif transp != 0:  # fully transparent
                 if not os.path.exists(dpath):
                     try:  # thread race safety
                         os.makedirs(dpath)
@@ -141,46 +252,148 @@ class MergeSet:
                         pass
                 if transp == 1 or not os.path.exists(dst_tile):
                     # fully opaque or no destination tile exists yet
-                    shutil.copy(src_path, dst_tile)
+                    fileplace.place(src_path, dst_tile)
                 else:  # semitransparent, combine with destination (exists! see above)
                     if not src_raster:
                         src_raster = Image.open(src_path).convert("RGBA")
-                    dst_raster = Image.composite(src_raster, Image.open(dst_tile).convert("RGBA"), src_raster)
-                    dst_raster.save(dst_tile)
+                    dst_raster = composite(src_raster, Image.open(dst_tile).convert("RGBA"))
+                    fileplace.save_image(dst_raster, dst_tile)
                 #if options.underlay and transp != 0:
                 #    self.underlay(tile, src_path, src_raster, options.underlay)
         except KeyboardInterrupt: # http://jessenoller.com/2009/01/08/multiprocessingpool-and-keyboardinterrupt/
             print('got KeyboardInterrupt')
             raise KeyboardInterruptError()
-        return (tile, transp) # send back transparency values for caching
+        return (tile, transp, dst_transp) # send back transparency values for caching
 
     def upd_stat(self, transparency_data):
-        self.src_transp.update(dict(transparency_data))
-        try:
-            pickle.dump(self.src_transp, open(self.src_cache_path, 'w'))
-        except:
-            pass
-            #ld("cache save failed")
-            #pf('')
-
-    def merge_dirs(self):
-        src_transparency = parallel_map(self, self.src_lst)
+        new_transp = [(tile, transp) for tile, transp, dst_transp in transparency_data
+                      if self.src_transp[tile] is None]
+        self.src_transp.update(dict(new_transp))
+        self.src_cache.put_all(new_transp)
+        self.src_cache.close()
+
+    def merge_dirs(self, opaque=None):
+        src_transparency = parallel_map(executor.call, self.src_lst, state=self)
         self.upd_stat(src_transparency)
+        if opaque is not None:
+            for tile, transp, dst_transp in src_transparency:
+                if dst_transp == 1:
+                    z, x, y = tile_zxy(tile)
+                    opaque.setdefault(z, set()).add((x, y))
 
 # MergeSet end
 
 
-def merge_list(name, tile_dir_list, nothreads=False):
+class TileMajorMerge:
+    def __init__(self, src_dirs, dst_dir, region_clip=None):
+        """merges the tiles of src_dirs into dst_dir one destination tile at a time
+           src_dirs - list of input ZXY tiled map directories, highest priority first
+           region_clip - tilecull.RegionClip, tiles outside of the region are not merged
+
+           every destination tile is composited from all of its contributing source tiles
+           in a single pass and written once
+        """
+        (self.src_dirs, self.dest) = (src_dirs, dst_dir)
+        self.src_caches = [TransparencyCache(src_dir) for src_dir in src_dirs]
+
+        # plan[z/x/y.png] = [indexes of src_dirs containing the tile in priority order]
+        plan = {}
+        for i in range(len(src_dirs)):
+            for tile in tile_list(src_dirs[i]):
+                if region_clip is None or region_clip.contains(*tile_zxy(tile)):
+                    plan.setdefault(tile, []).append(i)
+
+        print('merging', len(plan), 'tiles from', len(src_dirs), 'maps into', dst_dir)
+
+        # do the thing
+        new_transp = {}
+        for result in parallel_map(executor.call, sorted(plan.items()), state=self):
+            if result is not None:
+                i, tile, transp = result
+                new_transp.setdefault(i, []).append((tile, transp))
+
+        # cache the transparency of the single source tiles evaluated by the workers
+        for i, items in new_transp.items():
+            self.src_caches[i].put_all(items)
+            self.src_caches[i].close()
+
+    def _src_transparency(self, i, tile):
+        """returns (transparency of a source tile, True if it was not cached)"""
+        transp = self.src_caches[i].get(tile)
+        if transp is not None:
+            return transp, False
+        return transparency(Image.open(os.path.join(self.src_dirs[i], tile)).convert('RGBA')), True
+
+    def __call__(self, task):
+        """called by map() to composite a destination tile from its (tile, [src_dirs indexes]) task
+           returns (src_dirs index, tile, transparency) of a single source tile without a cached transparency
+        """
+        try:
+            tile, src_indexes = task
+            src_paths = [os.path.join(self.src_dirs[i], tile) for i in src_indexes]
+            dst_tile = os.path.join(self.dest, tile)
+            dpath = os.path.dirname(dst_tile)
+
+            new_transp = None
+            if len(src_paths) == 1:
+                transp, evaluated = self._src_transparency(src_indexes[0], tile)
+                if evaluated:
+                    new_transp = (src_indexes[0], tile, transp)
+                if transp == 0:  # fully transparent, there is nothing to merge
+                    return new_transp
+
+            if not os.path.exists(dpath):
+                try:  # thread race safety
+                    os.makedirs(dpath)
+                except os.error:
+                    pass
+
+            if len(src_paths) == 1:
+                fileplace.place(src_paths[0], dst_tile)
+            else:
+                rgba, count = alpha_over(src_paths)
+                if count == 1:  # top tile is fully opaque
+                    fileplace.place(src_paths[0], dst_tile)
+                elif rgba[:, :, 3].max() > 0:
+                    fileplace.save_image(Image.fromarray(rgba, 'RGBA'), dst_tile)
+            return new_transp
+        except KeyboardInterrupt:  # http://jessenoller.com/2009/01/08/multiprocessingpool-and-keyboardinterrupt/
+            print('got KeyboardInterrupt')
+            raise KeyboardInterruptError()
+
+# TileMajorMerge end
+
+
+def _merge_dirs(tile_dir_list, merge_dir, mode, region_clip=None):
+    if mode == MERGE_TILE_MAJOR:
+        TileMajorMerge(list(reversed(tile_dir_list)), merge_dir, region_clip)
+    elif mode == MERGE_REVERSE:
+        # opaque[zoom] = set of (x, y) destination tiles that are already opaque
+        opaque = {}
+        for tile_dir in reversed(tile_dir_list):
+            MergeSet(tile_dir, merge_dir, region_clip, opaque)
+    elif mode == MERGE_CHART_MAJOR:
+        for tile_dir in tile_dir_list:
+            MergeSet(tile_dir, merge_dir, region_clip)
+    else:
+        raise Exception('unknown merge mode: %s' % mode)
+
+
+def merge_list(name, tile_dir_list, nothreads=False, mode=MERGE_CHART_MAJOR):
     """merge a list of XZY tiled map directories into a single directory
        name - output directory will be the directory defined in config.py + name
        tile_dir_list - list of input ZXY tiled map directories
        nothreads - set to true if you don't want multiprocessing
+       mode - MERGE_CHART_MAJOR, MERGE_TILE_MAJOR or MERGE_REVERSE
 
        note: tile_dir_list should be sorted by map scale descending so that larger scale
        map tiles (that are close in scale and the same zoom level as another intersecting
        map) get priority
 
        note: tiles with transparency will be combined if possible with data from another tile
+
+       note: merged tiles may be hard links to (share data with) the input tiles,
+       rewrite them with fileplace.save_image, never modify them in place
     """
     if nothreads:
         set_nothreads()
@@ -193,17 +406,20 @@ def merge_list(name, tile_dir_list, nothreads=False):
         shutil.rmtree(merge_dir, ignore_errors=True)
 
     for tile_dir in tile_dir_list:
-        if os.path.isdir(tile_dir):
-            MergeSet(tile_dir, merge_dir)
-        else:
+        if not os.path.isdir(tile_dir):
             raise Exception('map %s is missing from tiles list', os.path.basename(tile_dir))
 
+    _merge_dirs(tile_dir_list, merge_dir, mode)
 
-def merge_catalog(catalog_name, nothreads=False):
+
+def merge_catalog(catalog_name, nothreads=False, mode=MERGE_CHART_MAJOR):
     """merge a catalog of XZY tiled map directories into a single directory
        catalog_name - name of catalog to merge, also the name of the ouput directory
        to be created in congig.merged_tile_dir
        nothreads - set to true if you don't want multiprocessing
+       mode - MERGE_CHART_MAJOR, MERGE_TILE_MAJOR or MERGE_REVERSE
+
+       note: tiles outside of the region boundary (if the region has one) are not merged
     """
 
     if nothreads:
@@ -211,6 +427,7 @@ def merge_catalog(catalog_name, nothreads=False):
 
     reader = catalog.get_reader_for_region(catalog_name)
     merge_dir = os.path.join(config.merged_tile_dir, catalog_name)
+    region_clip = tilecull.region_clip_for_region(catalog_name)
 
     if not os.path.isdir(merge_dir):
         os.makedirs(merge_dir)
@@ -228,11 +445,14 @@ def merge_catalog(catalog_name, nothreads=False):
     if unmerged_tile_dir is None:
         raise Exception('%s is not in unmerged tiles directory' % catalog_name)
 
+    tile_dir_list = []
     for entry in reader:
         map_name = os.path.basename(entry['path'])
         map_name = map_name[0:map_name.find('.')]
         tile_dir = os.path.join(unmerged_tile_dir, map_name)
         if os.path.isdir(tile_dir):
-            MergeSet(tile_dir, merge_dir)
+            tile_dir_list.append(tile_dir)
         else:
-            raise Exception('map %s missing from tiles' % map_name)
\ No newline at end of file
+            raise Exception('map %s missing from tiles' % map_name)
+
+    _merge_dirs(tile_dir_list, merge_dir, mode, region_clip)
@@ -253,4 +253,15 @@ def lat_lng_bounds_to_tile_bounds_count(min_lng, max_lat, max_lng, min_lat, leve
     if num_tiles_west_east < 0:
         num_tiles_west_east = (map_size_tiles(level_of_detail) - tile_west) + tile_east + 2
 
-    return tile_west, tile_north, tile_east, tile_south, num_tiles_west_east, num_tiles_north_south
\ No newline at end of file
+    return tile_west, tile_north, tile_east, tile_south, num_tiles_west_east, num_tiles_north_south
+
+def tile_bounds_to_lat_lng_bounds(tile_west, tile_east, tile_north, tile_south, level_of_detail):
+    """
+        Tile system bounds (inclusive tile x and y extents) to latitude longitude bounds
+        :param level_of_detail: tile system zoom level
+        :return: min_lng, min_lat, max_lng, max_lat
+    """
+    max_lat, min_lng = pixel_xy_to_lat_lng(tile_west * tile_size, tile_north * tile_size, level_of_detail)
+    min_lat, max_lng = pixel_xy_to_lat_lng((tile_east + 1) * tile_size, (tile_south + 1) * tile_size,
+                                           level_of_detail)
+    return min_lng, min_lat, max_lng, max_lat
@@ -15,26 +15,29 @@ from PIL import Image
 
 from . import catalog
 from . import config
+from . import gemf
+from .tilecache import TransparencyCache, transparency
 
 
 error_message = ''
 IGNORED = {'.DS_Store'}
 
 
-def _full_transparency(img):
+def _full_transparency(img_path, cache):
     """is image fully transparent"""
-    rgba = img.split()
-    if len(rgba) < 4:
-        return False
+    tile = os.path.relpath(img_path, cache.tile_dir)
+    transp = cache.get(tile)
+    if transp is None:
+        transp = transparency(Image.open(img_path).convert('RGBA'))
+        cache.put(tile, transp)
 
-    (r, g, b, a) = rgba
-    (a_min, a_max) = a.getextrema()  # get min/max values for alpha channel
-    return a_min == 0 and a_max == 0
+    return transp == 0
 
 
-def _x_dir_has_tiles(x_dir):
+def _x_dir_has_tiles(x_dir, cache):
     """
     :param x_dir: zxy tile x directory
+    :param cache: TransparencyCache of the tile directory
     :return: count of all the png tiles in the directory
     """
 
@@ -46,8 +49,7 @@ def _x_dir_has_tiles(x_dir):
         name, ext = ne
         if name.isdigit() and ext.lower() == 'png':
             img_path = os.path.join(x_dir, d)
-            img = Image.open(img_path)
-            if _full_transparency(img):
+            if _full_transparency(img_path, cache):
                 print(img_path)
             else:
                 return True
@@ -58,18 +60,19 @@ def _x_dir_has_tiles(x_dir):
 def verify_opt(catalog_name, base_dir=config.merged_tile_dir):
     un_opt_dir = os.path.join(base_dir, catalog_name)
     opt_dir = un_opt_dir + ".opt"
+    # optimized tiles can change format (extension)
     un_opt_set = set()
     for path, dirs, files in os.walk(un_opt_dir):
         p = path.replace(un_opt_dir, '')
         for f in files:
             if not f.startswith('.'):
-                un_opt_set.add(os.path.join(p, f))
+                un_opt_set.add(os.path.splitext(os.path.join(p, f))[0])
     opt_set = set()
     for path, dirs, files in os.walk(opt_dir):
         p = path.replace(opt_dir, '')
         for f in files:
             if not f.startswith('.'):
-                opt_set.add(os.path.join(p, f))
+                opt_set.add(os.path.splitext(os.path.join(p, f))[0])
 
     i = len(un_opt_set)
     n = len(opt_set)
@@ -132,6 +135,7 @@ def verify_tile_dir(tile_dir):
 
     # we should have at least one zoom dir
     if len(found_zoom_dirs) > 0:
+        cache = TransparencyCache(tile_dir)
 
         # check for tiles
         for z_dir in found_zoom_dirs:
@@ -152,10 +156,13 @@ def verify_tile_dir(tile_dir):
                 if x_dir in IGNORED:
                     continue
                 x_dir = os.path.join(z_dir, x_dir)
-                if not _x_dir_has_tiles(x_dir):
+                if not _x_dir_has_tiles(x_dir, cache):
                     error_message += 'zero tiles in directory path: ' + os.path.join(z_dir, x_dir) + '\n'
+                    cache.close()
                     return False
 
+        cache.close()
+
     else:
         error_message += 'zero zoom directories found for ' + tile_dir + '\n'
         return False
@@ -163,6 +170,40 @@ def verify_tile_dir(tile_dir):
     return True
 
 
+def verify_gemf(gemf_path, tile_dir):
+    """
+    :param gemf_path: path of a (s)gemf archive or list of the paths of its zoom band archives
+    :param tile_dir: zxy tile directory the archive was generated from
+    :return: if every tile in tile_dir is read back from the archive with the same content
+    """
+    global error_message
+
+    gemf_paths = gemf_path if isinstance(gemf_path, list) else [gemf_path]
+    scan = gemf.TileScan(tile_dir)
+    readers = [gemf.GemfReader(path) for path in gemf_paths]
+    try:
+        band_readers = {}  # zoom: (reader, path) of the archive with the zoom level
+        for reader, path in zip(readers, gemf_paths):
+            for z in reader.zooms:
+                band_readers[z] = (reader, path)
+
+        for i in range(len(scan)):
+            z, x, y = int(scan.z[i]), int(scan.x[i]), int(scan.y[i])
+            if z not in band_readers:
+                error_message += 'zoom %d is not in %s\n' % (z, ', '.join(gemf_paths))
+                return False
+            reader, path = band_readers[z]
+            with open(scan.path(i), 'rb') as f:
+                if reader.get_tile(z, x, y) != f.read():
+                    error_message += '%d/%d/%d does not match in %s\n' % (z, x, y, path)
+                    return False
+    finally:
+        for reader in readers:
+            reader.close()
+
+    return True
+
+
 def verify(region_lst):
     for region in region_lst:
         region = region.upper()
@@ -10,6 +10,7 @@ __status__ = 'Development'  # 'Prototype', 'Development', or 'Production'
 
 import codecs
 import os.path
+import re
 import zipfile
 
 from . import config
@@ -48,23 +49,22 @@ def generate_update():
     print(zdat_path)
     zdat = zipfile.ZipFile(zdat_path, 'w', zipfile.ZIP_DEFLATED)
     sqlf = open(sql_path, 'w')
-    gemf_lst = []
+    # region: size of its archive files, zoom band archives (REGION.z<min>-<max>.gemf) and split parts
+    # (REGION.gemf-1 ...) add to the size of their region
+    region_sizes = {}
     for ea in os.listdir(config.compiled_dir):
-        if ea.endswith('gemf'):
-            gemf_lst.append(os.path.join(config.compiled_dir, ea))
-    gemf_lst.sort()
+        if re.search(r'gemf(-\d+)?$', ea):
+            region = ea[:ea.find('.')]
+            region_sizes[region] = region_sizes.get(region, 0) + os.path.getsize(os.path.join(config.compiled_dir, ea))
 
-    if len(gemf_lst) is 0:
+    if len(region_sizes) is 0:
         return
 
     sqlstr = u'update regions set latestdate=\'%s\', size=\'%s\' where name=\'%s\';'
     sqlf.write(u'--MXMARINER-DBVERSION:1\n')
-    for p in gemf_lst:
-        size = str(os.path.getsize(p))
-        region = os.path.basename(p)
-        region = region[:region.rfind('.')]
+    for region, size in sorted(region_sizes.items()):
         z_path = os.path.join(config.compiled_dir, region + '.zdat')
-        sqlf.write(sqlstr % (get_zdat_epoch(z_path), size, region) + '\n')
+        sqlf.write(sqlstr % (get_zdat_epoch(z_path), str(size), region) + '\n')
 
     sqlf.close()
     zdat.write(sql_path, sql_fname)